@@ -0,0 +1,104 @@
+import os
+
+# 一時ファイルの保存先
+TEMP_DIR = os.environ.get("TEMP_DIR", "temp")
+TEMP_QUOTA_BYTES = int(os.environ.get("TEMP_QUOTA_BYTES", str(2 * 1024 ** 3)))  # 2GB
+TEMP_MAX_AGE = float(os.environ.get("TEMP_MAX_AGE", "3600"))  # 使われていない一時ファイルの保持期間（秒）
+TEMP_JANITOR_INTERVAL = float(os.environ.get("TEMP_JANITOR_INTERVAL", "60"))  # 掃除の間隔（秒）
+
+# 変換済み音声キャッシュの設定
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(2 * 1024 ** 3)))  # 2GB
+CACHE_EVICTION_POLICY = os.environ.get("CACHE_EVICTION_POLICY", "lru")  # lru / lfu
+
+# 同一動画の重複処理を防ぐロック
+LOCK_DIR = os.environ.get("LOCK_DIR", os.path.join(TEMP_DIR, "locks"))
+SINGLEFLIGHT_OUTCOME_TTL = float(os.environ.get("SINGLEFLIGHT_OUTCOME_TTL", "10"))
+
+# 動画メタデータのキャッシュ（ストリームURLの有効期限より短くする）
+METADATA_CACHE_TTL = float(os.environ.get("METADATA_CACHE_TTL", "1800"))
+METADATA_CACHE_MAX_ENTRIES = int(os.environ.get("METADATA_CACHE_MAX_ENTRIES", "256"))  # プロセス内に置く件数
+INFO_CACHE_DB_PATH = os.environ.get("INFO_CACHE_DB_PATH", os.path.join(CACHE_DIR, "info.db"))  # ワーカー間で共有
+INFO_CACHE_MAX_ENTRIES = int(os.environ.get("INFO_CACHE_MAX_ENTRIES", "5000"))
+
+# uvicornのワーカープロセス数（uvicorn自身もこの環境変数を --workers の既定値として使う）。
+# CPU・メモリの枠はワーカーごとに持つため、この数で割って使う
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+
+# 並列処理の上限
+ALBUM_CONCURRENCY = int(os.environ.get("ALBUM_CONCURRENCY", "4"))  # アルバム内で同時に処理する曲数
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))  # 一括抽出で同時に処理する動画数
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", "50"))  # 一括抽出で受け付けるURL数の上限
+INFO_CONCURRENCY = int(os.environ.get("INFO_CONCURRENCY", "8"))  # 情報の一括取得で同時に解決する動画数
+INFO_MAX_URLS = int(os.environ.get("INFO_MAX_URLS", "100"))  # 情報の一括取得で受け付けるURL・IDの数の上限
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "4"))  # 同時ダウンロード数
+TRANSCODE_CONCURRENCY = int(os.environ.get("TRANSCODE_CONCURRENCY", "0"))  # ワーカーごとの同時変換数（0 = CPU数 ÷ ワーカー数）
+TRANSCODE_MAX_QUEUE = int(os.environ.get("TRANSCODE_MAX_QUEUE", "0"))  # 変換待ちの上限（0 = 同時変換数 x 4）
+YDL_POOL_MAX_IDLE = int(os.environ.get("YDL_POOL_MAX_IDLE", "8"))  # オプションごとに保持するYoutubeDLの数
+
+# メモリの上限による受け付け制御（処理の種類ごとの見積もりで受け付ける・待たせる・断るを決める）
+MEMORY_LIMIT_BYTES = int(os.environ.get("MEMORY_LIMIT_BYTES", "0"))  # 0 = cgroupの上限（無ければ物理メモリ）
+MEMORY_HIGH_WATER = float(os.environ.get("MEMORY_HIGH_WATER", "0.8"))  # 上限に対してここまで使ってよい割合
+MEMORY_MAX_QUEUE = int(os.environ.get("MEMORY_MAX_QUEUE", "8"))  # メモリの空きを待つリクエストの上限
+MEMORY_QUEUE_TIMEOUT = float(os.environ.get("MEMORY_QUEUE_TIMEOUT", "30"))  # 空きを待つ最大秒数（超えたら429）
+MEMORY_POLL_INTERVAL = float(os.environ.get("MEMORY_POLL_INTERVAL", "0.5"))
+# ワーカーが複数のとき、予約をワーカー間で共有する台帳（各ワーカーが他のワーカーの予約も数えて判断する）
+MEMORY_LEDGER_PATH = os.environ.get("MEMORY_LEDGER_PATH", os.path.join(CACHE_DIR, "memory.db"))
+MEMORY_COSTS = {  # 1件あたりの見積もり（バイト）
+    "single": int(os.environ.get("MEMORY_COST_SINGLE", str(48 * 1024 ** 2))),
+    "stream": int(os.environ.get("MEMORY_COST_STREAM", str(32 * 1024 ** 2))),
+    "playlist": int(os.environ.get("MEMORY_COST_PLAYLIST", str(128 * 1024 ** 2))),  # アルバム・同期（ALBUM_CONCURRENCY 曲を並列に処理）
+    "batch": int(os.environ.get("MEMORY_COST_BATCH", str(128 * 1024 ** 2))),  # BATCH_CONCURRENCY 件を並列に処理
+}
+
+# 抽出の優先度と公平な順番待ち（対話的 > 一括 > 先読み。同じ優先度の中ではクライアントごとに交互に処理する）
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", str(DOWNLOAD_CONCURRENCY)))  # 同時に処理する曲数
+SCHEDULER_INTERACTIVE_RESERVED = int(os.environ.get("SCHEDULER_INTERACTIVE_RESERVED", "1"))  # 一括・先読みには使わせない枠
+SCHEDULER_CLIENT_WEIGHTS = {  # "key:xxxx=2,ip:10.0.0.5=0.5" の形式（クライアントIDは /api/v1/scheduler/status で確認）
+    client.strip(): float(weight)
+    for client, _, weight in (
+        item.rpartition("=") for item in os.environ.get("SCHEDULER_CLIENT_WEIGHTS", "").split(",") if "=" in item
+    )
+}
+SCHEDULER_TRUST_FORWARDED = os.environ.get("SCHEDULER_TRUST_FORWARDED", "0") not in ("0", "false", "no")  # X-Forwarded-For を使う
+
+# ダウンロードエンジン
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))  # 1つのダウンロードで並列に取得する範囲・分割の数
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", str(4 * 1024 ** 2)))  # 範囲1つの大きさ（バイト）
+DOWNLOAD_CHUNK_RETRIES = int(os.environ.get("DOWNLOAD_CHUNK_RETRIES", "3"))
+DOWNLOAD_HOST_CONNECTIONS = int(os.environ.get("DOWNLOAD_HOST_CONNECTIONS", "8"))  # 接続先ホストごとの同時接続数
+DOWNLOAD_BANDWIDTH_LIMIT = float(os.environ.get("DOWNLOAD_BANDWIDTH_LIMIT", "0"))  # 全体の帯域の上限（bytes/s、0 = 無制限）
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", "30"))
+
+# 段階ごとの再試行（指数バックオフ + ジッター）と、上流の失敗が続いたときの遮断
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", "3"))  # 各段階の試行回数
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "1"))  # 1回目の再試行までの最大待ち時間（秒）
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "30"))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))  # 連続失敗で遮断する回数
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))  # 遮断してから再び試すまでの秒数
+
+# 起動後の事前準備（重いモジュールの読み込み・FFmpegの確認・YoutubeDLの初期化）。終わるまで /ready は503
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") not in ("0", "false", "no")
+
+# 先読み（空いている時間に次に使われそうな動画を変換して結果キャッシュへ入れる）
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") not in ("0", "false", "no")
+PREFETCH_CONCURRENCY = int(os.environ.get("PREFETCH_CONCURRENCY", "1"))  # ワーカーごとの同時先読み数
+PREFETCH_MAX_QUEUE = int(os.environ.get("PREFETCH_MAX_QUEUE", "50"))  # 待ち行列の上限（超えたら古いものから捨てる）
+PREFETCH_PLAYLIST_AHEAD = int(os.environ.get("PREFETCH_PLAYLIST_AHEAD", "3"))  # プレイリストで先読みする後続の曲数
+PREFETCH_IDLE_POLL = float(os.environ.get("PREFETCH_IDLE_POLL", "1"))  # 空き状況を確かめ直す間隔（秒）
+
+# 非同期ジョブ
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", os.path.join(CACHE_DIR, "jobs.db"))
+JOB_RESULT_DIR = os.environ.get("JOB_RESULT_DIR", os.path.join(CACHE_DIR, "jobs"))
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", str(24 * 3600)))  # 結果の保持期間（秒）
+
+# プレイリスト同期のマニフェスト
+MANIFEST_DIR = os.environ.get("MANIFEST_DIR", os.path.join(CACHE_DIR, "manifests"))
+
+# カバー画像
+COVER_CACHE_DIR = os.environ.get("COVER_CACHE_DIR", os.path.join(CACHE_DIR, "covers"))
+COVER_CACHE_MAX_BYTES = int(os.environ.get("COVER_CACHE_MAX_BYTES", str(256 * 1024 ** 2)))  # 256MB
+COVER_CACHE_MAX_AGE = float(os.environ.get("COVER_CACHE_MAX_AGE", str(30 * 24 * 3600)))  # 使われていないカバーの保持期間（秒）
+COVER_SIZE = int(os.environ.get("COVER_SIZE", "600"))  # 正方形カバーの最大辺（px）
+THUMBNAIL_TIMEOUT = float(os.environ.get("THUMBNAIL_TIMEOUT", "10"))
+THUMBNAIL_MAX_CONNECTIONS = int(os.environ.get("THUMBNAIL_MAX_CONNECTIONS", "8"))
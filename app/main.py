@@ -1,8 +1,22 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+import asyncio
 import logging
-from routes import audio  # 相対インポートを絶対インポートに変更
+from contextlib import asynccontextmanager
+import config
+from routes import audio, jobs  # 相対インポートを絶対インポートに変更
+from services.cache import get_result_cache
+from services.download_engine import get_download_engine
+from services.extractor import AudioExtractor
+from services.jobs import get_job_runner
+from services.prefetch import get_prefetch_queue
+from services.scheduler import WorkContextMiddleware
+from services.thumbnail import get_thumbnail_fetcher
+from services.temp_space import get_temp_space
+from services.warmup import FirstSuccessMiddleware, get_warmup_state, run_warmup
+from services.metrics import CONTENT_TYPE_LATEST, MetricsMiddleware, mark_process_dead, render_metrics
 import uvicorn
 
 # ロギングの設定
@@ -12,11 +26,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 停止したワーカーのジョブを引き継ぐ
+    runner = get_job_runner()
+    runner.cleanup_expired()
+    resumed = runner.resume_orphaned()
+    if resumed:
+        logger.info(f"Resumed {resumed} jobs")
+    # 一時領域の定期的な掃除（リクエスト処理中にはディレクトリを走査しない）
+    janitor = asyncio.create_task(get_temp_space().run_janitor())
+    # 重いモジュールの読み込みやYoutubeDLの初期化は起動を待たせずにバックグラウンドで行う（状態は /ready）
+    warmup = asyncio.create_task(run_warmup())
+    # 以前のキャッシュエントリのETagを計算しておく（リクエスト処理中にファイル全体を読まない）
+    backfill = asyncio.create_task(asyncio.to_thread(get_result_cache().backfill_etags))
+    # 空いている時間だけ先読みを進める（対話的な抽出が始まると中止して待ち行列に戻す）
+    prefetch = None
+    if config.PREFETCH_ENABLED:
+        prefetch = asyncio.create_task(
+            get_prefetch_queue().run(lambda item: AudioExtractor(item.profile).prefetch(item.video_id, item.playlist_id)))
+    yield
+    if prefetch:
+        prefetch.cancel()
+    warmup.cancel()
+    backfill.cancel()
+    janitor.cancel()
+    await get_thumbnail_fetcher().close()
+    await get_download_engine().close()
+    mark_process_dead()
+
 # FastAPIアプリケーションの初期化
 app = FastAPI(
     title="YouTube Audio Extractor",
     description="Extract high quality audio from YouTube videos",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORSミドルウェアの設定
@@ -27,6 +71,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 送信バイト数の計測
+app.add_middleware(MetricsMiddleware)
+# 起動から最初にリクエストが成功するまでの時間の計測
+app.add_middleware(FirstSuccessMiddleware)
+# クライアントの識別（抽出の順番待ちをクライアントごとに公平にする）
+app.add_middleware(WorkContextMiddleware)
 
 # リクエストモデル
 class AudioExtractionRequest(BaseModel):
@@ -34,12 +84,28 @@ class AudioExtractionRequest(BaseModel):
 
 # ルートの登録
 app.include_router(audio.router, prefix="/api/v1")  # これを追加
+app.include_router(jobs.router, prefix="/api/v1")
+
 
 # ヘルスチェックエンドポイント
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+
+# 準備完了チェック（事前準備が終わるまで503。ロードバランサーはこちらで振り分ける）
+@app.get("/ready")
+async def readiness_check():
+    state = get_warmup_state()
+    return JSONResponse(status_code=200 if state.ready else 503, content=state.status())
+
+
+# Prometheusのメトリクス（全ワーカー分を集計）
+@app.get("/metrics")
+async def metrics():
+    content = await asyncio.to_thread(render_metrics)  # 一時ディレクトリの走査を含むため
+    return Response(content=content, media_type=CONTENT_TYPE_LATEST)
+
 # ルーターのインポートと登録は後で追加
 
 
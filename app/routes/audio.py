@@ -1,44 +1,111 @@
-from fastapi import APIRouter, HTTPException, Response
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, HttpUrl
-from services.extractor import AudioExtractor
+from typing import Dict, List
+from services.extractor import AudioExtractor, create_extractor
+from services.profiles import AUTO_PROFILE, DEFAULT_PROFILE, media_type_for
+from services.cache import get_result_cache
+from services.temp_space import get_temp_space
+from utils.file_serving import serve_file
+from services.transcode_executor import get_transcode_executor
+from services.memory_governor import BATCH, PLAYLIST, SINGLE, STREAM, get_memory_governor
 from utils.file_handler import cleanup_temp_file
+from services.album import album_archive_entries, album_zip_stream, playlist_video_urls, safe_name
+from services.batch import batch_archive_entries, batch_ndjson_stream, group_batch_urls, ndjson_line
+from services.playlist_sync import album_sync_entries, get_manifest_store, plan_sync
+from services.info_lookup import group_info_targets, info_ndjson_stream
+from services.prefetch import PrefetchItem, get_prefetch_queue
+from services.scheduler import BULK, get_scheduler, set_work
+import config
+import asyncio
 import logging
 from urllib.parse import quote, urlparse, parse_qs
 import os
-import zipfile
 from fastapi import BackgroundTasks
-import shutil
-from mutagen.id3 import ID3
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 class AudioExtractionRequest(BaseModel):
     url: HttpUrl
+    stream: bool = False  # 変換しながら送信する
+    profile: str = DEFAULT_PROFILE  # mp3-320 / mp3-256 / mp3-192 / mp3-128 / opus / m4a / auto
+
+
+class AlbumSyncRequest(AudioExtractionRequest):
+    delta: bool = False  # 前回の同期から増えた・変わった曲だけを返す
+
+
+class BatchExtractionRequest(BaseModel):
+    urls: List[str]  # 不正なURLは個別のエラーとして返す（リクエスト全体は失敗させない）
+    profile: str = DEFAULT_PROFILE
+    format: str = "zip"  # zip / ndjson
+
+
+class InfoRequest(BaseModel):
+    urls: List[str]  # 動画のURL、または動画ID
+
+
+class PrefetchRequest(BaseModel):
+    urls: List[str]  # 動画のURL、または動画ID
+    profile: str = DEFAULT_PROFILE  # auto は受け付けない（クライアントごとに決まるため）
 
 
 @router.post("/extract-audio")
-async def extract_audio(request: AudioExtractionRequest):
+async def extract_audio(request: AudioExtractionRequest, http_request: Request):
     try:
-        extractor = AudioExtractor()
-        result = await extractor.extract(str(request.url))
-        
+        extractor = await create_extractor(request.profile, str(request.url),
+                                           http_request.headers.get("accept"))
+        cached = await extractor.get_cached(str(request.url))
+        if not cached:
+            # 変換待ちが満杯なら待たせずに429を返す
+            get_transcode_executor().check_admission()
+
+        # ストリーミングモード：変換しながら送信（キャッシュ済み、またはMP3以外なら通常どおりファイルを返す）
+        if request.stream and not cached and extractor.profile.codec == 'mp3':
+            # 送信が終わるまでメモリの見積もりを予約しておく
+            reservation = await get_memory_governor().acquire(STREAM)
+            try:
+                meta, body = await extractor.extract_stream(str(request.url))
+            except BaseException:
+                await reservation.release()
+                raise
+            return StreamingResponse(
+                reservation.hold(body),
+                media_type="audio/mpeg",
+                headers={"Content-Disposition": content_disposition(meta["filename"])},
+                background=BackgroundTask(reservation.release),
+            )
+
+        result = await _extract_single(extractor, str(request.url), bool(cached))
+
+        # キャッシュ管理下のファイルは安定したURLでも取得できる（再開・シーク用）
+        if result.get("cache_key"):
+            try:
+                return _serve_cached_result(http_request, extractor, result)
+            except FileNotFoundError:
+                if not result.get("cached"):
+                    raise
+                # 参照してから送るまでに別のワーカーが削除した場合は、キャッシュから外して変換し直す
+                logger.warning(f"Cached file vanished before serving, re-extracting: {result['file_path']}")
+                await asyncio.to_thread(extractor.cache.drop, result["cache_key"])
+                get_transcode_executor().check_admission()
+                result = await _extract_single(extractor, str(request.url), False)
+                if result.get("cache_key"):
+                    return _serve_cached_result(http_request, extractor, result)
+
         # ファイル名を適切にエンコード
         filename = result["filename"]
-        encoded_filename = quote(filename)
-        
-        response = FileResponse(
-            path=result["file_path"],
-            media_type="audio/mpeg",
-            filename=filename  # オリジナルのファイル名
+
+        # キャッシュへの登録に失敗した一時ファイルは送信後に削除（開いた状態で送るので先に消えても問題ない）
+        response = serve_file(
+            http_request.headers, http_request.method, result["file_path"], result.get("etag"),
+            result.get("media_type", extractor.profile.media_type),
+            headers={"content-disposition": content_disposition(filename)},
+            conditional=False,
         )
-        
-        # Content-Dispositionヘッダーを明示的に設定
-        response.headers["Content-Disposition"] = f'attachment; filename="{encoded_filename}"; filename*=UTF-8\'\'{encoded_filename}'
-        
-        response.background = lambda: cleanup_temp_file(result["file_path"])
-        
+        response.background = BackgroundTask(cleanup_temp_file, result["file_path"])
         return response
 
     except HTTPException as he:
@@ -49,10 +116,62 @@ async def extract_audio(request: AudioExtractionRequest):
         raise HTTPException(status_code=400, detail=str(e))
 
 
+async def _extract_single(extractor: AudioExtractor, url: str, cached: bool) -> Dict:
+    if cached:
+        return await extractor.extract(url)
+    # メモリに余裕が無ければ空くまで待つ（待ちきれなければ429）
+    async with get_memory_governor().admit(SINGLE):
+        return await extractor.extract(url)
+
+
+def _serve_cached_result(http_request: Request, extractor: AudioExtractor, result: Dict) -> Response:
+    return serve_file(
+        http_request.headers, http_request.method, result["file_path"], result.get("etag"),
+        result.get("media_type", extractor.profile.media_type),
+        headers={
+            "content-disposition": content_disposition(result["filename"]),
+            "content-location": artifact_url(result["cache_key"]),
+        },
+        conditional=False,
+    )
+
+
+def artifact_url(cache_key: str) -> str:
+    """変換済みファイルの安定したURL"""
+    return f"/api/v1/artifacts/{cache_key}"
+
+
+@router.api_route("/artifacts/{cache_key}", methods=["GET", "HEAD"])
+async def get_artifact(cache_key: str, http_request: Request):
+    """変換済みファイルを返す（Range・ETag対応）"""
+    cache = get_result_cache()
+    entry = await asyncio.to_thread(cache.get_by_key, cache_key)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    try:
+        return serve_file(
+            http_request.headers, http_request.method, entry["path"], await asyncio.to_thread(cache.etag, entry),
+            media_type_for(entry["codec"]),
+            headers={
+                "content-disposition": content_disposition(entry["filename"] or os.path.basename(entry["path"])),
+                "cache-control": "public, max-age=86400",
+            },
+        )
+    except FileNotFoundError:
+        # 参照直後に削除された
+        raise HTTPException(status_code=404, detail="Artifact not found")
+
+
+def content_disposition(filename: str) -> str:
+    """日本語などを含むファイル名用のContent-Dispositionヘッダー値"""
+    encoded_filename = quote(filename)
+    return f'attachment; filename="{encoded_filename}"; filename*=UTF-8\'\'{encoded_filename}'
+
+
 
 
 @router.post("/extract-album")
-async def extract_album(request: AudioExtractionRequest):
+async def extract_album(request: AudioExtractionRequest, http_request: Request):
     try:
         parsed_url = urlparse(str(request.url))
         query_params = parse_qs(parsed_url.query)
@@ -61,98 +180,255 @@ async def extract_album(request: AudioExtractionRequest):
         if playlist_id:
             playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
             logger.info(f"Found playlist URL: {playlist_url}")
+            # 曲ごとに一括の優先度で順番待ちし、他のクライアントの1曲の抽出を先に通す
+            set_work(BULK)
 
-            extractor = AudioExtractor()
-            playlist_info = await extractor.get_playlist_info(playlist_url)
+            get_transcode_executor().check_admission()
+            reservation = await get_memory_governor().acquire(PLAYLIST)
+            try:
+                extractor = await create_extractor(request.profile, playlist_url,
+                                                   http_request.headers.get("accept"))
+                playlist_info = await extractor.get_playlist_info(playlist_url)
             
-            # アルバムディレクトリの作成
-            album_title = playlist_info.get('title', 'Unknown_Album')
-            safe_album_title = "".join(c for c in album_title if c.isalnum() or c in (' ', '-', '_')).rstrip()
-            album_dir = os.path.join(extractor.temp_dir, safe_album_title)
-            os.makedirs(album_dir, exist_ok=True)
-            logger.info(f"Created album directory: {album_dir}")
-
-            total_videos = len(playlist_info.get('entries', []))
-            logger.info(f"Processing {total_videos} videos for album: {album_title}")
-
-            # ファイルの保存を確認するためのログを追加
-            saved_files = []
-
-            # 各動画を処理
-            for i, entry in enumerate(playlist_info.get('entries', []), 1):
-                video_id = entry.get('id')
-                if video_id:
-                    video_url = f"https://www.youtube.com/watch?v={video_id}"
+                # リクエストごとのアルバムディレクトリ（同じアルバムの同時リクエストと衝突しない）
+                album_title = playlist_info.get('title', 'Unknown_Album')
+                safe_album_title = safe_name(album_title)
+                workdir = get_temp_space().workdir("album")
+                album_dir = workdir.path
+                logger.info(f"Created album directory: {album_dir}")
+
+                total_videos = len(playlist_info.get('entries', []))
+                logger.info(f"Processing {total_videos} videos for album: {album_title}")
+
+                # 各動画を並列に処理（結果はプレイリストの順序どおり）
+                video_urls = playlist_video_urls(playlist_info)
+                entries = album_archive_entries(extractor, video_urls, safe_album_title, output_dir=album_dir)
+
+                async def stream_album():
                     try:
-                        # album_dir を渡して、そこにファイルを保存
-                        result = await extractor.extract(video_url, output_dir=album_dir)
-                        saved_files.append(result["file_path"])
-                        logger.info(f"Saved file: {result['file_path']}")
-                    except Exception as e:
-                        logger.error(f"Error processing video {video_id}: {str(e)}")
-
-            # 保存されたファイルの確認
-            files_in_dir = os.listdir(album_dir)
-            logger.info(f"Files in album directory before ZIP: {files_in_dir}")
-
-
-            # ZIPファイルの作成
-            zip_path = f"{album_dir}.zip"
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                for file in os.listdir(album_dir):
-                    if file.endswith('.mp3'):
-                        file_path = os.path.join(album_dir, file)
-                        # ファイル名を曲名に変更
-                        try:
-                            audio = ID3(file_path)
-                            title = audio.get('TIT2', ['Unknown Title'])[0]
-                            # 安全なファイル名に変換
-                            safe_title = "".join(c for c in str(title) if c.isalnum() or c in (' ', '-', '_')).rstrip()
-                            archive_path = os.path.join(safe_album_title, f"{safe_title}.mp3")
-                        except:
-                            # タグ取得に失敗した場合は元のファイル名を使用
-                            archive_path = os.path.join(safe_album_title, file)
-                        
-                        logger.info(f"Adding to ZIP: {file_path} as {archive_path}")
-                        zipf.write(file_path, archive_path)
-                        
-
-            # ZIP後の確認
-            if os.path.exists(zip_path):
-                zip_size = os.path.getsize(zip_path)
-                logger.info(f"Created ZIP file: {zip_path}, size: {zip_size} bytes")
-                
-                # ファイルを読み込んでからクリーンアップ
-                with open(zip_path, 'rb') as f:
-                    content = f.read()
-
-                # クリーンアップ
-                shutil.rmtree(album_dir, ignore_errors=True)
-                os.remove(zip_path)
-
-                # バイナリレスポンスを返す
-                return Response(
-                    content=content,
+                        async for chunk in album_zip_stream(entries):
+                            yield chunk
+                    finally:
+                        # クリーンアップ
+                        workdir.release()
+
+                # 一時ZIPを作らずにそのままストリーミングで返す
+                return StreamingResponse(
+                    reservation.hold(stream_album()),
                     media_type='application/zip',
                     headers={
                         'Content-Disposition': f'attachment; filename="{safe_album_title}.zip"'
-                    }
+                    },
+                    background=BackgroundTask(reservation.release),
                 )
+            except BaseException:
+                await reservation.release()
+                raise
 
         else:
             logger.info("No playlist found in URL")
             return {"message": "No playlist found in URL"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
-    
-    
-async def cleanup_album_files(zip_path: str, album_dir: str):
-    """アルバムの一時ファイルをクリーンアップする"""
+
+
+@router.post("/sync-album")
+async def sync_album(request: AlbumSyncRequest, http_request: Request):
+    """プレイリストを前回の同期との差分だけ変換して返す
+
+    変わっていない曲はキャッシュから格納する。delta=true なら新しい曲だけのZIPを返す。
+    """
+    playlist_id = AudioExtractor.playlist_id(str(request.url))
+    if not playlist_id:
+        raise HTTPException(status_code=400, detail="No playlist found in URL")
+
+    set_work(BULK)
+    try:
+        reservation = await get_memory_governor().acquire(PLAYLIST)
+        try:
+            playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
+            extractor = await create_extractor(request.profile, playlist_url, http_request.headers.get("accept"))
+            playlist_info = await extractor.get_playlist_info(playlist_url)
+
+            store = get_manifest_store()
+            # キャッシュのインデックス（SQLite）を参照するのでスレッドで行う
+            plan = await asyncio.to_thread(plan_sync, extractor, playlist_id, playlist_info,
+                                           store.load(playlist_id, extractor.profile.name))
+            if plan.pending:
+                get_transcode_executor().check_admission()
+            logger.info(f"Sync plan for {playlist_id}: {len(plan.reused)} reused, {len(plan.pending)} to convert, "
+                        f"{len(plan.removed)} removed")
+
+            safe_album_title = safe_name(plan.title)
+            workdir = get_temp_space().workdir("sync")
+
+            async def stream_album():
+                try:
+                    entries = album_sync_entries(extractor, plan, safe_album_title, workdir.path,
+                                                 delta=request.delta, store=store)
+                    async for chunk in album_zip_stream(entries):
+                        yield chunk
+                finally:
+                    workdir.release()
+
+            suffix = "-delta" if request.delta else ""
+            return StreamingResponse(
+                reservation.hold(stream_album()),
+                media_type="application/zip",
+                headers={
+                    "Content-Disposition": content_disposition(f"{safe_album_title}{suffix}.zip"),
+                    "X-Sync-Reused": str(len(plan.reused)),
+                    "X-Sync-Pending": str(len(plan.pending)),
+                    "X-Sync-Removed": str(len(plan.removed)),
+                },
+                background=BackgroundTask(reservation.release),
+            )
+        except BaseException:
+            await reservation.release()
+            raise
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error syncing playlist: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/extract-batch")
+async def extract_batch(request: BatchExtractionRequest, http_request: Request):
+    """複数の動画をまとめて処理（ZIP、または1件終わるごとのNDJSONで返す）
+
+    同じ動画を指すURLは1回だけ処理し、結果の index にリクエスト内の位置をまとめて返す。
+    """
+    if request.format not in ("zip", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'zip' or 'ndjson'")
+    if not request.urls:
+        raise HTTPException(status_code=400, detail="urls must not be empty")
+    if len(request.urls) > config.BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"Too many urls (max {config.BATCH_MAX_URLS})")
+
+    set_work(BULK)
     try:
-        await cleanup_temp_file(zip_path)  # awaitを追加
-        import shutil
-        shutil.rmtree(album_dir)
+        reservation = await get_memory_governor().acquire(BATCH)
+        try:
+            extractor = await create_extractor(request.profile, request.urls[0],
+                                               http_request.headers.get("accept"))
+            items, errors = group_batch_urls(extractor, request.urls)
+            for item in items:
+                if not await extractor.get_cached(item.url):
+                    get_transcode_executor().check_admission()
+                    break
+            logger.info(f"Batch request: {len(request.urls)} urls, {len(items)} unique videos, {len(errors)} invalid")
+
+            if request.format == "ndjson":
+                async def stream_results():
+                    async for line in batch_ndjson_stream(extractor, request.urls, items, errors):
+                        if "cache_key" in line:
+                            cache_key = line.pop("cache_key")
+                            line["artifact_url"] = artifact_url(cache_key)
+                        yield ndjson_line(line)
+
+                return StreamingResponse(reservation.hold(stream_results()), media_type="application/x-ndjson",
+                                         background=BackgroundTask(reservation.release))
+
+            workdir = get_temp_space().workdir("batch")
+
+            async def stream_archive():
+                try:
+                    entries = batch_archive_entries(extractor, request.urls, items, errors, workdir.path)
+                    async for chunk in album_zip_stream(entries):
+                        yield chunk
+                finally:
+                    workdir.release()
+
+            return StreamingResponse(
+                reservation.hold(stream_archive()),
+                media_type="application/zip",
+                headers={"Content-Disposition": 'attachment; filename="batch.zip"'},
+                background=BackgroundTask(reservation.release),
+            )
+        except BaseException:
+            await reservation.release()
+            raise
+
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error during cleanup: {e}")
+        logger.error(f"Error processing batch request: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/info")
+async def bulk_info(request: InfoRequest):
+    """複数の動画の情報（タイトル・長さ・サムネイルなど）を取得できた順にNDJSONで返す
+
+    取得した情報は共有キャッシュに残るので、後の抽出では情報の取得を省ける。
+    """
+    if not request.urls:
+        raise HTTPException(status_code=400, detail="urls must not be empty")
+    if len(request.urls) > config.INFO_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"Too many urls (max {config.INFO_MAX_URLS})")
+
+    extractor = AudioExtractor()
+    items, errors = group_info_targets(extractor, request.urls)
+    logger.info(f"Info request: {len(request.urls)} urls, {len(items)} unique videos, {len(errors)} invalid")
+
+    async def stream_results():
+        async for line in info_ndjson_stream(extractor, request.urls, items, errors):
+            yield ndjson_line(line)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@router.post("/prefetch", status_code=202)
+async def prefetch(request: PrefetchRequest):
+    """次に使われそうな動画を先読みの待ち行列に入れる（空いている時間に変換して結果キャッシュへ入れる）"""
+    if not config.PREFETCH_ENABLED:
+        raise HTTPException(status_code=503, detail="Prefetch is disabled")
+    if not request.urls:
+        raise HTTPException(status_code=400, detail="urls must not be empty")
+    if len(request.urls) > config.PREFETCH_MAX_QUEUE:
+        raise HTTPException(status_code=400, detail=f"Too many urls (max {config.PREFETCH_MAX_QUEUE})")
+    if request.profile == AUTO_PROFILE:
+        raise HTTPException(status_code=400, detail="profile 'auto' cannot be prefetched")
+
+    extractor = AudioExtractor(profile=request.profile)
+    items, errors = group_info_targets(extractor, request.urls)
+    # 変換済みのものは待ち行列に入れない
+    pending = [item for item in items if not await extractor.get_cached(item.url)]
+    queued = get_prefetch_queue().enqueue([
+        PrefetchItem(item.video_id, extractor.profile.name, extractor.playlist_id(item.url)) for item in pending
+    ])
+    return {
+        "queued": queued,
+        "cached": len(items) - len(pending),
+        "invalid": sum(len(line["index"]) for line in errors),
+    }
+
+
+@router.get("/prefetch/status")
+async def prefetch_status():
+    """先読みの状態（待ち行列・実行中の動画・対話的な処理の有無）"""
+    return await get_prefetch_queue().status()
+
+
+@router.get("/transcode/status")
+async def transcode_status():
+    """変換キューの状態（同時実行数・待ち件数）"""
+    return get_transcode_executor().status()
+
+
+@router.get("/scheduler/status")
+async def scheduler_status():
+    """抽出の実行枠の状態（優先度ごとの実行数・クライアントごとの待ち件数）"""
+    return get_scheduler().status()
+
+
+@router.get("/memory/status")
+async def memory_status():
+    """メモリガバナーの状態（使用量・予約中の見積もり・最近の判断）"""
+    return await get_memory_governor().status()
@@ -0,0 +1,118 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, HttpUrl
+from services.job_store import TERMINAL_STATES, SUCCEEDED
+from services.jobs import SINGLE, get_job_runner
+from services.profiles import AUTO_PROFILE, DEFAULT_PROFILE, get_profile
+from services.scheduler import current_work
+from routes.audio import content_disposition
+from utils.file_serving import serve_file
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+router = APIRouter()
+
+# SSEで状態を確認する間隔（秒）
+EVENT_POLL_INTERVAL = 0.5
+
+
+class JobRequest(BaseModel):
+    url: HttpUrl
+    type: str = SINGLE  # single / playlist
+    profile: str = DEFAULT_PROFILE  # 出力プロファイル（/extract-audio と同じ）
+
+
+def _public_job(job: dict) -> dict:
+    """APIで返すジョブ情報"""
+    view = {
+        "job_id": job["id"],
+        "type": job["kind"],
+        "url": job["url"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "message": job["message"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+    if job["status"] == SUCCEEDED:
+        view["result_url"] = f"/api/v1/jobs/{job['id']}/result"
+    return view
+
+
+async def _get_job_or_404(job_id: str) -> dict:
+    # ジョブストアはワーカー間で共有するSQLiteなので、イベントループを止めないようスレッドで読む
+    job = await asyncio.to_thread(get_job_runner().store.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/jobs", status_code=202)
+async def create_job(request: JobRequest, http_request: Request):
+    # 実行時の順番待ちを依頼元のクライアントごとに公平にする
+    params = {"profile": request.profile, "client": current_work().client}
+    if request.profile == AUTO_PROFILE:
+        # auto はジョブ実行時にAcceptヘッダから選ぶ
+        params["accept"] = http_request.headers.get("accept")
+    else:
+        get_profile(request.profile)
+    job = get_job_runner().submit(request.type, str(request.url), params)
+    return _public_job(job)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return _public_job(await _get_job_or_404(job_id))
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """ジョブの進捗をServer-Sent Eventsで通知"""
+    await _get_job_or_404(job_id)
+    store = get_job_runner().store
+
+    async def events():
+        last = None
+        while True:
+            job = await asyncio.to_thread(store.get, job_id)
+            if job is None:
+                yield "event: error\ndata: {\"detail\": \"Job not found\"}\n\n"
+                return
+            view = _public_job(job)
+            snapshot = (view["status"], view["stage"], view["progress"], view["message"])
+            if snapshot != last:
+                last = snapshot
+                yield f"event: progress\ndata: {json.dumps(view, ensure_ascii=False)}\n\n"
+            if job["status"] in TERMINAL_STATES:
+                yield f"event: {job['status']}\ndata: {json.dumps(view, ensure_ascii=False)}\n\n"
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+@router.api_route("/jobs/{job_id}/result", methods=["GET", "HEAD"])
+async def get_job_result(job_id: str, request: Request):
+    """ジョブの成果物（Range・ETag対応）"""
+    job = await _get_job_or_404(job_id)
+    if job["status"] != SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"Job is not finished (status: {job['status']})")
+    if not job["result_path"] or not os.path.exists(job["result_path"]):
+        raise HTTPException(status_code=410, detail="Job result is no longer available")
+
+    try:
+        return serve_file(
+            request.headers, request.method, job["result_path"], job["etag"], job["media_type"],
+            headers={"content-disposition": content_disposition(job["filename"])},
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=410, detail="Job result is no longer available")
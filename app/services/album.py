@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from services.extractor import AudioExtractor
+from services.metrics import STAGE_SECONDS
+from utils.zip_stream import stream_zip, unique_archive_path
+
+logger = logging.getLogger(__name__)
+
+
+def safe_name(name: str) -> str:
+    """ファイル名に使える文字だけを残す"""
+    return "".join(c for c in str(name or '') if c.isalnum() or c in (' ', '-', '_')).rstrip()
+
+
+def playlist_video_urls(playlist_info: Dict) -> List[str]:
+    """プレイリストの各エントリを動画URLに変換"""
+    return [
+        f"https://www.youtube.com/watch?v={entry.get('id')}"
+        for entry in playlist_info.get('entries', [])
+        if entry.get('id')
+    ]
+
+
+async def album_archive_entries(extractor: AudioExtractor, video_urls: List[str], album_name: str,
+                                output_dir: str = None,
+                                on_track: Optional[Callable[[int, Optional[Dict]], None]] = None
+                                ) -> AsyncIterator[Tuple[str, str]]:
+    """曲が変換され次第（プレイリスト順で）ZIPへ追加する (ファイルパス, アーカイブ内パス) を返す"""
+    used_paths = set()
+    saved = 0
+    done = 0
+    async for result in extractor.iter_extract_many(video_urls, output_dir=output_dir):
+        done += 1
+        if on_track:
+            on_track(done, result)
+        if not result or not os.path.exists(result["file_path"]):
+            continue
+        # ファイル名を曲名に変更（拡張子は出力プロファイルのもの）
+        safe_title = safe_name(result.get("title"))
+        ext = os.path.splitext(result["file_path"])[1]
+        file_name = f"{safe_title}{ext}" if safe_title else os.path.basename(result["file_path"])
+        archive_path = unique_archive_path(os.path.join(album_name, file_name), used_paths)
+        saved += 1
+        yield result["file_path"], archive_path
+    logger.info(f"Saved {saved}/{len(video_urls)} files for album: {album_name}")
+
+
+async def album_zip_stream(entries: AsyncIterator[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    """アルバムのZIPを生成（曲の変換待ちと送信待ちを除いた書き込み時間を計測）"""
+    waiting = 0.0
+
+    async def timed_entries() -> AsyncIterator[Tuple[str, str]]:
+        nonlocal waiting
+        iterator = entries.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                entry = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                waiting += time.perf_counter() - started
+            yield entry
+
+    busy = 0.0
+    chunks = stream_zip(timed_entries())
+    while True:
+        started = time.perf_counter()
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            break
+        finally:
+            busy += time.perf_counter() - started
+        yield chunk
+    STAGE_SECONDS.labels('zip').observe(max(0.0, busy - waiting))
@@ -0,0 +1,126 @@
+import os
+import json
+import logging
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException
+
+import config
+from services.album import safe_name
+from services.extractor import AudioExtractor
+from utils.file_handler import cleanup_temp_file
+from utils.zip_stream import unique_archive_path
+
+logger = logging.getLogger(__name__)
+
+# ZIPに同梱する失敗一覧
+ERRORS_FILE = "errors.json"
+
+
+class BatchItem(NamedTuple):
+    """重複をまとめた処理単位（indices はリクエスト内の位置）"""
+    video_id: str
+    url: str
+    indices: List[int]
+
+
+def group_batch_urls(extractor: AudioExtractor, urls: List[str]) -> Tuple[List[BatchItem], List[Dict]]:
+    """URLを動画IDでまとめる（同じ動画を指すURLは1回だけ処理する）
+
+    動画IDを取り出せないURLは、処理せずにエラーとして返す。
+    """
+    items: Dict[str, BatchItem] = {}
+    errors = []
+    for index, url in enumerate(urls):
+        try:
+            video_id = extractor._extract_video_id(url)
+        except HTTPException as e:
+            errors.append({"index": [index], "url": url, "status": "error",
+                           "status_code": e.status_code, "error": e.detail})
+            continue
+        if video_id in items:
+            items[video_id].indices.append(index)
+        else:
+            items[video_id] = BatchItem(video_id, f"https://www.youtube.com/watch?v={video_id}", [index])
+    return list(items.values()), errors
+
+
+def error_line(item: BatchItem, urls: List[str], error: Exception) -> Dict:
+    status_code = error.status_code if isinstance(error, HTTPException) else 500
+    detail = error.detail if isinstance(error, HTTPException) else str(error)
+    return {"index": item.indices, "url": urls[item.indices[0]], "video_id": item.video_id,
+            "status": "error", "status_code": status_code, "error": detail}
+
+
+async def iter_batch(extractor: AudioExtractor, items: List[BatchItem], output_dir: str = None
+                     ) -> AsyncIterator[Tuple[BatchItem, Optional[Dict], Optional[Exception]]]:
+    """各動画を共有の上限（BATCH_CONCURRENCY）で並列に処理し、終わった順に返す"""
+    async for index, result, error in extractor.iter_extract_completed(
+            [item.url for item in items], output_dir=output_dir, concurrency=config.BATCH_CONCURRENCY):
+        yield items[index], result, error
+
+
+def ndjson_line(value: Dict) -> bytes:
+    return (json.dumps(value, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def batch_ndjson_stream(extractor: AudioExtractor, urls: List[str], items: List[BatchItem],
+                              errors: List[Dict]) -> AsyncIterator[Dict]:
+    """1件終わるごとに結果を返す（最後に集計を返す）
+
+    成功した結果は cache_key を含み、呼び出し側で取得用のURLに変換する。
+    """
+    failed = sum(len(line["index"]) for line in errors)
+    for line in errors:
+        yield line
+
+    async for item, result, error in iter_batch(extractor, items):
+        if error is None and not result.get("cache_key"):
+            # キャッシュに登録できなかった結果は後から取得できないので失敗扱い
+            await cleanup_temp_file(result["file_path"])
+            error = HTTPException(status_code=500, detail="Result could not be stored")
+        if error is not None:
+            failed += len(item.indices)
+            yield error_line(item, urls, error)
+            continue
+        yield {
+            "index": item.indices,
+            "url": urls[item.indices[0]],
+            "video_id": item.video_id,
+            "status": "ok",
+            "title": result.get("title"),
+            "filename": result["filename"],
+            "media_type": result.get("media_type", extractor.profile.media_type),
+            "size": os.path.getsize(result["file_path"]),
+            "etag": result.get("etag"),
+            "cache_key": result["cache_key"],
+        }
+
+    yield {"status": "done", "total": len(urls), "succeeded": len(urls) - failed, "failed": failed}
+
+
+async def batch_archive_entries(extractor: AudioExtractor, urls: List[str], items: List[BatchItem],
+                                errors: List[Dict], output_dir: str) -> AsyncIterator[Tuple[str, str]]:
+    """変換が終わった順にZIPへ追加する (ファイルパス, アーカイブ内パス) を返す
+
+    失敗した動画は最後に errors.json としてまとめて格納する。
+    """
+    errors = list(errors)
+    used_paths = {ERRORS_FILE}
+    async for item, result, error in iter_batch(extractor, items, output_dir=output_dir):
+        if error is None and not os.path.exists(result["file_path"]):
+            error = HTTPException(status_code=500, detail="Converted file is missing")
+        if error is not None:
+            errors.append(error_line(item, urls, error))
+            continue
+        safe_title = safe_name(result.get("title"))
+        ext = os.path.splitext(result["file_path"])[1]
+        file_name = f"{safe_title}{ext}" if safe_title else os.path.basename(result["file_path"])
+        yield result["file_path"], unique_archive_path(file_name, used_paths)
+
+    logger.info(f"Batch finished: {len(items)} videos, {len(errors)} errors")
+    if errors:
+        errors_path = os.path.join(output_dir, ERRORS_FILE)
+        with open(errors_path, "w", encoding="utf-8") as f:
+            json.dump(sorted(errors, key=lambda line: line["index"][0]), f, ensure_ascii=False, indent=2)
+        yield errors_path, ERRORS_FILE
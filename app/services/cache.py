@@ -0,0 +1,212 @@
+import os
+import shutil
+import sqlite3
+import hashlib
+import logging
+import time
+from typing import Dict, Optional
+
+import config
+from utils.file_serving import hash_file
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """変換済み音声のディスクキャッシュ（video_id + 出力プロファイルをキーとする）
+
+    アルバムのタグはURLのプレイリストで決まるため、list= 付きで変換したものはプレイリストIDもキーに含める。
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None, policy: str = None):
+        self.cache_dir = cache_dir or config.CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else config.CACHE_MAX_BYTES
+        self.policy = (policy or config.CACHE_EVICTION_POLICY).lower()
+        if self.policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown cache eviction policy: {self.policy}")
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.db_path = os.path.join(self.cache_dir, "index.db")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    video_id TEXT NOT NULL,
+                    codec TEXT NOT NULL,
+                    quality TEXT NOT NULL,
+                    tag_version INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    title TEXT,
+                    duration REAL,
+                    filename TEXT,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    etag TEXT
+                )
+                """
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(entries)")}
+            if "etag" not in columns:
+                # 以前のインデックスには etag 列が無い（値は参照時に計算する）
+                conn.execute("ALTER TABLE entries ADD COLUMN etag TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        # ワーカープロセス間で共有するため、呼び出しごとに接続する
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def make_key(video_id: str, codec: str, quality: str, tag_version: int,
+                 playlist_id: Optional[str] = None) -> str:
+        """キャッシュキーを生成"""
+        raw = f"{video_id}:{codec}:{quality}:{tag_version}"
+        if playlist_id:
+            raw += f":list={playlist_id}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    def get(self, video_id: str, codec: str, quality: str, tag_version: int,
+            playlist_id: Optional[str] = None) -> Optional[Dict]:
+        """キャッシュを参照（ヒット時はアクセス情報を更新）"""
+        return self.get_by_key(self.make_key(video_id, codec, quality, tag_version, playlist_id))
+
+    def get_by_key(self, key: str) -> Optional[Dict]:
+        """キャッシュキーで参照（ヒット時はアクセス情報を更新）"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            if not os.path.exists(row["path"]):
+                # ファイルが消えている場合はインデックスからも削除
+                logger.warning(f"Cache file missing, dropping entry: {row['path']}")
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+
+            conn.execute(
+                "UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?",
+                (time.time(), key),
+            )
+            return dict(row)
+
+    def put(self, video_id: str, codec: str, quality: str, tag_version: int,
+            src_path: str, meta: Dict, playlist_id: Optional[str] = None) -> Dict:
+        """変換済みファイルをキャッシュへ移動して登録
+
+        ファイル全体のハッシュを計算するので、イベントループからは asyncio.to_thread で呼ぶ。
+        """
+        key = self.make_key(video_id, codec, quality, tag_version, playlist_id)
+        dest_path = os.path.join(self.cache_dir, f"{key}.{codec}")
+        shutil.move(src_path, dest_path)
+
+        size = os.path.getsize(dest_path)
+        etag = hash_file(dest_path)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO entries
+                    (key, video_id, codec, quality, tag_version, path, size,
+                     title, duration, filename, created_at, last_access, hits, etag)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
+                """,
+                (key, video_id, codec, quality, tag_version, dest_path, size,
+                 meta.get("title"), meta.get("duration"), meta.get("filename"), now, now, etag),
+            )
+        logger.info(f"Stored in cache: {video_id} ({codec}/{quality}) -> {dest_path} ({size} bytes)")
+
+        self.evict(protect_key=key)
+        return self.get_by_key(key) or {}
+
+    def drop(self, key: str) -> None:
+        """エントリとファイルを削除（参照後に別のワーカーがファイルを消していた場合など）"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if row and os.path.exists(row["path"]):
+            os.remove(row["path"])
+
+    def etag(self, entry: Dict) -> str:
+        """エントリの内容ハッシュ（未計算なら計算して保存。計算する場合があるので asyncio.to_thread で呼ぶ）"""
+        if entry.get("etag"):
+            return entry["etag"]
+        etag = hash_file(entry["path"])
+        with self._connect() as conn:
+            conn.execute("UPDATE entries SET etag = ? WHERE key = ?", (etag, entry["key"]))
+        entry["etag"] = etag
+        return etag
+
+    def backfill_etags(self) -> int:
+        """etag の無い以前のエントリのハッシュを計算して保存（起動後にバックグラウンドで実行する）"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM entries WHERE etag IS NULL").fetchall()
+        filled = 0
+        for row in rows:
+            if os.path.exists(row["path"]):
+                self.etag(dict(row))
+                filled += 1
+        if filled:
+            logger.info(f"Computed ETags for {filled} cache entries")
+        return filled
+
+    def total_bytes(self) -> int:
+        """キャッシュの合計サイズ（バイト）"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def evict(self, protect_key: Optional[str] = None) -> int:
+        """容量上限を超えた分をLRU/LFUで削除"""
+        order = "last_access ASC" if self.policy == "lru" else "hits ASC, last_access ASC"
+        removed = 0
+        with self._connect() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+
+            rows = conn.execute(
+                f"SELECT key, path, size FROM entries WHERE key != ? ORDER BY {order}",
+                (protect_key or "",),
+            ).fetchall()
+            for row in rows:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    if os.path.exists(row["path"]):
+                        os.remove(row["path"])
+                except OSError as e:
+                    logger.error(f"Error deleting cache file {row['path']}: {e}")
+                    continue
+                conn.execute("DELETE FROM entries WHERE key = ?", (row["key"],))
+                total -= row["size"]
+                removed += 1
+
+        if removed:
+            logger.info(f"Evicted {removed} cache entries ({self.policy})")
+        return removed
+
+    def materialize(self, entry: Dict, output_dir: str) -> str:
+        """キャッシュファイルを出力ディレクトリへ配置（可能ならハードリンク）"""
+        os.makedirs(output_dir, exist_ok=True)
+        dest_path = os.path.join(output_dir, os.path.basename(entry["path"]))
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(entry["path"], dest_path)
+        except OSError:
+            shutil.copy2(entry["path"], dest_path)
+        return dest_path
+
+
+_result_cache: Optional[ResultCache] = None
+
+
+def get_result_cache() -> ResultCache:
+    """プロセス内で共有するキャッシュインスタンスを取得"""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
@@ -0,0 +1,20 @@
+import asyncio
+import logging
+from typing import Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# ネットワーク処理（ダウンロード）の上限。CPU処理（変換）は TranscodeExecutor で管理する
+_download_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def download_slot() -> asyncio.Semaphore:
+    """ダウンロード用の同時実行枠"""
+    global _download_semaphore
+    if _download_semaphore is None:
+        _download_semaphore = asyncio.Semaphore(config.DOWNLOAD_CONCURRENCY)
+        logger.info(f"Download concurrency: {config.DOWNLOAD_CONCURRENCY}")
+    return _download_semaphore
+
@@ -0,0 +1,344 @@
+import os
+import re
+import copy
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import config
+from services.metrics import DOWNLOAD_BYTES, DOWNLOAD_CONNECTIONS, DOWNLOAD_THROUGHPUT
+from utils.lazy_import import lazy_import
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+httpx = lazy_import("httpx")
+
+# yt-dlp形式の進捗フック（{'status': 'downloading', 'downloaded_bytes': ..., 'total_bytes': ...}）
+ProgressHook = Callable[[Dict], None]
+
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+# 範囲を分けて並列に取得できる形式（DASH/HLSなどの分割形式はyt-dlpに任せる）
+_RANGED_PROTOCOLS = ('http', 'https')
+
+
+class DownloadedSource(NamedTuple):
+    """ダウンロードした元ファイルと、yt-dlpがダウンロード用に選んだ形式
+
+    形式は情報取得時の選択（bestaudio）と違うことがあるので、コーデックの判定にはこちらを使う。
+    """
+    path: str
+    format: Dict
+
+
+class BandwidthShare:
+    """1つのダウンロードに割り当てられた帯域（rate は bytes/s、None は無制限）"""
+
+    def __init__(self, on_change: Callable[[Optional[float]], None] = None):
+        self.rate: Optional[float] = None
+        self.on_change = on_change
+        self._started = time.monotonic()
+        self._bytes = 0
+
+    def set_rate(self, rate: Optional[float]) -> None:
+        self.rate = rate
+        # 配分が変わったら計測をやり直す
+        self._started = time.monotonic()
+        self._bytes = 0
+        if self.on_change:
+            self.on_change(rate)
+
+    async def throttle(self, nbytes: int) -> None:
+        """受信したバイト数に応じて、割り当てを超えていれば待つ"""
+        if not self.rate:
+            return
+        self._bytes += nbytes
+        ahead = self._bytes / self.rate - (time.monotonic() - self._started)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+
+class BandwidthBudget:
+    """全ダウンロード（単曲・アルバム・一括）で共有する帯域の上限。実行中のダウンロードで均等に分ける"""
+
+    def __init__(self, limit: float = None):
+        self.limit = config.DOWNLOAD_BANDWIDTH_LIMIT if limit is None else limit
+        self._shares: List[BandwidthShare] = []
+
+    def open(self, on_change: Callable[[Optional[float]], None] = None) -> BandwidthShare:
+        share = BandwidthShare(on_change)
+        self._shares.append(share)
+        self._rebalance()
+        return share
+
+    def close(self, share: BandwidthShare) -> None:
+        if share in self._shares:
+            self._shares.remove(share)
+            self._rebalance()
+
+    def _rebalance(self) -> None:
+        rate = self.limit / len(self._shares) if self.limit and self._shares else None
+        for share in self._shares:
+            share.set_rate(rate)
+
+
+class HostConnectionLimiter:
+    """接続先ホストごとの同時接続数の上限
+
+    空きがあれば希望数まで、少なければ空いている分だけを割り当てる（1つも空いていなければ待つ）。
+    """
+
+    def __init__(self, per_host: int = None):
+        self.per_host = per_host or config.DOWNLOAD_HOST_CONNECTIONS
+        self._in_use: Dict[str, int] = {}
+        self._changed: Optional[asyncio.Condition] = None
+
+    def in_use(self, host: str) -> int:
+        return self._in_use.get(host, 0)
+
+    async def acquire(self, host: str, want: int) -> int:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_use(host) < self.per_host)
+            granted = min(want, self.per_host - self.in_use(host))
+            self._in_use[host] = self.in_use(host) + granted
+            return granted
+
+    async def release(self, host: str, count: int) -> None:
+        async with self._changed:
+            self._in_use[host] = self.in_use(host) - count
+            if not self._in_use[host]:
+                del self._in_use[host]
+            self._changed.notify_all()
+
+
+class DownloadEngine:
+    """元の音声ストリームのダウンロード
+
+    単一ファイルの形式は範囲（Range）に分けて複数の接続で並列に取得し、
+    DASH/HLSなどの分割形式はyt-dlpに任せて分割単位で並列に取得する。
+    どちらもホストごとの接続数の上限と、全体の帯域の上限を共有する。
+    """
+
+    def __init__(self, connections: int = None, chunk_size: int = None, hosts: HostConnectionLimiter = None,
+                 budget: BandwidthBudget = None, transport: Optional["httpx.AsyncBaseTransport"] = None):
+        self.connections = connections or config.DOWNLOAD_CONNECTIONS
+        self.chunk_size = chunk_size or config.DOWNLOAD_CHUNK_SIZE
+        self.hosts = hosts or HostConnectionLimiter()
+        self.budget = budget or BandwidthBudget()
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop = None
+
+    def _get_client(self) -> "httpx.AsyncClient":
+        # 接続プールはイベントループごとに持つ
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=config.DOWNLOAD_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=None,
+                                    max_keepalive_connections=self.hosts.per_host * 4),
+                transport=self._transport,
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @asynccontextmanager
+    async def _connections(self, url: str, want: int) -> AsyncIterator[int]:
+        host = urlparse(url).hostname or ''
+        granted = await self.hosts.acquire(host, want)
+        DOWNLOAD_CONNECTIONS.inc(granted)
+        try:
+            yield granted
+        finally:
+            DOWNLOAD_CONNECTIONS.dec(granted)
+            await self.hosts.release(host, granted)
+
+    async def download(self, ydl: "yt_dlp.YoutubeDL", info: Dict,
+                       progress_hook: ProgressHook = None) -> DownloadedSource:
+        """解決済みの動画情報から元ファイルをダウンロードし、保存先のパスと選ばれた形式を返す
+
+        ydl は保存先（paths / outtmpl）とフォーマット指定を設定済みのものを渡す。
+        """
+        # フォーマットの選択だけを先に行い、取得方法を決める
+        selected = await asyncio.to_thread(ydl.process_ie_result, copy.deepcopy(info), False)
+        started = time.monotonic()
+        if self._can_fetch_ranges(selected):
+            engine = 'ranged'
+            path = ydl.prepare_filename(selected)
+            size = await self._fetch_ranges(selected['url'], selected.get('http_headers') or {}, path,
+                                            progress_hook)
+        else:
+            engine = 'ytdlp'
+            path = await self._download_with_ytdlp(ydl, info, selected)
+            size = os.path.getsize(path)
+
+        elapsed = time.monotonic() - started
+        DOWNLOAD_BYTES.labels(engine).inc(size)
+        if elapsed > 0:
+            DOWNLOAD_THROUGHPUT.labels(engine).observe(size / elapsed)
+        logger.info(f"Downloaded {size} bytes in {elapsed:.1f}s via {engine}: {path}")
+        return DownloadedSource(path, selected)
+
+    def _can_fetch_ranges(self, selected: Dict) -> bool:
+        return (
+            self.connections > 1
+            and selected.get('protocol') in _RANGED_PROTOCOLS
+            and bool(selected.get('url'))
+            and not selected.get('requested_formats')
+            and not selected.get('cookies')  # Cookieが必要な形式はyt-dlpに任せる
+        )
+
+    async def _download_with_ytdlp(self, ydl: "yt_dlp.YoutubeDL", info: Dict, selected: Dict) -> str:
+        """yt-dlpでダウンロード（分割形式は割り当てられた接続数で並列に取得）"""
+        protocol = selected.get('protocol') or ''
+        fragmented = 'm3u8' in protocol or 'dash' in protocol
+        async with self._connections(selected.get('url') or '', self.connections if fragmented else 1) as granted:
+            saved = {name: ydl.params.get(name) for name in ('concurrent_fragment_downloads', 'ratelimit')}
+
+            def apply_rate(rate: Optional[float]) -> None:
+                # yt-dlpの速度制限は接続（分割）ごとなので、割り当てを接続数で割る
+                ydl.params['ratelimit'] = int(rate / granted) if rate else None
+
+            share = self.budget.open(apply_rate)
+            ydl.params['concurrent_fragment_downloads'] = granted
+            try:
+                result = await asyncio.to_thread(ydl.process_ie_result, copy.deepcopy(info), True)
+            finally:
+                self.budget.close(share)
+                ydl.params.update(saved)
+
+        downloads = result.get('requested_downloads') or [{}]
+        source_file = downloads[0].get('filepath') or result.get('filepath')
+        if not source_file or not os.path.exists(source_file):
+            raise Exception(f"Downloaded source not found for {info['id']}")
+        return source_file
+
+    async def _fetch_ranges(self, url: str, headers: Dict[str, str], path: str,
+                            progress_hook: ProgressHook = None) -> int:
+        """ファイルを範囲に分けて並列に取得（サーバがRangeに対応していなければ1本で取得）"""
+        client = self._get_client()
+        part_path = f"{path}.part"
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        received = 0
+        total: Optional[int] = None
+
+        def report(nbytes: int) -> None:
+            nonlocal received
+            received += nbytes
+            if progress_hook:
+                progress_hook({'status': 'downloading', 'downloaded_bytes': received, 'total_bytes': total})
+
+        try:
+            async with self._connections(url, self.connections) as granted:
+                share = self.budget.open()
+                try:
+                    # 最初の範囲の応答から全体のサイズを知る
+                    total, ranged = await self._fetch_first(client, url, headers, fd, share, report)
+                    offsets = list(range(self.chunk_size, total, self.chunk_size)) if ranged else []
+                    if offsets:
+                        # 1つの範囲が失敗したら他の接続も止め、終わるのを待ってからファイルを閉じる
+                        # （閉じた後に書き込むと、番号を再利用した別のファイルを壊す）
+                        try:
+                            async with asyncio.TaskGroup() as workers:
+                                for _ in range(min(granted, len(offsets))):
+                                    workers.create_task(self._fetch_worker(
+                                        client, url, headers, fd, offsets, total, share, report))
+                        except BaseExceptionGroup as group:
+                            raise group.exceptions[0]
+                finally:
+                    self.budget.close(share)
+        except BaseException:
+            os.close(fd)
+            os.remove(part_path)
+            raise
+        os.close(fd)
+
+        if received != total:
+            os.remove(part_path)
+            raise Exception(f"Incomplete download: {received}/{total} bytes")
+        os.replace(part_path, path)
+        if progress_hook:
+            progress_hook({'status': 'finished', 'downloaded_bytes': received, 'total_bytes': total})
+        return total
+
+    async def _fetch_first(self, client: "httpx.AsyncClient", url: str, headers: Dict[str, str], fd: int,
+                           share: BandwidthShare, report: Callable[[int], None]) -> Tuple[int, bool]:
+        """先頭の範囲を取得し、(全体のサイズ, 残りを範囲で取得できるか) を返す"""
+        request_headers = {**headers, 'Range': f'bytes=0-{self.chunk_size - 1}'}
+        async with client.stream('GET', url, headers=request_headers) as response:
+            response.raise_for_status()
+            match = _CONTENT_RANGE_RE.match(response.headers.get('content-range', ''))
+            ranged = response.status_code == 206 and match is not None
+            # Range非対応なら全体が返ってくるので、そのまま書き込んで終わる
+            written = await self._write_body(response, fd, 0, share, report)
+        return (int(match.group(3)) if ranged else written), ranged
+
+    async def _fetch_worker(self, client: "httpx.AsyncClient", url: str, headers: Dict[str, str], fd: int,
+                            offsets: List[int], total: int, share: BandwidthShare,
+                            report: Callable[[int], None]) -> None:
+        """残りの範囲を順に取り出して取得（接続ごとに1つ動かす）"""
+        while offsets:
+            start = offsets.pop(0)
+            end = min(start + self.chunk_size, total) - 1
+            for attempt in range(config.DOWNLOAD_CHUNK_RETRIES):
+                # 失敗した範囲は先頭から取り直す（進捗は書き込んだ分だけ戻す）
+                written = 0
+
+                def count(nbytes: int) -> None:
+                    nonlocal written
+                    written += nbytes
+                    report(nbytes)
+
+                try:
+                    async with client.stream('GET', url, headers={**headers, 'Range': f'bytes={start}-{end}'}) as response:
+                        if response.status_code != 206:
+                            raise Exception(f"Range request returned {response.status_code}")
+                        await self._write_body(response, fd, start, share, count)
+                    if written != end - start + 1:
+                        raise Exception(f"Short range response: {written}/{end - start + 1} bytes")
+                    break
+                except Exception as e:
+                    report(-written)
+                    if attempt == config.DOWNLOAD_CHUNK_RETRIES - 1:
+                        raise
+                    logger.warning(f"Retrying range {start}-{end} ({attempt + 1}): {str(e)}")
+                    await asyncio.sleep(0.5 * (attempt + 1))
+
+    @staticmethod
+    async def _write_body(response: "httpx.Response", fd: int, offset: int, share: BandwidthShare,
+                          report: Callable[[int], None]) -> int:
+        position = offset
+        async for data in response.aiter_bytes():
+            os.pwrite(fd, data, position)
+            position += len(data)
+            report(len(data))
+            await share.throttle(len(data))
+        return position - offset
+
+
+_download_engine: Optional[DownloadEngine] = None
+
+
+def get_download_engine() -> DownloadEngine:
+    """プロセス内で共有するダウンロードエンジンを取得"""
+    global _download_engine
+    if _download_engine is None:
+        _download_engine = DownloadEngine()
+        logger.info(f"Download engine: {_download_engine.connections} connections/download, "
+                    f"{_download_engine.hosts.per_host} connections/host, "
+                    f"bandwidth limit {_download_engine.budget.limit or 'none'}")
+    return _download_engine
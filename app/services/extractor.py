@@ -1,30 +1,64 @@
-import yt_dlp
 import os
+import shutil
 import asyncio
 import logging
-from typing import Dict
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, List, Optional, Tuple
 from fastapi import HTTPException
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, APIC, error
-import requests
-from PIL import Image
+import base64
 import io
+from urllib.parse import urlparse, parse_qs
+import config
+from utils.file_handler import cleanup_temp_file
+from utils.lazy_import import lazy_import
+from services.cache import ResultCache, get_result_cache
+from services.info_cache import get_info_cache
+from services.singleflight import get_single_flight
+from services.concurrency import download_slot
+from services.download_engine import DownloadedSource, get_download_engine
+from services.transcode_executor import get_transcode_executor
+from services.temp_space import get_temp_space
+from services.metrics import CACHE_REQUESTS, IN_FLIGHT, stage_timer
+from services.prefetch import get_prefetch_queue
+from services.retry import get_upstream_breaker, run_stage
+from services.scheduler import BACKGROUND, get_scheduler, set_work
+from services.transcoder import audio_file_args, mp3_stream_args, run_ffmpeg, stream_ffmpeg
+from services.profiles import (
+    AUTO_PROFILE, DEFAULT_PROFILE, PROFILES, OutputProfile, accepted_profiles, can_passthrough,
+    choose_auto_profile, get_profile, source_codec,
+)
+from services.thumbnail import center_crop_square, get_thumbnail_fetcher
+from services.ydl_pool import get_ydl_pool
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 logger = logging.getLogger(__name__)
 
+# 起動を速くするため、重いモジュールは使うときに読み込む
+yt_dlp = lazy_import("yt_dlp")
+id3 = lazy_import("mutagen.id3")
+flac = lazy_import("mutagen.flac")
+oggopus = lazy_import("mutagen.oggopus")
+
+# タグ付け処理を変更したら上げる（古いキャッシュを無効化するため）
+TAG_VERSION = 3
+
+# 進捗通知 (stage, percent) — percent が不明な段階では None
+ProgressCallback = Callable[[str, Optional[float]], None]
+
 class AudioExtractor:
-    def __init__(self):
-        self.temp_dir = "temp"
+    def __init__(self, profile: str = DEFAULT_PROFILE):
+        self.profile: OutputProfile = get_profile(profile)
+        self.temp_dir = config.TEMP_DIR
         os.makedirs(self.temp_dir, exist_ok=True)
+        self.temp_space = get_temp_space()
+        self.cache = get_result_cache()
+        self.info_cache = get_info_cache()  # ワーカー間で共有
         
         self.ydl_opts = {
             'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '320',
-            }],
-            'writethumbnail': True,
+            # 変換・タグ付けは _convert_audio でFFmpegを直接実行する
+            'writethumbnail': False,  # カバー画像はThumbnailFetcherで取得する
             'outtmpl': f'{self.temp_dir}/%(id)s.%(ext)s',
             'quiet': True,
             'no_warnings': True,
@@ -34,6 +68,30 @@ class AudioExtractor:
 
     
 
+    def _video_opts(self) -> Dict:
+        """単一動画の情報取得用のオプション"""
+        return {**self.ydl_opts, 'extract_flat': False, 'noplaylist': True}
+
+    def _playlist_opts(self) -> Dict:
+        """プレイリスト情報のみを取得するオプション"""
+        return {**self.ydl_opts, 'extract_flat': True, 'noplaylist': False}
+
+    def _download_opts(self) -> Dict:
+        """元の音声ストリームのダウンロード用のオプション（保存先は paths で指定）"""
+        return {
+            **self.ydl_opts,
+            # 出力ファイルと同じ名前にならないよう、元ファイルには .src を付ける
+            'outtmpl': '%(id)s.src.%(ext)s',
+            'format': self.profile.format,
+            'verbose': True,  # 詳細なログを有効化
+        }
+
+    def warm_ydl_pool(self) -> None:
+        """よく使うオプションのYoutubeDLを作っておく（初回リクエストの初期化を省く）"""
+        pool = get_ydl_pool()
+        for opts in (self._video_opts(), self._playlist_opts(), self._download_opts()):
+            pool.warm(opts)
+
     async def _get_video_info(self, url: str) -> Dict:
         """動画の情報を取得"""
         try:
@@ -41,62 +99,22 @@ class AudioExtractor:
             video_id = self._extract_video_id(url)
             logger.info(f"Extracted video ID from URL: {video_id}")
 
-            # プレイリスト情報用の設定
-            playlist_opts = {
-                **self.ydl_opts,
-                'extract_flat': True,
-                'noplaylist': False,
-            }
+            # プレイリスト情報はURLに list= がある場合のみ取得
+            playlist_id = self.playlist_id(url)
+            playlist_data = await self._get_playlist_data(url, playlist_id) if playlist_id else None
+            if playlist_data:
+                # 続きの曲も使われることが多いので先読みする
+                playlist_video_ids = await self.info_cache.get(('playlist_entries', playlist_id)) or []
+                get_prefetch_queue().enqueue_following(video_id, playlist_video_ids, self.profile.name, playlist_id)
 
-            # 単一動画情報用の設定
-            video_opts = {
-                **self.ydl_opts,
-                'extract_flat': False,
-                'noplaylist': True,
-            }
+            video_info = await self._cached_video_info(video_id)
 
-            with yt_dlp.YoutubeDL(playlist_opts) as ydl:
-                try:
-                    # プレイリスト情報の取得を試みる
-                    playlist_info = await asyncio.to_thread(ydl.extract_info, url, download=False)
-                    
-                    # プレイリスト情報の保存
-                    playlist_data = None
-                    if playlist_info.get('_type') == 'playlist':
-                        playlist_data = {
-                            'playlist_title': playlist_info.get('title'),
-                            'playlist_id': playlist_info.get('id'),
-                        }
-                        logger.info(f"Found playlist info: {playlist_data}")
-                        logger.info("===================================")
-                        logger.info(playlist_info)
-                        
-                        logger.info("===================================")
-                        
-                        
-                    
-                    
-                    # 単一動画の情報を取得
-                    with yt_dlp.YoutubeDL(video_opts) as video_ydl:
-                        video_url = f"https://www.youtube.com/watch?v={video_id}"
-                        video_info = await asyncio.to_thread(video_ydl.extract_info, video_url, download=False)
-
-                        if not video_info or 'id' not in video_info:
-                            raise HTTPException(status_code=400, detail="Video not found")
-
-                        # プレイリスト情報があれば追加
-                        if playlist_data:
-                            video_info.update(playlist_data)
-
-                        logger.info(f"Successfully retrieved video info - Title: {video_info.get('title')}, ID: {video_info.get('id')}")
-                        return video_info
-
-                except yt_dlp.utils.ExtractorError as e:
-                    logger.error(f"Extractor error: {str(e)}")
-                    raise HTTPException(status_code=400, detail=f"Could not extract video info: {str(e)}")
-                except yt_dlp.utils.DownloadError as e:
-                    logger.error(f"Download error: {str(e)}")
-                    raise HTTPException(status_code=400, detail=f"Video not available: {str(e)}")
+            # プレイリスト情報があれば追加（キャッシュ本体は書き換えない）
+            if playlist_data:
+                video_info = {**video_info, **playlist_data}
+
+            logger.info(f"Successfully retrieved video info - Title: {video_info.get('title')}, ID: {video_info.get('id')}")
+            return video_info
 
         except HTTPException:
             raise
@@ -104,257 +122,591 @@ class AudioExtractor:
             logger.error(f"Unexpected error: {str(e)}")
             raise HTTPException(status_code=400, detail="Could not process video URL")
 
-    def center_crop_square(self, img: Image.Image) -> Image.Image:
+    async def _cached_video_info(self, video_id: str) -> Dict:
+        """動画情報をキャッシュから取得（無ければ解決して登録）"""
+        cached = await self.info_cache.get(video_id)
+        if cached:
+            logger.info(f"Metadata cache hit: {video_id}")
+            return cached
+        video_info = await self._resolve_video_info(video_id)
+        await self.info_cache.set(video_id, video_info)
+        return video_info
+
+    async def _resolve_video_info(self, video_id: str) -> Dict:
+        """単一動画の情報を解決（フォーマット選択済みの情報をダウンロードにも使う）"""
+        try:
+            async with get_ydl_pool().acheckout(self._video_opts()) as video_ydl:
+                video_url = f"https://www.youtube.com/watch?v={video_id}"
+                video_info = await asyncio.to_thread(video_ydl.extract_info, video_url, download=False)
+        except yt_dlp.utils.ExtractorError as e:
+            logger.error(f"Extractor error: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Could not extract video info: {str(e)}")
+        except yt_dlp.utils.DownloadError as e:
+            logger.error(f"Download error: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Video not available: {str(e)}")
+
+        if not video_info or 'id' not in video_info:
+            raise HTTPException(status_code=400, detail="Video not found")
+        return video_info
+
+    async def _get_playlist_data(self, url: str, playlist_id: str) -> Optional[Dict]:
+        """URLに含まれるプレイリストのタイトルとIDを取得"""
+        cache_key = ('playlist', playlist_id)
+        cached = await self.info_cache.get(cache_key)
+        if cached is not None:
+            return cached or None
+
+        try:
+            async with get_ydl_pool().acheckout(self._playlist_opts()) as ydl:
+                playlist_info = await asyncio.to_thread(ydl.extract_info, url, download=False)
+        except (yt_dlp.utils.ExtractorError, yt_dlp.utils.DownloadError) as e:
+            # プレイリストが取れなくても動画自体は処理できる
+            logger.warning(f"Could not get playlist info for {playlist_id}: {str(e)}")
+            return None
+
+        playlist_data = {}
+        if playlist_info and playlist_info.get('_type') == 'playlist':
+            playlist_data = {
+                'playlist_title': playlist_info.get('title'),
+                'playlist_id': playlist_info.get('id'),
+            }
+            logger.info(f"Found playlist info: {playlist_data}")
+            video_ids = [entry.get('id') for entry in playlist_info.get('entries') or [] if entry and entry.get('id')]
+            await self.info_cache.set(('playlist_entries', playlist_id), video_ids)
+
+        await self.info_cache.set(cache_key, playlist_data)
+        return playlist_data or None
+
+    def center_crop_square(self, img: "Image.Image") -> "Image.Image":
         """画像を中央から正方形にクロップ"""
-        width, height = img.size
-        if width == height:
-            return img
-        
-        new_size = min(width, height)
-        # 中央を基準にクロップする位置を計算
-        left = (width - new_size) // 2
-        top = (height - new_size) // 2
-        right = left + new_size
-        bottom = top + new_size
+        return center_crop_square(img)
         
-        # クロップを実行
-        logger.info(f"Cropping image from {width}x{height} to {new_size}x{new_size}")
-        return img.crop((left, top, right, bottom))
         
-        
-    async def cleanup_old_files(self, keep_latest: int = 5):
-        """最新のN個以外の一時ファイルを削除"""
+    async def extract(self, url: str, output_dir: str = None,
+                      progress: Optional[ProgressCallback] = None) -> Dict:
+        """音声を抽出してタグを設定"""
+        video_id = self._extract_video_id(url)
+        playlist_id = self.playlist_id(url)
+
+        # キャッシュにあれば変換せずに返す
+        cached = await self._lookup_cache(video_id, output_dir, playlist_id)
+        CACHE_REQUESTS.labels('hit' if cached else 'miss').inc()
+        if cached:
+            return cached
+
+        # 同じ動画・同じプロファイルの処理は1つにまとめ、他の呼び出しは結果を待つ
+        # アルバムのタグが違うので、プレイリストの文脈が異なる呼び出しはまとめない
+        key = ResultCache.make_key(video_id, self.profile.ext, self.profile.quality, TAG_VERSION, playlist_id)
+        with get_prefetch_queue().foreground():
+            result = await get_single_flight().do(key, lambda: self._run_pipeline(url, video_id, progress))
+
+        if output_dir:
+            file_path = await asyncio.to_thread(self.cache.materialize, {"path": result["file_path"]}, output_dir)
+            result = {**result, "file_path": file_path}
+        return result
+
+    async def extract_stream(self, url: str) -> Tuple[Dict, AsyncIterator[bytes]]:
+        """変換しながら少しずつ返すストリーミング抽出（MP3プロファイルのみ）
+
+        ID3v2ヘッダ（タグ + カバー画像）を先に送り、その後にFFmpegの出力を順次送る。
+        送出したバイト列は一時ファイルにも書き出し、完了後に結果キャッシュへ登録する。
+        """
+        video_id = self._extract_video_id(url)
+        CACHE_REQUESTS.labels('miss').inc()
+        breaker = get_upstream_breaker()
+
+        async def fetch_info(attempt: int) -> Dict:
+            with stage_timer('metadata'):
+                return await self._get_video_info(url)
+
+        # 同時ストリームと衝突しないよう専用のディレクトリにダウンロード（送信が終わるまで保持）
+        workdir = self.temp_space.workdir(f"stream-{video_id}")
+        work_dir = workdir.path
         try:
-            files = []
-            for f in os.listdir(self.temp_dir):
-                path = os.path.join(self.temp_dir, f)
-                if os.path.isfile(path):
-                    files.append((path, os.path.getmtime(path)))
-            
-            # 更新時刻で並べ替え
-            files.sort(key=lambda x: x[1], reverse=True)
-            
-            # 古いファイルを削除
-            for file_path, _ in files[keep_latest:]:
+            # 実行枠はダウンロードまで（変換は送信に合わせて進むので TranscodeExecutor の枠だけを使う）
+            with get_prefetch_queue().foreground():
+                async with get_scheduler().slot():
+                    info = await run_stage('metadata', fetch_info, breaker=breaker)
+                    source = await run_stage(
+                        'download', lambda attempt: self._download_source(info, work_dir=work_dir), breaker=breaker)
+                    source_file = source.path
+                    header = await self._build_id3_header(info)
+        except BaseException:
+            workdir.release()
+            raise
+
+        safe_title = "".join(c for c in info['title'] if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        meta = {
+            "video_id": info['id'],
+            "title": info['title'],
+            "duration": info.get('duration'),
+            "filename": f"{safe_title}.mp3",
+            "media_type": self.profile.media_type,
+        }
+
+        async def body() -> AsyncIterator[bytes]:
+            output_file = os.path.join(work_dir, f"{video_id}.mp3")
+            completed = False
+            try:
+                async with get_transcode_executor().slot():
+                    with IN_FLIGHT.labels('stream').track_inprogress(), get_prefetch_queue().foreground():
+                        with open(output_file, 'wb') as out:
+                            out.write(header)
+                            yield header
+                            args = mp3_stream_args(source_file, self.profile.quality)
+                            async for chunk in stream_ffmpeg(args):
+                                out.write(chunk)
+                                yield chunk
+                completed = True
+                logger.info(f"Finished streaming: {video_id}")
+            except Exception as e:
+                logger.error(f"Error while streaming {video_id}: {str(e)}")
+                raise
+            finally:
+                if completed:
+                    try:
+                        await asyncio.to_thread(self.cache.put, info['id'], self.profile.ext, self.profile.quality,
+                                                TAG_VERSION, output_file, meta, self.playlist_id(url))
+                    except Exception as e:
+                        logger.error(f"Error storing streamed result in cache: {str(e)}")
+                workdir.release()
+
+        return meta, body()
+
+    async def _run_pipeline(self, url: str, video_id: str,
+                            progress: Optional[ProgressCallback] = None) -> Dict:
+        """ダウンロードから変換・タグ付け・キャッシュ登録までを実行
+
+        各段階の結果（動画情報・元ファイル・変換済みファイル）は作業ディレクトリに残し、
+        失敗した段階だけを再試行する（run_stage を参照）。
+        """
+        def report(stage: str, percent: Optional[float] = None) -> None:
+            if progress:
+                progress(stage, percent)
+
+        # 別ワーカーが処理を終えていればキャッシュから返す
+        playlist_id = self.playlist_id(url)
+        cached = await self._lookup_cache(video_id, playlist_id=playlist_id)
+        if cached:
+            return cached
+
+        # 優先度・クライアントごとの順番待ち（1曲ずつ。アルバムなども曲単位で他のリクエストと交互に処理する）
+        async with get_scheduler().slot():
+            # 専用の作業ディレクトリを使い、終了時に中間ファイルごと削除する
+            workdir = self.temp_space.workdir(video_id)
+            try:
+                async def fetch_info(attempt: int) -> Dict:
+                    report('metadata', None)
+                    with stage_timer('metadata'):
+                        return await self._get_video_info(url)
+
+                info = await run_stage('metadata', fetch_info, breaker=get_upstream_breaker())
+
+                with IN_FLIGHT.labels('extract').track_inprogress():
+                    output_file = await self._download_and_convert(info, report, work_dir=workdir.path)
+
+                # タグとカバー画像は変換時に書き込み済み
+                safe_title = "".join(c for c in info['title'] if c.isalnum() or c in (' ', '-', '_')).rstrip()
+
+                result = {
+                    "video_id": info['id'],
+                    "title": info['title'],
+                    "duration": info.get('duration'),
+                    "file_path": output_file,
+                    "filename": f"{safe_title}.{self.profile.ext}",
+                    "media_type": self.profile.media_type,
+                    "cached": False,
+                }
+
+                # 変換結果をキャッシュへ登録
                 try:
-                    os.remove(file_path)
-                    logger.info(f"Cleaned up old file: {file_path}")
+                    # ハッシュの計算でイベントループを止めない
+                    entry = await asyncio.to_thread(
+                        self.cache.put, info['id'], self.profile.ext, self.profile.quality, TAG_VERSION,
+                        output_file, result, playlist_id
+                    )
+                    result["file_path"] = entry["path"]
+                    result["cache_key"] = entry["key"]
+                    result["etag"] = entry["etag"]
                 except Exception as e:
-                    logger.error(f"Error deleting file {file_path}: {e}")
-                    
-            return len(files[keep_latest:])  # 削除したファイル数を返す
-        except Exception as e:
-            logger.error(f"Error during cleanup: {e}")
-            return 0
-
+                    logger.error(f"Error storing result in cache: {str(e)}")
+                    # 作業ディレクトリの削除後も送信できるよう退避（送信後に呼び出し側が削除）
+                    result["file_path"] = workdir.detach(output_file)
 
+                return result
+            finally:
+                workdir.release()
 
-    async def extract(self, url: str, output_dir: str = None) -> Dict:
-        """音声を抽出してタグを設定"""
-        retry_count = 3  # リトライ回数を設定
-        retry_delay = 2  # リトライ間の待機時間（秒）
+    async def prefetch(self, video_id: str, playlist_id: Optional[str] = None) -> bool:
+        """先読み: 結果キャッシュに無ければ変換して登録する（変換した場合は True）
 
-        for attempt in range(retry_count):
+        後で来るリクエストと同じキャッシュキーになるよう、プレイリストの文脈（list=）も付けて変換する。
+        対話的な抽出に割り込まれたら中止できるよう、SingleFlight を通さずに実行する。
+        """
+        if await self._lookup_cache(video_id, playlist_id=playlist_id):
+            return False
+        set_work(BACKGROUND, "prefetch")
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        if playlist_id:
+            url += f"&list={playlist_id}"
+        result = await self._run_pipeline(url, video_id)
+        if not result.get("cache_key"):
+            # キャッシュに登録できなかった結果は使われないので削除
+            await cleanup_temp_file(result["file_path"])
+        return not result.get("cached", False)
+
+    async def get_cached(self, url: str) -> Optional[Dict]:
+        """変換済みキャッシュがあれば結果を返す（無ければ None）"""
+        return await self._lookup_cache(self._extract_video_id(url), playlist_id=self.playlist_id(url))
+
+    async def select_auto_profile(self, url: str, accepted: List[str]) -> OutputProfile:
+        """auto 指定時のプロファイルを決める（キャッシュ済みのものを優先し、次にパススルー可能なもの）"""
+        try:
+            video_id = self._extract_video_id(url)
+        except HTTPException:
+            # 動画IDを含まないURL（プレイリストなど）は最も優先度の高い候補を使う
+            self.profile = PROFILES[accepted[0]]
+            return self.profile
+
+        for name in accepted:
+            profile = PROFILES[name]
+            if await asyncio.to_thread(self.cache.get, video_id, profile.ext, profile.quality, TAG_VERSION,
+                                       self.playlist_id(url)):
+                self.profile = profile
+                return self.profile
+
+        if len(accepted) == 1:
+            self.profile = PROFILES[accepted[0]]
+        else:
+            self.profile = choose_auto_profile(accepted, await self._get_video_info(url))
+        return self.profile
+
+    async def _lookup_cache(self, video_id: str, output_dir: str = None,
+                            playlist_id: Optional[str] = None) -> Optional[Dict]:
+        """変換済みキャッシュを参照（playlist_id は list= 付きで変換したもの）
+
+        インデックスはワーカー間で共有するSQLiteで、ヒット時に更新も行うためスレッドで参照する。
+        """
+        entry = await asyncio.to_thread(
+            self.cache.get, video_id, self.profile.ext, self.profile.quality, TAG_VERSION, playlist_id)
+        if not entry:
+            logger.info(f"Cache miss: {video_id}")
+            return None
+
+        logger.info(f"Cache hit: {video_id} -> {entry['path']}")
+        file_path = entry["path"]
+        if output_dir:
             try:
-                info = await self._get_video_info(url)
-                if not info:
-                    raise HTTPException(status_code=400, detail="Could not get video information")
+                file_path = await asyncio.to_thread(self.cache.materialize, entry, output_dir)
+            except FileNotFoundError:
+                # 参照直後に別のワーカーが削除した場合は、キャッシュに無いものとして変換し直す
+                logger.warning(f"Cache file vanished, treating as miss: {entry['path']}")
+                await asyncio.to_thread(self.cache.drop, entry["key"])
+                return None
+
+        return {
+            "video_id": entry["video_id"],
+            "title": entry["title"],
+            "duration": entry["duration"],
+            "file_path": file_path,
+            "filename": entry["filename"],
+            "media_type": self.profile.media_type,
+            "cached": True,
+            "cache_key": entry["key"],
+            # 以前のエントリで未計算なら None（起動後に ResultCache.backfill_etags が埋める）
+            "etag": entry.get("etag"),
+        }
 
-                # 保存先ディレクトリを設定
-                original_temp_dir = self.temp_dir
-                if output_dir:
-                    self.temp_dir = output_dir
-                    logger.info(f"Using custom output directory: {output_dir}")
+    async def _fetch_cover_image(self, info: Dict) -> Optional[bytes]:
+        """カバー画像を取得し、正方形のJPEGにして返す"""
+        return await get_thumbnail_fetcher().get_cover(info)
+
+    @staticmethod
+    def _tag_values(info: Dict) -> Dict[str, str]:
+        """タグに書き込む値（タイトル・アーティスト・アルバム・年）"""
+        return {
+            'title': info.get('title', ''),
+            'artist': info.get('uploader', ''),
+            'album': info.get('playlist_title', '') or info.get('album', 'YouTube Music'),
+            'date': (info.get('upload_date') or '')[:4],
+        }
 
-                try:
-                    output_file = await self._download_and_convert(url, info['id'])
-                    
-                    # ファイルの存在確認
-                    if not os.path.exists(output_file):
-                        raise Exception(f"File was not saved properly: {output_file}")
-                    
-                    # ファイルサイズの確認
-                    file_size = os.path.getsize(output_file)
-                    if file_size == 0:
-                        raise Exception(f"File is empty: {output_file}")
-
-                    await self._set_media_tags(output_file, info)
-                    safe_title = "".join(c for c in info['title'] if c.isalnum() or c in (' ', '-', '_')).rstrip()
-                    
-                    # MP3ファイルとして正しく保存されているか確認
-                    try:
-                        audio = ID3(output_file)
-                        logger.info(f"Successfully verified MP3 file: {safe_title}")
-                    except Exception as e:
-                        raise Exception(f"Invalid MP3 file: {str(e)}")
-
-                    result = {
-                        "video_id": info['id'],
-                        "title": info['title'],
-                        "duration": info.get('duration'),
-                        "file_path": output_file,
-                        "filename": f"{safe_title}.mp3"
-                    }
-
-                    # プレイリスト処理時はクリーンアップしない
-                    if not output_dir:
-                        cleaned = await self.cleanup_old_files(keep_latest=5)
-                        if cleaned > 0:
-                            logger.info(f"Cleaned up {cleaned} old files")
+    async def _fetch_cover_safely(self, info: Dict) -> Optional[bytes]:
+        """カバー画像を取得（失敗してもタグ付け自体は続ける）"""
+        try:
+            with stage_timer('thumbnail'):
+                return await self._fetch_cover_image(info)
+        except Exception as e:
+            logger.error(f"Error fetching cover image: {str(e)}")
+            return None
+
+    async def _build_id3_header(self, info: Dict) -> bytes:
+        """音声データの前に置くID3v2ヘッダ（タグ + カバー画像）を生成"""
+        values = self._tag_values(info)
+        tags = id3.ID3()
+        tags.add(id3.TIT2(encoding=3, text=values['title']))
+        tags.add(id3.TPE1(encoding=3, text=values['artist']))
+        tags.add(id3.TALB(encoding=3, text=values['album']))
+        if values['date']:
+            tags.add(id3.TDRC(encoding=3, text=values['date']))
+
+        image_data = await self._fetch_cover_safely(info)
+        if image_data:
+            tags.add(id3.APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=image_data))
+
+        with stage_timer('tagging'):
+            buffer = io.BytesIO()
+            tags.save(buffer, v2_version=3)
+            return buffer.getvalue()
+
+    async def _download_and_convert(self, info: Dict, progress: Optional[ProgressCallback] = None,
+                                    work_dir: str = None) -> str:
+        """動画をダウンロードし、出力プロファイルの形式に変換
+
+        ダウンロード済みの元ファイルは変換が成功するまで残し、変換の再試行では再ダウンロードしない。
+        変換済みファイルへのタグ付け（Oggのカバー画像）の再試行でも変換をやり直さない。
+        """
+        video_id = info['id']
+        work_dir = work_dir or self.temp_dir
+        # 出力ディレクトリが存在することを確認
+        os.makedirs(work_dir, exist_ok=True)
+
+        async def download(attempt: int) -> DownloadedSource:
+            source_info = info
+            if attempt:
+                # ストリームURLの期限切れに備え、情報を取り直してからダウンロード（途中までのファイルは続きから）
+                source_info = await self._resolve_video_info(video_id)
+                await self.info_cache.set(video_id, source_info)
+            try:
+                return await self._download_source(source_info, work_dir=work_dir, progress=progress)
+            except yt_dlp.utils.DownloadError as e:
+                raise HTTPException(status_code=400, detail=f"Download failed: {str(e)}")
 
-                    return result
+        # カバー画像の取得はダウンロードと並行して行う
+        cover_task = asyncio.ensure_future(self._fetch_cover_safely(info))
+        try:
+            # ダウンロード（ネットワーク）と変換（CPU）は別々の上限で実行する
+            source = await run_stage('download', download, breaker=get_upstream_breaker())
+        except BaseException:
+            cover_task.cancel()
+            raise
+        cover = await cover_task
+        source_file = source.path
+
+        output_file = os.path.join(work_dir, f"{video_id}.{self.profile.ext}")
+
+        async def transcode(attempt: int) -> None:
+            if progress:
+                progress('transcode', None)
+            await self._convert_audio(info, source_file, output_file, cover, source.format)
+            with stage_timer('verify'):
+                self._verify_output(output_file)
+
+        await run_stage('transcode', transcode)
+        os.remove(source_file)
+
+        if cover and self.profile.ext == 'opus':
+            async def tag(attempt: int) -> None:
+                if progress:
+                    progress('tagging', None)
+                # Oggのカバー画像はFFmpegでは書けないため、METADATA_BLOCK_PICTUREとして追加
+                with stage_timer('tagging'):
+                    await get_transcode_executor().run(self._embed_ogg_cover, output_file, cover)
+
+            await run_stage('tagging', tag)
+
+        logger.info(f"Successfully downloaded and converted: {output_file} ({os.path.getsize(output_file)} bytes)")
+        return output_file
+
+    @staticmethod
+    def _verify_output(output_file: str) -> None:
+        """変換済みファイルが存在し、空でないことを確認"""
+        if not os.path.exists(output_file):
+            logger.error(f"Expected output file not found: {output_file}")
+            # 出力ディレクトリの内容をログ
+            logger.error(f"Files in directory: {os.listdir(os.path.dirname(output_file) or '.')}")
+            raise Exception("File conversion failed - Output file not found")
+        if os.path.getsize(output_file) == 0:
+            os.remove(output_file)
+            raise Exception(f"Generated file is empty: {output_file}")
+
+    async def _download_source(self, info: Dict, work_dir: str = None,
+                               progress: Optional[ProgressCallback] = None) -> DownloadedSource:
+        """元の音声ストリームを変換せずにダウンロード"""
+        work_dir = work_dir or self.temp_dir
+        hook = self._download_progress_hook(progress) if progress else None
+
+        logger.info(f"Downloading to directory: {work_dir}")
+
+        async with download_slot():
+            with stage_timer('download'):
+                # 保存先はリクエストごとに違うため、借りている間だけ paths で指定する
+                async with get_ydl_pool().acheckout(self._download_opts(), paths={'home': work_dir},
+                                                    progress_hook=hook) as ydl:
+                    try:
+                        # 解決済みの情報を再利用し、再度の情報取得を行わない
+                        source = await get_download_engine().download(ydl, info, hook)
+                    except Exception as ydl_error:
+                        logger.error(f"YouTube-DL error details: {str(ydl_error)}")
+                        # ストリームURLの期限切れに備え、次の試行では情報を取り直す
+                        await self.info_cache.delete(info['id'])
+                        raise
 
-                finally:
-                    # 元のtemp_dirを復元
-                    if output_dir:
-                        self.temp_dir = original_temp_dir
+        logger.info(f"Downloaded source: {source.path}")
+        return source
+
+    @staticmethod
+    def _download_progress_hook(progress: ProgressCallback) -> Callable[[Dict], None]:
+        """yt-dlpの進捗をダウンロード率（%）として通知するフック"""
+        def hook(d: Dict) -> None:
+            if d.get('status') == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                percent = d.get('downloaded_bytes', 0) * 100 / total if total else None
+                progress('download', percent)
+            elif d.get('status') == 'finished':
+                progress('download', 100.0)
+        return hook
+
+    async def _convert_audio(self, info: Dict, source_file: str, output_file: str,
+                             cover: Optional[bytes] = None, source_format: Optional[Dict] = None) -> str:
+        """ダウンロード済みの音声をFFmpegで変換（タグとカバー画像も同時に書き込む）
+
+        元のコーデック（source_format はダウンロード時に選ばれた形式）が出力プロファイルと
+        同じ場合は再エンコードせずに詰め替える。
+        """
+        cover_file = None
+        part_file = f"{output_file}.part"
+        try:
+            if cover:
+                cover_file = f"{os.path.splitext(source_file)[0]}.cover.jpg"
+                with open(cover_file, 'wb') as f:
+                    f.write(cover)
+
+            passthrough = can_passthrough(self.profile, source_codec(source_format or {}))
+            args = audio_file_args(source_file, part_file, self.profile, self._tag_values(info),
+                                   cover_file, passthrough=passthrough)
+            async with get_transcode_executor().slot():
+                with stage_timer('transcode'):
+                    await run_ffmpeg(args)
+            os.replace(part_file, output_file)
+            mode = 'Remuxed' if passthrough else 'Converted'
+            logger.info(f"{mode} with tags{' and cover' if cover_file else ''}: {output_file}")
+            return output_file
+        finally:
+            # 元ファイルは再試行のために残す（呼び出し側が削除する）
+            for path in (cover_file, part_file):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    @staticmethod
+    def _embed_ogg_cover(path: str, image_data: bytes) -> None:
+        """Ogg Opusファイルにカバー画像を追加（途中で失敗しても変換済みファイルは壊さない）"""
+        picture = flac.Picture()
+        picture.type = 3  # 表紙
+        picture.mime = 'image/jpeg'
+        picture.desc = 'Cover'
+        picture.data = image_data
+        tagged = f"{path}.tagging"
+        shutil.copyfile(path, tagged)
+        try:
+            audio = oggopus.OggOpus(tagged)
+            audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+            audio.save()
+            os.replace(tagged, path)
+        finally:
+            if os.path.exists(tagged):
+                os.remove(tagged)
 
-            except Exception as e:
-                logger.error(f"Attempt {attempt + 1}/{retry_count} failed: {str(e)}")
-                if attempt < retry_count - 1:  # 最後の試行でなければ
-                    logger.info(f"Retrying in {retry_delay} seconds...")
-                    await asyncio.sleep(retry_delay)  # 次の試行前に待機
-                else:  # 最後の試行で失敗した場合
-                    if isinstance(e, HTTPException):
-                        raise
-                    raise HTTPException(status_code=400, detail=str(e))
+    async def iter_extract_many(self, urls: List[str], output_dir: str = None,
+                                concurrency: int = None) -> AsyncIterator[Optional[Dict]]:
+        """複数の動画を並列に処理し、入力順に結果を返す（失敗した曲は None）
 
+        各曲はそれ以前の曲が全て終わった時点で、すぐに返される。
+        """
+        slots = asyncio.Semaphore(concurrency or config.ALBUM_CONCURRENCY)
 
+        async def run(index: int, url: str) -> Optional[Dict]:
+            async with slots:
+                try:
+                    result = await self.extract(url, output_dir=output_dir)
+                    logger.info(f"[{index + 1}/{len(urls)}] Saved file: {result['file_path']}")
+                    return result
+                except Exception as e:
+                    logger.error(f"[{index + 1}/{len(urls)}] Error processing {url}: {str(e)}")
+                    return None
 
-    async def _set_media_tags(self, file_path: str, info: Dict) -> None:
-        """メディアタグを設定"""
+        tasks = [asyncio.ensure_future(run(i, url)) for i, url in enumerate(urls)]
         try:
-            # メタデータの設定
-            try:
-                audio = EasyID3(file_path)
-            except error:
-                audio = ID3()
-                audio.save(file_path)
-                audio = EasyID3(file_path)
-
-            # 基本的なメタデータを設定
-            title = info.get('title', '')
-            artist = info.get('uploader', '')
-            album = info.get('playlist_title', '') or info.get('album', 'YouTube Music')
-
-            audio['title'] = title
-            audio['artist'] = artist
-            audio['album'] = album
-            if info.get('upload_date'):
-                audio['date'] = info['upload_date'][:4]
-            audio.save()
-
-            # 画像の設定
-            thumbnails = [
-                info.get('thumbnail'),
-                next((t['url'] for t in info.get('thumbnails', []) if t.get('url')), None),
-                f"https://i.ytimg.com/vi/{info['id']}/maxresdefault.jpg",
-                f"https://i.ytimg.com/vi/{info['id']}/hqdefault.jpg"
-            ]
-            
-            thumbnail_url = next((url for url in thumbnails if url), None)
-            logger.info(f"Selected thumbnail URL: {thumbnail_url}")
-
-            if thumbnail_url:
-                response = requests.get(thumbnail_url)
-                if response.status_code == 200:
-                    # 画像をPILで開く
-                    img = Image.open(io.BytesIO(response.content))
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    
-                    # 画像を正方形にクロップ
-                    img = self.center_crop_square(img)
-                    
-                    # JPEG形式で保存
-                    output = io.BytesIO()
-                    img.save(output, format='JPEG', quality=95)
-                    image_data = output.getvalue()
-                    
-                    # ID3タグに画像を追加
-                    audio = ID3(file_path)
-                    audio.delall('APIC')  # 既存の画像を削除
-                    
-                    audio.add(APIC(
-                        encoding=3,
-                        mime='image/jpeg',
-                        type=3,
-                        desc='Cover',
-                        data=image_data
-                    ))
-                    audio.save(v2_version=3)
-                    
-                    # 検証
-                    verify_audio = ID3(file_path)
-                    apic_frames = verify_audio.getall('APIC')
-                    logger.info(f"Embedded image size: {len(image_data)} bytes")
-                    logger.info(f"Number of APIC frames: {len(apic_frames)}")
-                    logger.info(f"Set metadata - Title: {title}, Artist: {artist}, Album: {album}")
+            for task in tasks:
+                yield await task
+        finally:
+            # 途中で打ち切られた場合（クライアント切断など）は残りを中止
+            for task in tasks:
+                task.cancel()
+
+    async def iter_extract_completed(self, urls: List[str], output_dir: str = None,
+                                     concurrency: int = None
+                                     ) -> AsyncIterator[Tuple[int, Optional[Dict], Optional[Exception]]]:
+        """複数の動画を並列に処理し、終わった順に (入力の位置, 結果, 例外) を返す"""
+        slots = asyncio.Semaphore(concurrency or config.ALBUM_CONCURRENCY)
+
+        async def run(index: int, url: str) -> Tuple[int, Optional[Dict], Optional[Exception]]:
+            async with slots:
+                try:
+                    return index, await self.extract(url, output_dir=output_dir), None
+                except Exception as e:
+                    logger.error(f"[{index + 1}/{len(urls)}] Error processing {url}: {str(e)}")
+                    return index, None, e
 
-        except Exception as e:
-            logger.error(f"Error setting media tags: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
-                
-    async def _download_and_convert(self, url: str, video_id: str) -> str:
-        """動画をダウンロードしMP3に変換"""
+        tasks = [asyncio.ensure_future(run(i, url)) for i, url in enumerate(urls)]
         try:
-            # 出力ディレクトリが存在することを確認
-            os.makedirs(self.temp_dir, exist_ok=True)
-            
-            # yt-dlpのオプションを更新
-            current_opts = self.ydl_opts.copy()
-            current_opts.update({
-                'outtmpl': os.path.join(self.temp_dir, '%(id)s.%(ext)s'),
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '320',
-                }],
-                'verbose': True,  # 詳細なログを有効化
-            })
-
-            logger.info(f"Downloading to directory: {self.temp_dir}")
-            
-            with yt_dlp.YoutubeDL(current_opts) as ydl:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # 途中で打ち切られた場合（クライアント切断など）は残りを中止
+            for task in tasks:
+                task.cancel()
+
+    async def iter_video_info(self, video_ids: List[str], concurrency: int = None
+                              ) -> AsyncIterator[Tuple[int, Optional[Dict], Optional[Exception]]]:
+        """複数の動画情報を並列に取得し、取得できた順に (入力の位置, 情報, 例外) を返す
+
+        取得した情報は共有キャッシュに登録され、後のダウンロードでそのまま使われる。
+        """
+        slots = asyncio.Semaphore(concurrency or config.INFO_CONCURRENCY)
+        breaker = get_upstream_breaker()
+
+        async def fetch_info(video_id: str) -> Dict:
+            with stage_timer('metadata'):
+                return await self._cached_video_info(video_id)
+
+        async def run(index: int, video_id: str) -> Tuple[int, Optional[Dict], Optional[Exception]]:
+            cached = await self.info_cache.get(video_id)
+            if cached:
+                # キャッシュ済みのものは並列数の枠を使わずにすぐ返す
+                return index, cached, None
+            async with slots:
                 try:
-                    await asyncio.to_thread(ydl.download, [url])
-                except Exception as ydl_error:
-                    logger.error(f"YouTube-DL error details: {str(ydl_error)}")
-                    raise
-                
-            # 出力ファイルのパスを構築
-            output_file = os.path.join(self.temp_dir, f"{video_id}.mp3")
-            if not os.path.exists(output_file):
-                logger.error(f"Expected output file not found: {output_file}")
-                # 出力ディレクトリの内容をログ
-                files = os.listdir(self.temp_dir)
-                logger.error(f"Files in directory: {files}")
-                raise Exception("File conversion failed - Output file not found")
-                    
-            # ファイルサイズの確認
-            file_size = os.path.getsize(output_file)
-            if file_size == 0:
-                raise Exception(f"Generated file is empty: {output_file}")
-
-            logger.info(f"Successfully downloaded and converted: {output_file} ({file_size} bytes)")
-            return output_file
+                    return index, await run_stage('metadata', lambda attempt: fetch_info(video_id),
+                                                  breaker=breaker), None
+                except Exception as e:
+                    logger.error(f"Error getting info for {video_id}: {str(e)}")
+                    return index, None, e
+
+        tasks = [asyncio.ensure_future(run(i, video_id)) for i, video_id in enumerate(video_ids)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # 途中で打ち切られた場合（クライアント切断など）は残りを中止
+            for task in tasks:
+                task.cancel()
+
+    async def extract_many(self, urls: List[str], output_dir: str = None,
+                           concurrency: int = None) -> List[Optional[Dict]]:
+        """複数の動画を並列に処理（結果は入力順、失敗した曲は None）"""
+        return [result async for result in self.iter_extract_many(urls, output_dir, concurrency)]
 
-        except Exception as e:
-            logger.error(f"Error in download_and_convert: {str(e)}")
-            logger.error(f"Error type: {type(e)}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            
-            # より具体的なエラー情報を提供
-            if isinstance(e, yt_dlp.utils.DownloadError):
-                raise HTTPException(status_code=400, detail=f"Download failed: {str(e)}")
-            elif isinstance(e, FileNotFoundError):
-                raise HTTPException(status_code=400, detail="File not found after download")
-            else:
-                raise HTTPException(status_code=400, detail=f"Download or conversion failed: {str(e)}")
-            
     def _extract_video_id(self, url: str) -> str:
         """URLから動画IDを抽出"""
         import urllib.parse
@@ -379,6 +731,11 @@ class AudioExtractor:
         return video_id
 
 
+    @staticmethod
+    def playlist_id(url: str) -> Optional[str]:
+        """URLの list= パラメータからプレイリストIDを取得"""
+        return parse_qs(urlparse(url).query).get('list', [None])[0]
+
     def _is_valid_youtube_url(self, url: str) -> bool:
         """YouTubeのURLが有効かチェック"""
         import re
@@ -411,17 +768,20 @@ class AudioExtractor:
         
     async def get_playlist_info(self, url: str) -> Dict:
         """プレイリストの情報を取得"""
-        playlist_opts = {
-            **self.ydl_opts,
-            'extract_flat': True,  # プレイリスト情報のみを取得
-            'noplaylist': False    # プレイリストを許可
-        }
-
         try:
-            with yt_dlp.YoutubeDL(playlist_opts) as ydl:
+            async with get_ydl_pool().acheckout(self._playlist_opts()) as ydl:
                 info = await asyncio.to_thread(ydl.extract_info, url, download=False)
                 logger.info(f"Retrieved playlist info with {len(info.get('entries', []))} videos")
                 return info
         except Exception as e:
             logger.error(f"Error getting playlist info: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Could not get playlist info: {str(e)}")
\ No newline at end of file
+            raise HTTPException(status_code=400, detail=f"Could not get playlist info: {str(e)}")
+
+
+async def create_extractor(profile: str, url: str, accept: Optional[str] = None) -> AudioExtractor:
+    """出力プロファイルに応じたExtractorを作成（auto はAcceptヘッダから選ぶ）"""
+    if profile == AUTO_PROFILE:
+        extractor = AudioExtractor()
+        await extractor.select_auto_profile(url, accepted_profiles(accept))
+        return extractor
+    return AudioExtractor(profile=profile)
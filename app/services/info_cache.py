@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+from typing import Any, Hashable, Optional
+
+import config
+from utils.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# この回数の登録ごとに期限切れ・上限超過の行を削除する
+_PRUNE_EVERY = 50
+
+# 共有しない動画情報の項目（ダウンロードにも表示にも使わず、字幕の一覧などで数百KBになる）
+_SHARED_OMIT = ("subtitles", "automatic_captions", "heatmap")
+
+
+def _shared_value(value: Any) -> Any:
+    if isinstance(value, dict) and any(key in value for key in _SHARED_OMIT):
+        return {key: item for key, item in value.items() if key not in _SHARED_OMIT}
+    return value
+
+
+class InfoCache:
+    """動画・プレイリスト情報のキャッシュ
+
+    SQLiteに保存してワーカー間で共有し、よく使うものはプロセス内の TTLCache にも置く
+    （毎回JSONを読み直さないため）。キーは動画ID、またはタプル（('playlist', id) など）。
+    JSONにそのまま変換できない値を含む情報は共有しない（別の型に変わった情報をダウンロードに使わないため）。
+    SQLiteの読み書きとJSONの変換はスレッドで行い、イベントループを止めない。
+    """
+
+    def __init__(self, db_path: str = None, ttl: float = None, max_entries: int = None,
+                 local_entries: int = None):
+        self.db_path = db_path or config.INFO_CACHE_DB_PATH
+        self.ttl = ttl or config.METADATA_CACHE_TTL
+        self.max_entries = max_entries or config.INFO_CACHE_MAX_ENTRIES
+        self.local = TTLCache(self.ttl, local_entries or config.METADATA_CACHE_MAX_ENTRIES)
+        self._sets = 0
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS info (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS info_expires_at ON info (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # ワーカープロセス間で共有するため、呼び出しごとに接続する
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def _db_key(key: Hashable) -> str:
+        return ":".join(key) if isinstance(key, tuple) else str(key)
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        """値を取得（期限切れ・未登録なら None）"""
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        return await asyncio.to_thread(self._read, key)
+
+    def _read(self, key: Hashable) -> Optional[Any]:
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM info WHERE key = ? AND expires_at > ?",
+                    (self._db_key(key), time.time()),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading info cache: {str(e)}")
+            return None
+        if row is None:
+            return None
+        value = json.loads(row[0])
+        # 他のワーカーが登録したものも、残りの有効期間だけプロセス内に置く
+        self.local.set(key, value, ttl=row[1] - time.time())
+        return value
+
+    async def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """値を登録"""
+        ttl = ttl if ttl is not None else self.ttl
+        self.local.set(key, value, ttl=ttl)
+        await asyncio.to_thread(self._write, key, value, ttl)
+
+    def _write(self, key: Hashable, value: Any, ttl: float) -> None:
+        try:
+            encoded = json.dumps(_shared_value(value), ensure_ascii=False)
+        except (TypeError, ValueError) as e:
+            # 共有できなくてもプロセス内のキャッシュは使える
+            logger.warning(f"Not sharing info for {key}: {str(e)}")
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO info (key, value, expires_at) VALUES (?, ?, ?)",
+                    (self._db_key(key), encoded, time.time() + ttl),
+                )
+                self._sets += 1
+                if self._sets % _PRUNE_EVERY == 0:
+                    self._prune(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing info cache: {str(e)}")
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM info WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM info WHERE key NOT IN (SELECT key FROM info ORDER BY expires_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    async def delete(self, key: Hashable) -> None:
+        """値を削除（古いストリームURLで失敗した場合など）"""
+        self.local.delete(key)
+        await asyncio.to_thread(self._remove, key)
+
+    def _remove(self, key: Hashable) -> None:
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM info WHERE key = ?", (self._db_key(key),))
+        except sqlite3.Error as e:
+            logger.error(f"Error deleting from info cache: {str(e)}")
+
+
+_info_cache: Optional[InfoCache] = None
+
+
+def get_info_cache() -> InfoCache:
+    """プロセス内で共有する情報キャッシュを取得"""
+    global _info_cache
+    if _info_cache is None:
+        _info_cache = InfoCache()
+    return _info_cache
@@ -0,0 +1,61 @@
+import re
+import logging
+from typing import AsyncIterator, Dict, List, Tuple
+
+import config
+from services.batch import BatchItem, error_line, group_batch_urls
+from services.extractor import AudioExtractor
+
+logger = logging.getLogger(__name__)
+
+_VIDEO_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+
+
+def normalize_target(target: str) -> str:
+    """動画ID だけが渡された場合は動画のURLにする"""
+    target = target.strip()
+    if _VIDEO_ID_RE.fullmatch(target):
+        return f"https://www.youtube.com/watch?v={target}"
+    return target
+
+
+def group_info_targets(extractor: AudioExtractor, targets: List[str]) -> Tuple[List[BatchItem], List[Dict]]:
+    """URL・動画IDを動画IDでまとめる（不正なものはエラーとして返す）"""
+    return group_batch_urls(extractor, [normalize_target(target) for target in targets])
+
+
+def info_summary(info: Dict) -> Dict:
+    """検索結果などに表示するための情報（ストリームURLなどは返さない）"""
+    return {
+        "title": info.get("title"),
+        "duration": info.get("duration"),
+        "thumbnail": info.get("thumbnail"),
+        "uploader": info.get("uploader") or info.get("channel"),
+        "upload_date": info.get("upload_date"),
+    }
+
+
+async def info_ndjson_stream(extractor: AudioExtractor, targets: List[str], items: List[BatchItem],
+                             errors: List[Dict]) -> AsyncIterator[Dict]:
+    """取得できた順に動画情報を返す（最後に集計を返す）"""
+    failed = sum(len(line["index"]) for line in errors)
+    for line in errors:
+        yield line
+
+    async for index, info, error in extractor.iter_video_info([item.video_id for item in items],
+                                                             concurrency=config.INFO_CONCURRENCY):
+        item = items[index]
+        if error is not None:
+            failed += len(item.indices)
+            yield error_line(item, targets, error)
+            continue
+        yield {
+            "index": item.indices,
+            "url": targets[item.indices[0]],
+            "video_id": item.video_id,
+            "status": "ok",
+            **info_summary(info),
+        }
+
+    logger.info(f"Info lookup finished: {len(items)} videos, {failed} failed")
+    yield {"status": "done", "total": len(targets), "succeeded": len(targets) - failed, "failed": failed}
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+from typing import Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATES = (SUCCEEDED, FAILED)
+
+_UPDATABLE_FIELDS = {
+    "status", "stage", "progress", "message", "error",
+    "result_path", "filename", "media_type", "worker", "etag",
+}
+
+
+class JobStore:
+    """ジョブの状態をSQLiteに保存（ワーカー間で共有・再起動後も保持）"""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or config.JOB_DB_PATH
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    params TEXT NOT NULL DEFAULT '{}',
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    progress REAL,
+                    message TEXT,
+                    error TEXT,
+                    result_path TEXT,
+                    filename TEXT,
+                    media_type TEXT,
+                    worker TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    etag TEXT
+                )
+                """
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "etag" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN etag TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        job["params"] = json.loads(job.get("params") or "{}")
+        return job
+
+    def create(self, kind: str, url: str, params: Dict = None) -> Dict:
+        """ジョブを登録"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO jobs (id, kind, url, params, status, progress, worker, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)
+                """,
+                (job_id, kind, url, json.dumps(params or {}), QUEUED, worker_identity(), now, now),
+            )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """ジョブを取得"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def update(self, job_id: str, **fields) -> None:
+        """ジョブの状態を更新"""
+        unknown = set(fields) - _UPDATABLE_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown job fields: {unknown}")
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim_orphaned(self) -> List[Dict]:
+        """停止したワーカーが処理中だったジョブを、このワーカーに引き継ぐ"""
+        claimed = []
+        me = worker_identity()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, worker FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchall()
+            for row in rows:
+                if row["worker"] == me or _worker_alive(row["worker"]):
+                    continue
+                # 他のワーカーと同時に引き継がないよう、元のワーカーを条件に更新
+                cur = conn.execute(
+                    "UPDATE jobs SET worker = ?, status = ?, updated_at = ? WHERE id = ? AND worker IS ?",
+                    (me, QUEUED, time.time(), row["id"], row["worker"]),
+                )
+                if cur.rowcount:
+                    claimed.append(row["id"])
+        return [self.get(job_id) for job_id in claimed]
+
+    def expired(self, ttl: float) -> List[Dict]:
+        """保持期間を過ぎた完了済みジョブ"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (SUCCEEDED, FAILED, time.time() - ttl),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def delete(self, job_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+def _process_start_time(pid: int) -> Optional[str]:
+    """プロセスの開始時刻（pidの再利用を見分けるため）"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm にスペースが含まれる場合があるので ')' 以降を分割
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def worker_identity(pid: int = None) -> str:
+    """ワーカーを識別する文字列（pid + 開始時刻）"""
+    pid = pid or os.getpid()
+    return f"{pid}:{_process_start_time(pid) or ''}"
+
+
+def _worker_alive(worker: Optional[str]) -> bool:
+    if not worker:
+        return False
+    pid = int(worker.split(":", 1)[0])
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # 同じpidでも開始時刻が違えば別プロセス（コンテナ再起動など）
+    return worker_identity(pid) == worker
@@ -0,0 +1,186 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import threading
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+import config
+from services.album import album_archive_entries, album_zip_stream, playlist_video_urls, safe_name
+from services.extractor import AudioExtractor, create_extractor
+from services.memory_governor import get_memory_governor
+from services.job_store import JobStore, RUNNING, SUCCEEDED, FAILED, worker_identity
+from services.profiles import DEFAULT_PROFILE
+from services.metrics import IN_FLIGHT
+from services.scheduler import BULK, INTERACTIVE, set_work
+from utils.file_serving import hash_file
+
+logger = logging.getLogger(__name__)
+
+# ジョブの種類
+SINGLE = "single"
+PLAYLIST = "playlist"
+JOB_KINDS = (SINGLE, PLAYLIST)
+
+
+class _ProgressReporter:
+    """進捗をジョブストアへ書き込む（書き込み頻度は間引く）"""
+
+    def __init__(self, store: JobStore, job_id: str, min_interval: float = 0.5):
+        self.store = store
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self._last = (None, None, 0.0)
+        self._lock = threading.Lock()  # yt-dlpのフックは別スレッドから呼ばれる
+
+    def __call__(self, stage: str, percent: Optional[float] = None, message: str = None) -> None:
+        with self._lock:
+            last_stage, last_percent, last_time = self._last
+            now = time.monotonic()
+            if stage == last_stage and percent != 100.0 and now - last_time < self.min_interval:
+                return
+            self._last = (stage, percent, now)
+        fields = {"stage": stage, "progress": round(percent, 1) if percent is not None else None}
+        if message is not None:
+            fields["message"] = message
+        try:
+            self.store.update(self.job_id, **fields)
+        except Exception as e:
+            logger.error(f"Error updating job progress {self.job_id}: {e}")
+
+
+class JobRunner:
+    """抽出ジョブをバックグラウンドで実行"""
+
+    def __init__(self, store: JobStore = None, result_dir: str = None):
+        self.store = store or JobStore()
+        self.result_dir = result_dir or config.JOB_RESULT_DIR
+        os.makedirs(self.result_dir, exist_ok=True)
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def submit(self, kind: str, url: str, params: Dict = None) -> Dict:
+        """ジョブを登録して実行を開始"""
+        if kind not in JOB_KINDS:
+            raise HTTPException(status_code=400, detail=f"Unknown job type: {kind}")
+        self.cleanup_expired()
+        job = self.store.create(kind, url, params)
+        logger.info(f"Created {kind} job {job['id']} for {url}")
+        self._start(job)
+        return job
+
+    def resume_orphaned(self) -> int:
+        """再起動などで止まったジョブを引き継いで再実行"""
+        jobs = self.store.claim_orphaned()
+        for job in jobs:
+            logger.info(f"Resuming orphaned job {job['id']} ({job['kind']})")
+            self._start(job)
+        return len(jobs)
+
+    def _start(self, job: Dict) -> None:
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda t: self._tasks.pop(job["id"], None))
+
+    async def _run(self, job: Dict) -> None:
+        job_id = job["id"]
+        report = _ProgressReporter(self.store, job_id)
+        job_dir = os.path.join(self.result_dir, job_id)
+        # プレイリストのジョブは一括の優先度で1曲ずつ順番待ちする
+        set_work(INTERACTIVE if job["kind"] == SINGLE else BULK,
+                 (job.get("params") or {}).get("client") or f"job:{job_id}")
+        # メモリに空きができるまで queued のまま待つ（ジョブは断らない）
+        reservation = await get_memory_governor().acquire_for_job(job["kind"])
+        shutil.rmtree(job_dir, ignore_errors=True)
+        os.makedirs(job_dir, exist_ok=True)
+        await asyncio.to_thread(self.store.update, job_id, status=RUNNING, stage="metadata", progress=0,
+                                worker=worker_identity())
+
+        try:
+            with IN_FLIGHT.labels('job').track_inprogress():
+                if job["kind"] == SINGLE:
+                    result = await self._run_single(job, job_dir, report)
+                else:
+                    result = await self._run_playlist(job, job_dir, report)
+            if not result.get("etag"):
+                result["etag"] = await asyncio.to_thread(hash_file, result["result_path"])
+            await asyncio.to_thread(self.store.update, job_id, status=SUCCEEDED, stage="done", progress=100,
+                                    **result)
+            logger.info(f"Job {job_id} succeeded: {result['filename']}")
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Job {job_id} failed: {detail}")
+            await asyncio.to_thread(self.store.update, job_id, status=FAILED, error=str(detail))
+            shutil.rmtree(job_dir, ignore_errors=True)
+        finally:
+            await reservation.release()
+
+    async def _run_single(self, job: Dict, job_dir: str, report: _ProgressReporter) -> Dict:
+        extractor = await self._create_extractor(job, job["url"])
+        result = await extractor.extract(job["url"], output_dir=job_dir, progress=report)
+        return {
+            "result_path": result["file_path"],
+            "filename": result["filename"],
+            "media_type": result.get("media_type", extractor.profile.media_type),
+            "etag": result.get("etag"),
+        }
+
+    async def _run_playlist(self, job: Dict, job_dir: str, report: _ProgressReporter) -> Dict:
+        playlist_id = AudioExtractor.playlist_id(job["url"])
+        if not playlist_id:
+            raise HTTPException(status_code=400, detail="No playlist found in URL")
+
+        playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
+        extractor = await self._create_extractor(job, playlist_url)
+        playlist_info = await extractor.get_playlist_info(playlist_url)
+        album_name = safe_name(playlist_info.get('title', 'Unknown_Album'))
+        video_urls = playlist_video_urls(playlist_info)
+        total = len(video_urls)
+
+        def on_track(done: int, result: Optional[Dict]) -> None:
+            report("download", done * 100 / total if total else 100.0, message=f"{done}/{total} tracks")
+
+        tracks_dir = os.path.join(job_dir, "tracks")
+        zip_path = os.path.join(job_dir, f"{album_name or job['id']}.zip")
+        entries = album_archive_entries(extractor, video_urls, album_name, output_dir=tracks_dir, on_track=on_track)
+        with open(f"{zip_path}.part", "wb") as f:
+            async for chunk in album_zip_stream(entries):
+                f.write(chunk)
+        report("zipping", 100.0)
+        os.replace(f"{zip_path}.part", zip_path)
+        shutil.rmtree(tracks_dir, ignore_errors=True)
+
+        return {
+            "result_path": zip_path,
+            "filename": os.path.basename(zip_path),
+            "media_type": "application/zip",
+        }
+
+    @staticmethod
+    async def _create_extractor(job: Dict, url: str) -> AudioExtractor:
+        params = job.get("params") or {}
+        return await create_extractor(params.get("profile", DEFAULT_PROFILE), url, params.get("accept"))
+
+    def cleanup_expired(self) -> int:
+        """保持期間を過ぎたジョブと成果物を削除"""
+        removed = 0
+        for job in self.store.expired(config.JOB_RESULT_TTL):
+            shutil.rmtree(os.path.join(self.result_dir, job["id"]), ignore_errors=True)
+            self.store.delete(job["id"])
+            removed += 1
+        if removed:
+            logger.info(f"Cleaned up {removed} expired jobs")
+        return removed
+
+
+_job_runner: Optional[JobRunner] = None
+
+
+def get_job_runner() -> JobRunner:
+    """プロセス内で共有するJobRunnerを取得"""
+    global _job_runner
+    if _job_runner is None:
+        _job_runner = JobRunner()
+    return _job_runner
@@ -0,0 +1,404 @@
+import os
+import math
+import time
+import asyncio
+import sqlite3
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Deque, Dict, Optional, Set, Tuple
+
+import config
+from services.metrics import FAILURES, MEMORY_DECISIONS, MEMORY_RESERVED
+from services.transcode_executor import ServerBusyError
+
+logger = logging.getLogger(__name__)
+
+# 処理の種類（見積もりは config.MEMORY_COSTS で設定する）
+SINGLE = "single"
+STREAM = "stream"
+PLAYLIST = "playlist"
+BATCH = "batch"
+
+# 判断の結果
+ADMITTED = "admitted"
+QUEUED = "queued"
+REJECTED = "rejected"
+
+# 制限が無い（大きすぎる）とみなすcgroupの値
+_UNLIMITED = 1 << 60
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == "max" else int(value)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_stat(path: str, key: str) -> int:
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(" ")
+                if name == key:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def cgroup_memory() -> Tuple[Optional[int], Optional[int]]:
+    """cgroupのメモリ使用量（再利用できるページキャッシュを除く）と上限。取れなければ None"""
+    # cgroup v2
+    usage = _read_int("/sys/fs/cgroup/memory.current")
+    if usage is not None:
+        usage -= _read_stat("/sys/fs/cgroup/memory.stat", "inactive_file")
+        return max(0, usage), _read_int("/sys/fs/cgroup/memory.max")
+    # cgroup v1
+    usage = _read_int("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if usage is not None:
+        usage -= _read_stat("/sys/fs/cgroup/memory/memory.stat", "total_inactive_file")
+        limit = _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+        return max(0, usage), limit if limit and limit < _UNLIMITED else None
+    return None, None
+
+
+def process_rss() -> int:
+    """このプロセスの常駐メモリ（バイト）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _physical_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (OSError, ValueError):
+        return 0
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ReservationLedger:
+    """ワーカープロセス間で共有する予約の台帳（SQLite）
+
+    予約の判断と登録を1つのトランザクションで行うので、複数のワーカーが同時に
+    上限ぎりぎりまで受け付けることはない。終了したプロセスの予約は参照時に削除する。
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or config.MEMORY_LEDGER_PATH
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS reservations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    pid INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    cost INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            # 同じPIDで動いていた以前のプロセスの予約は残っていても無効
+            conn.execute("DELETE FROM reservations WHERE pid = ?", (os.getpid(),))
+
+    def _connect(self) -> sqlite3.Connection:
+        # ワーカープロセス間で共有するため、呼び出しごとに接続する（トランザクションは明示的に開始する）
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def _total(conn: sqlite3.Connection) -> int:
+        for (pid,) in conn.execute("SELECT DISTINCT pid FROM reservations").fetchall():
+            if not _pid_alive(pid):
+                logger.warning(f"Dropping memory reservations of exited worker {pid}")
+                conn.execute("DELETE FROM reservations WHERE pid = ?", (pid,))
+        return conn.execute("SELECT COALESCE(SUM(cost), 0) FROM reservations").fetchone()[0]
+
+    def reserve_if(self, kind: str, cost: int, fits: Callable[[int], bool]) -> Optional[int]:
+        """全ワーカーの予約の合計で fits が真なら予約を登録してIDを返す（入らなければ None）"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if not fits(self._total(conn)):
+                conn.execute("ROLLBACK")
+                return None
+            cursor = conn.execute(
+                "INSERT INTO reservations (pid, kind, cost, created_at) VALUES (?, ?, ?, ?)",
+                (os.getpid(), kind, cost, time.time()),
+            )
+            conn.execute("COMMIT")
+            return cursor.lastrowid
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def release(self, reservation_id: int) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
+        finally:
+            conn.close()
+
+    def total(self) -> int:
+        """全ワーカーの予約の合計"""
+        conn = self._connect()
+        try:
+            return self._total(conn)
+        finally:
+            conn.close()
+
+
+class MemoryReservation:
+    """予約したメモリの見積もり（release は何度呼んでもよい）"""
+
+    def __init__(self, governor: "MemoryGovernor", kind: str, cost: int, ledger_id: Optional[int] = None):
+        self.governor = governor
+        self.kind = kind
+        self.cost = cost
+        self.ledger_id = ledger_id
+        self.released = False
+
+    async def release(self) -> None:
+        if not self.released:
+            self.released = True
+            await self.governor._release(self.kind, self.cost, self.ledger_id)
+
+    async def hold(self, body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """ストリーミングの送信が終わるまで予約を保持する"""
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await self.release()
+
+
+class MemoryGovernor:
+    """メモリの使用量と処理ごとの見積もりから、処理を受け付ける・待たせる・断るを決める
+
+    実際の使用量（cgroup全体、取れなければこのプロセス）に、実行中の処理の見積もりの合計と
+    新しい処理の見積もりを足して上限（high_water）を超えるなら、空くまで待たせる。
+    見積もりは実際の使用量と重複して数えるので安全側に倒れる。
+    待ち行列が満杯、または queue_timeout 秒待っても空かなければ429で断る。
+    ワーカーが複数なら予約を ReservationLedger で共有し、他のワーカーの予約も数える
+    （使用量はコンテナ全体なので、予約だけをプロセスごとに数えると全員が同時に上限まで受け付けてしまう）。
+    """
+
+    def __init__(self, limit: int = None, high_water: float = None, costs: Dict[str, int] = None,
+                 max_queue: int = None, queue_timeout: float = None, ledger: Optional[ReservationLedger] = None):
+        _, cgroup_limit = cgroup_memory()
+        self.limit = limit or config.MEMORY_LIMIT_BYTES or cgroup_limit or _physical_memory()
+        self.high_water = int(self.limit * (high_water or config.MEMORY_HIGH_WATER))
+        self.costs = costs or config.MEMORY_COSTS
+        self.max_queue = max_queue if max_queue is not None else config.MEMORY_MAX_QUEUE
+        self.queue_timeout = queue_timeout if queue_timeout is not None else config.MEMORY_QUEUE_TIMEOUT
+        if ledger is None and config.WEB_CONCURRENCY > 1:
+            ledger = ReservationLedger()
+        self.ledger = ledger
+        # このプロセスの予約の合計（全ワーカーの合計は total_reserved()）
+        self.reserved = 0
+        self.running: Dict[str, int] = {}
+        self._waiters: Deque[object] = deque()
+        self._changed: Optional[asyncio.Condition] = None
+        self._background: Set[asyncio.Task] = set()
+        self.decisions: Deque[Dict] = deque(maxlen=50)
+        logger.info(f"Memory governor: limit {self.limit >> 20}MB, high water {self.high_water >> 20}MB")
+
+    def cost(self, kind: str) -> int:
+        return self.costs.get(kind, self.costs[SINGLE])
+
+    def observed(self) -> int:
+        """現在のメモリ使用量（cgroupが取れればコンテナ全体）"""
+        usage, _ = cgroup_memory()
+        return usage if usage is not None else process_rss()
+
+    async def total_reserved(self) -> int:
+        """全ワーカーの予約の合計（台帳が無ければこのプロセスの分）"""
+        if not self.ledger:
+            return self.reserved
+        # 台帳の読み書き（停止したワーカーの予約の削除を含む）はイベントループを止めないようスレッドで行う
+        return await asyncio.to_thread(self.ledger.total)
+
+    def _fits(self, cost: int, reserved: int) -> bool:
+        if not reserved:
+            # 何も実行していなければ、見積もりが大きすぎても1件は通す
+            return self.observed() < self.high_water
+        return self.observed() + reserved + cost <= self.high_water
+
+    async def _try_reserve(self, kind: str, cost: int) -> Optional[MemoryReservation]:
+        """入るなら予約する（入らなければ None）"""
+        ledger_id = None
+        if self.ledger:
+            registering = asyncio.ensure_future(asyncio.to_thread(
+                self.ledger.reserve_if, kind, cost, lambda reserved: self._fits(cost, reserved)))
+            try:
+                ledger_id = await asyncio.shield(registering)
+            except asyncio.CancelledError:
+                # 登録が終わってから中止された場合でも台帳に残さない
+                def drop(done: asyncio.Future) -> None:
+                    if not done.cancelled() and done.exception() is None and done.result() is not None:
+                        self._spawn(self._release_ledger(done.result()))
+
+                registering.add_done_callback(drop)
+                raise
+            if ledger_id is None:
+                return None
+        elif not self._fits(cost, self.reserved):
+            return None
+        self._reserve(kind, cost)
+        return MemoryReservation(self, kind, cost, ledger_id)
+
+    def _record(self, kind: str, cost: int, decision: str, waited: float = 0.0) -> None:
+        MEMORY_DECISIONS.labels(kind, decision).inc()
+        entry = {"time": time.time(), "kind": kind, "cost": cost, "decision": decision,
+                 "observed": self.observed(), "reserved": self.reserved, "queued": len(self._waiters),
+                 "waited": round(waited, 2)}
+        self.decisions.append(entry)
+        message = (f"Memory governor {decision} {kind} ({cost >> 20}MB): observed {entry['observed'] >> 20}MB, "
+                   f"reserved {self.reserved >> 20}MB in this worker, high water {self.high_water >> 20}MB")
+        if decision == REJECTED:
+            logger.warning(message)
+        else:
+            logger.info(message)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.queue_timeout or 5))
+
+    async def acquire(self, kind: str, wait: bool = True) -> MemoryReservation:
+        """見積もり分のメモリを予約する（終わったら release する）
+
+        空きが無ければ queue_timeout 秒まで待つ。wait=False なら待たずに断る。
+        """
+        return await self._acquire(kind, self.queue_timeout if wait else 0)
+
+    async def acquire_for_job(self, kind: str) -> MemoryReservation:
+        """バックグラウンドのジョブ用に予約する（断らずに空くまで待つ）"""
+        return await self._acquire(kind, None)
+
+    async def _acquire(self, kind: str, timeout: Optional[float]) -> MemoryReservation:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        cost = self.cost(kind)
+        async with self._changed:
+            # 待っている処理があれば追い越さない
+            reservation = None if self._waiters else await self._try_reserve(kind, cost)
+            if reservation:
+                self._record(kind, cost, ADMITTED)
+                return reservation
+            if timeout == 0 or (timeout is not None and len(self._waiters) >= self.max_queue):
+                self._record(kind, cost, REJECTED)
+                FAILURES.labels('memory').inc()
+                raise ServerBusyError(self.retry_after())
+
+            ticket = object()
+            self._waiters.append(ticket)
+            self._record(kind, cost, QUEUED)
+            started = time.monotonic()
+            try:
+                while True:
+                    if self._waiters[0] is ticket:
+                        reservation = await self._try_reserve(kind, cost)
+                        if reservation:
+                            break
+                    remaining = None if timeout is None else timeout - (time.monotonic() - started)
+                    if remaining is not None and remaining <= 0:
+                        self._record(kind, cost, REJECTED, time.monotonic() - started)
+                        FAILURES.labels('memory').inc()
+                        raise ServerBusyError(self.retry_after())
+                    # 他のワーカーの使用量も変わるため、通知が無くても定期的に確かめる
+                    interval = config.MEMORY_POLL_INTERVAL
+                    if remaining is not None:
+                        interval = min(remaining, interval)
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), interval)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiters.remove(ticket)
+                self._changed.notify_all()
+            self._record(kind, cost, ADMITTED, time.monotonic() - started)
+            return reservation
+
+    def _reserve(self, kind: str, cost: int) -> None:
+        self.reserved += cost
+        self.running[kind] = self.running.get(kind, 0) + 1
+        MEMORY_RESERVED.set(self.reserved)
+
+    async def _release_ledger(self, ledger_id: int) -> None:
+        try:
+            await asyncio.to_thread(self.ledger.release, ledger_id)
+        except sqlite3.Error as e:
+            # 残った予約はこのプロセスの終了時に他のワーカーが削除する
+            logger.error(f"Error releasing shared memory reservation: {str(e)}")
+
+    def _spawn(self, coro) -> None:
+        """完了を待たない処理を開始（終わるまで参照を保持する）"""
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _release(self, kind: str, cost: int, ledger_id: Optional[int] = None) -> None:
+        if ledger_id is not None:
+            await self._release_ledger(ledger_id)
+        self.reserved -= cost
+        self.running[kind] -= 1
+        if not self.running[kind]:
+            del self.running[kind]
+        MEMORY_RESERVED.set(self.reserved)
+        async with self._changed:
+            self._changed.notify_all()
+
+    @asynccontextmanager
+    async def admit(self, kind: str, wait: bool = True):
+        """処理の間だけメモリを予約する"""
+        reservation = await self.acquire(kind, wait=wait)
+        try:
+            yield reservation
+        finally:
+            await reservation.release()
+
+    async def status(self) -> Dict:
+        usage, cgroup_limit = cgroup_memory()
+        return {
+            "limit": self.limit,
+            "high_water": self.high_water,
+            "cgroup_usage": usage,
+            "cgroup_limit": cgroup_limit,
+            "process_rss": process_rss(),
+            "reserved": self.reserved,
+            "reserved_all_workers": await self.total_reserved(),
+            "running": dict(self.running),
+            "queued": len(self._waiters),
+            "max_queue": self.max_queue,
+            "costs": dict(self.costs),
+            "recent_decisions": list(self.decisions),
+        }
+
+
+_memory_governor: Optional[MemoryGovernor] = None
+
+
+def get_memory_governor() -> MemoryGovernor:
+    """プロセス内で共有するメモリガバナーを取得"""
+    global _memory_governor
+    if _memory_governor is None:
+        _memory_governor = MemoryGovernor()
+    return _memory_governor
@@ -0,0 +1,147 @@
+import os
+import logging
+from typing import Iterator
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 複数のuvicornワーカーで集計するため、PROMETHEUS_MULTIPROC_DIR が設定されていればマルチプロセスモードで動作する
+# （ディレクトリは起動前に空にしておく — docker-compose.yml を参照）
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# 各段階の所要時間（ダウンロードは数分かかることもあるため上限を広めに取る）
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "ytdlp_stage_duration_seconds",
+    "Duration of each extraction stage",
+    ["stage"],  # metadata / download / thumbnail / transcode / tagging / verify / zip
+    buckets=STAGE_BUCKETS,
+)
+RETRIES = Counter("ytdlp_retries_total", "Pipeline retries", ["stage"])
+CACHE_REQUESTS = Counter("ytdlp_cache_requests_total", "Result cache lookups", ["result"])  # hit / miss
+FAILURES = Counter("ytdlp_failures_total", "Failed extractions by cause", ["cause"])
+IN_FLIGHT = Gauge(
+    "ytdlp_in_flight", "Extractions and jobs currently running", ["kind"],  # extract / stream / job
+    multiprocess_mode="livesum",
+)
+BYTES_SERVED = Counter("ytdlp_bytes_served_total", "Response body bytes sent", ["endpoint"])
+
+# ダウンロードの効率（ranged = 範囲を分けた並列取得 / ytdlp = yt-dlpによる取得）
+DOWNLOAD_BYTES = Counter("ytdlp_download_bytes_total", "Source bytes downloaded", ["engine"])
+DOWNLOAD_THROUGHPUT = Histogram(
+    "ytdlp_download_throughput_bytes_per_second", "Throughput of each source download", ["engine"],
+    buckets=(64e3, 256e3, 1e6, 2.5e6, 5e6, 10e6, 25e6, 50e6, 100e6),
+)
+DOWNLOAD_CONNECTIONS = Gauge(
+    "ytdlp_download_connections", "Upstream connections currently used by downloads",
+    multiprocess_mode="livesum",
+)
+
+
+# メモリガバナーの判断（admitted / queued / rejected）と、実行中の処理の見積もりの合計
+MEMORY_DECISIONS = Counter("ytdlp_memory_decisions_total", "Memory governor admission decisions", ["kind", "decision"])
+MEMORY_RESERVED = Gauge(
+    "ytdlp_memory_reserved_bytes", "Estimated memory reserved by running work",
+    multiprocess_mode="livesum",
+)
+
+# 抽出の順番待ち（interactive / bulk / background）
+SCHEDULER_QUEUED = Gauge(
+    "ytdlp_scheduler_queued", "Work units waiting for an extraction slot", ["priority"],
+    multiprocess_mode="livesum",
+)
+SCHEDULER_WAIT = Histogram(
+    "ytdlp_scheduler_wait_seconds", "Time work units waited for an extraction slot", ["priority"],
+    buckets=STAGE_BUCKETS,
+)
+
+# プロセスの起動から準備完了（ready）・最初のAPIの成功（first_success）までの秒数
+STARTUP_SECONDS = Gauge(
+    "ytdlp_startup_seconds", "Seconds from process start to readiness and to the first successful request",
+    ["phase"], multiprocess_mode="max",
+)
+
+# 先読みの結果（done / cached / failed / preempted / dropped）
+PREFETCH = Counter("ytdlp_prefetch_total", "Speculative prefetch outcomes", ["result"])
+
+
+def stage_timer(stage: str):
+    """段階の所要時間を計測するコンテキストマネージャ"""
+    return STAGE_SECONDS.labels(stage).time()
+
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # 走査中に削除されたファイル
+                pass
+    return total
+
+
+class _TempDirCollector:
+    """一時ディレクトリの使用量（全ワーカーで共有なので収集時に計測する）"""
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        yield GaugeMetricFamily("ytdlp_temp_dir_bytes", "Bytes used in the temp directory",
+                                value=_dir_bytes(config.TEMP_DIR))
+
+
+_temp_dir_collector = _TempDirCollector()
+if not MULTIPROCESS:
+    REGISTRY.register(_temp_dir_collector)
+
+
+def render_metrics() -> bytes:
+    """Prometheus形式のメトリクスを生成"""
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(_temp_dir_collector)
+    return generate_latest(registry)
+
+
+def mark_process_dead() -> None:
+    """終了するワーカーの livesum ゲージを集計対象から外す"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    """レスポンスの送信バイト数をエンドポイントごとに数えるASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def counting_send(message):
+            size = 0
+            if message["type"] == "http.response.body":
+                size = len(message.get("body", b""))
+            elif message["type"] == "http.response.zerocopysend":
+                size = message.get("count") or 0
+            elif message["type"] == "http.response.pathsend":
+                size = os.path.getsize(message["path"])
+            if size:
+                # ルーティング後に設定されるエンドポイント名をラベルにする（パスだとIDごとに増えるため）
+                endpoint = scope.get("endpoint")
+                BYTES_SERVED.labels(getattr(endpoint, "__name__", "unknown")).inc(size)
+            await send(message)
+
+        await self.app(scope, receive, counting_send)
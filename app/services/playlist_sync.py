@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import time
+import logging
+import tempfile
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+import config
+from services.album import safe_name
+from services.extractor import TAG_VERSION, AudioExtractor
+from utils.zip_stream import unique_archive_path
+
+logger = logging.getLogger(__name__)
+
+
+class PlaylistManifestStore:
+    """プレイリストごとの同期マニフェスト（前回の同期で格納した曲と内容ハッシュ）
+
+    1プレイリスト・1出力プロファイルにつき1つのJSONファイルとして保存する。
+    """
+
+    def __init__(self, manifest_dir: str = None):
+        self.manifest_dir = manifest_dir or config.MANIFEST_DIR
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+    def _path(self, playlist_id: str, profile: str) -> str:
+        name = re.sub(r'[^A-Za-z0-9_-]', '_', f"{playlist_id}.{profile}")
+        return os.path.join(self.manifest_dir, f"{name}.json")
+
+    def load(self, playlist_id: str, profile: str) -> Optional[Dict]:
+        """マニフェストを読み込む（無い・壊れている場合は None）"""
+        try:
+            with open(self._path(playlist_id, profile), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable manifest for {playlist_id}: {str(e)}")
+            return None
+
+    def save(self, manifest: Dict) -> None:
+        """マニフェストを保存（他のワーカーが読み途中のファイルを見ないよう置き換える）"""
+        path = self._path(manifest["playlist_id"], manifest["profile"])
+        fd, tmp_path = tempfile.mkstemp(dir=self.manifest_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class SyncPlan(NamedTuple):
+    """同期の計画（video_ids はプレイリスト順）"""
+    playlist_id: str
+    title: str
+    video_ids: List[str]
+    reused: Dict[str, Dict]  # video_id -> キャッシュのエントリ（前回から変わっていない曲）
+    pending: List[str]  # 新しく（または再度）変換する曲
+    removed: List[str]  # プレイリストから消えた曲
+    previous: Dict[str, Dict]  # video_id -> 前回のマニフェストのエントリ
+
+
+def plan_sync(extractor: AudioExtractor, playlist_id: str, playlist_info: Dict,
+              manifest: Optional[Dict]) -> SyncPlan:
+    """前回のマニフェストと比べて、変換が必要な曲を決める
+
+    前回と同じタグ付け版で格納し、同じ内容のファイルがキャッシュに残っている曲は変換しない。
+    """
+    video_ids = []
+    for entry in playlist_info.get('entries', []):
+        video_id = entry.get('id') if entry else None
+        if video_id and video_id not in video_ids:
+            video_ids.append(video_id)
+
+    previous = {}
+    if manifest and manifest.get("tag_version") == TAG_VERSION:
+        previous = {entry["video_id"]: entry for entry in manifest.get("entries", [])}
+
+    reused, pending = {}, []
+    for video_id in video_ids:
+        known = previous.get(video_id)
+        cached = extractor.cache.get_by_key(known["cache_key"]) if known and known.get("cache_key") else None
+        if cached and cached.get("etag") and cached["etag"] == known.get("etag"):
+            reused[video_id] = cached
+        else:
+            pending.append(video_id)
+
+    removed = [video_id for video_id in previous if video_id not in video_ids]
+    return SyncPlan(playlist_id, playlist_info.get('title') or 'Unknown_Album',
+                    video_ids, reused, pending, removed, previous)
+
+
+async def album_sync_entries(extractor: AudioExtractor, plan: SyncPlan, album_name: str, output_dir: str,
+                             delta: bool = False,
+                             store: PlaylistManifestStore = None) -> AsyncIterator[Tuple[str, str]]:
+    """同期した曲をプレイリスト順にZIPへ追加する (ファイルパス, アーカイブ内パス) を返す
+
+    delta の場合は前回から増えた・内容が変わった曲だけを返す。
+    最後まで送り終えたときだけマニフェストを更新する（途中で切断された差分は次回も返す）。
+    """
+    store = store or get_manifest_store()
+    urls = [f"https://www.youtube.com/watch?v={video_id}" for video_id in plan.pending]
+    extracted = extractor.iter_extract_many(urls, output_dir=output_dir).__aiter__()
+
+    used_paths = set()
+    manifest_entries = []
+    changed = 0
+    try:
+        for position, video_id in enumerate(plan.video_ids):
+            cached = plan.reused.get(video_id)
+            if cached:
+                entry = {"video_id": video_id, "title": cached["title"], "cache_key": cached["key"],
+                         "etag": cached["etag"]}
+                file_path = extractor.cache.materialize(cached, output_dir) if not delta else None
+            else:
+                result = await extracted.__anext__()
+                if not result or not result.get("cache_key") or not os.path.exists(result["file_path"]):
+                    # 失敗した曲はマニフェストに載せず、次回の同期で再び変換する
+                    continue
+                entry = {"video_id": video_id, "title": result.get("title"), "cache_key": result["cache_key"],
+                         "etag": result.get("etag")}
+                known = plan.previous.get(video_id)
+                is_changed = not known or known.get("etag") != entry["etag"]
+                changed += is_changed
+                file_path = result["file_path"] if not delta or is_changed else None
+
+            entry["position"] = position
+            manifest_entries.append(entry)
+            if file_path:
+                safe_title = safe_name(entry["title"])
+                ext = os.path.splitext(file_path)[1]
+                file_name = f"{safe_title}{ext}" if safe_title else os.path.basename(file_path)
+                yield file_path, unique_archive_path(os.path.join(album_name, file_name), used_paths)
+    finally:
+        # 途中で打ち切られた場合は残りの変換を中止
+        await extracted.aclose()
+
+    store.save({
+        "playlist_id": plan.playlist_id,
+        "title": plan.title,
+        "profile": extractor.profile.name,
+        "tag_version": TAG_VERSION,
+        "updated_at": time.time(),
+        "entries": manifest_entries,
+    })
+    logger.info(f"Synced playlist {plan.playlist_id}: {len(plan.reused)} reused, {changed} new or changed, "
+                f"{len(plan.removed)} removed")
+
+
+_manifest_store: Optional[PlaylistManifestStore] = None
+
+
+def get_manifest_store() -> PlaylistManifestStore:
+    """プロセス内で共有するマニフェストストアを取得"""
+    global _manifest_store
+    if _manifest_store is None:
+        _manifest_store = PlaylistManifestStore()
+    return _manifest_store
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+import config
+from services.memory_governor import SINGLE, get_memory_governor
+from services.metrics import PREFETCH
+from services.transcode_executor import ServerBusyError, get_transcode_executor
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchItem(NamedTuple):
+    """先読みする動画と出力プロファイル（playlist_id はアルバムのタグに使うプレイリスト）"""
+    video_id: str
+    profile: str
+    playlist_id: Optional[str] = None
+
+
+# 先読みを実行する関数（変換した場合は True、キャッシュ済みなら False を返す）
+PrefetchRunner = Callable[[PrefetchItem], Awaitable[bool]]
+
+
+class PrefetchQueue:
+    """次に使われそうな動画を、空いている時間だけ先に変換して結果キャッシュへ入れる
+
+    対話的な抽出（foreground）が動いている間は新しく始めず、実行中の先読みは中止して
+    待ち行列の先頭へ戻す。待ち行列があふれたら古いものから捨てる。
+    """
+
+    def __init__(self, max_queue: int = None, concurrency: int = None):
+        self.max_queue = max_queue or config.PREFETCH_MAX_QUEUE
+        self.concurrency = concurrency or config.PREFETCH_CONCURRENCY
+        self._queue: "OrderedDict[PrefetchItem, None]" = OrderedDict()
+        self._running: Dict[PrefetchItem, asyncio.Task] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self.foreground_count = 0
+
+    def _notify(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def enqueue(self, items: List[PrefetchItem]) -> int:
+        """待ち行列に追加し、新しく追加した件数を返す（待機中・実行中のものは追加しない）"""
+        added = 0
+        for item in items:
+            if item in self._queue or item in self._running:
+                continue
+            self._queue[item] = None
+            added += 1
+            while len(self._queue) > self.max_queue:
+                dropped, _ = self._queue.popitem(last=False)
+                PREFETCH.labels('dropped').inc()
+                logger.info(f"Prefetch queue full, dropped {dropped.video_id}")
+        if added:
+            logger.info(f"Queued {added} videos for prefetch ({len(self._queue)} waiting)")
+            self._notify()
+        return added
+
+    def enqueue_following(self, video_id: str, playlist_video_ids: List[str], profile: str,
+                          playlist_id: Optional[str] = None) -> int:
+        """プレイリスト内で今の動画に続く動画を先読みする（PREFETCH_PLAYLIST_AHEAD 件）"""
+        if not config.PREFETCH_ENABLED or config.PREFETCH_PLAYLIST_AHEAD <= 0 or video_id not in playlist_video_ids:
+            return 0
+        position = playlist_video_ids.index(video_id)
+        following = playlist_video_ids[position + 1:position + 1 + config.PREFETCH_PLAYLIST_AHEAD]
+        return self.enqueue([PrefetchItem(next_id, profile, playlist_id) for next_id in following])
+
+    @contextmanager
+    def foreground(self):
+        """対話的な抽出の間は先読みを止める（実行中の先読みは中止して戻す）"""
+        self.foreground_count += 1
+        self._preempt()
+        try:
+            yield
+        finally:
+            self.foreground_count -= 1
+            if not self.foreground_count:
+                self._notify()
+
+    def _preempt(self) -> None:
+        for item, task in list(self._running.items()):
+            if not task.done():
+                logger.info(f"Pre-empting prefetch of {item.video_id} for interactive work")
+                task.cancel()
+
+    async def is_idle(self) -> bool:
+        """先読みを始めてよいか（対話的な処理が無く、変換待ちも無く、メモリに余裕がある）"""
+        if self.foreground_count:
+            return False
+        executor = get_transcode_executor()
+        if executor.queued or executor.running > len(self._running):
+            return False
+        governor = get_memory_governor()
+        return governor.observed() + await governor.total_reserved() + governor.cost(SINGLE) <= governor.high_water
+
+    async def run(self, runner: PrefetchRunner) -> None:
+        """待ち行列を処理し続ける（起動時にバックグラウンドタスクとして開始する）"""
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                while self._queue and len(self._running) < self.concurrency and await self.is_idle():
+                    item, _ = self._queue.popitem(last=False)
+                    task = asyncio.ensure_future(self._prefetch(runner, item))
+                    self._running[item] = task
+                    task.add_done_callback(lambda t, item=item: self._finish(item, t))
+                try:
+                    # 対話的な処理が終わったときや追加されたときに起こされる。他のワーカーの状況は分からないので定期的にも確かめる
+                    await asyncio.wait_for(self._wakeup.wait(), config.PREFETCH_IDLE_POLL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in self._running.values():
+                task.cancel()
+
+    async def _prefetch(self, runner: PrefetchRunner, item: PrefetchItem) -> None:
+        try:
+            # 先読みの分もメモリを予約しておき、対話的な処理の受け入れ判断に反映させる
+            async with get_memory_governor().admit(SINGLE, wait=False):
+                converted = await runner(item)
+        except asyncio.CancelledError:
+            raise
+        except ServerBusyError:
+            # 混んでいただけでこの動画の失敗ではないので、少し待ってから待ち行列の先頭に戻す
+            PREFETCH.labels('deferred').inc()
+            logger.info(f"Prefetch of {item.video_id} deferred: server busy")
+            await asyncio.sleep(config.PREFETCH_IDLE_POLL)
+            self._requeue(item)
+            return
+        except Exception as e:
+            PREFETCH.labels('failed').inc()
+            logger.warning(f"Prefetch of {item.video_id} failed: {str(e)}")
+            return
+        PREFETCH.labels('done' if converted else 'cached').inc()
+        if converted:
+            logger.info(f"Prefetched {item.video_id} ({item.profile})")
+
+    def _finish(self, item: PrefetchItem, task: asyncio.Task) -> None:
+        self._running.pop(item, None)
+        if task.cancelled():
+            # 中止された先読みは、次に空いたときに最初にやり直す
+            PREFETCH.labels('preempted').inc()
+            self._requeue(item)
+        self._notify()
+
+    def _requeue(self, item: PrefetchItem) -> None:
+        """待ち行列の先頭に戻す（次に空いたときに最初にやり直す）"""
+        if item not in self._queue:
+            self._queue[item] = None
+            self._queue.move_to_end(item, last=False)
+
+    async def status(self) -> Dict:
+        return {
+            "enabled": config.PREFETCH_ENABLED,
+            "queued": [item._asdict() for item in self._queue],
+            "running": [item._asdict() for item in self._running],
+            "foreground": self.foreground_count,
+            "idle": await self.is_idle(),
+        }
+
+
+_prefetch_queue: Optional[PrefetchQueue] = None
+
+
+def get_prefetch_queue() -> PrefetchQueue:
+    """プロセス内で共有する先読みの待ち行列を取得"""
+    global _prefetch_queue
+    if _prefetch_queue is None:
+        _prefetch_queue = PrefetchQueue()
+    return _prefetch_queue
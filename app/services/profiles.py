@@ -0,0 +1,142 @@
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+class OutputProfile(NamedTuple):
+    """出力プロファイル（コーデック・品質・コンテナ）"""
+    name: str
+    codec: str          # 出力する音声コーデック（FFmpeg上の名前ではなく mp3 / opus / aac）
+    ext: str            # 出力ファイルの拡張子
+    quality: str        # ビットレート（kbps）。'copy' は再エンコードしない
+    media_type: str
+    format: str         # yt-dlpのフォーマット指定
+    encoder: str        # 再エンコードが必要な場合のエンコーダ
+    fallback_bitrate: str  # 再エンコードが必要な場合のビットレート
+
+
+PROFILES: Dict[str, OutputProfile] = {
+    profile.name: profile for profile in [
+        OutputProfile('mp3-320', 'mp3', 'mp3', '320', 'audio/mpeg', 'bestaudio/best', 'libmp3lame', '320'),
+        OutputProfile('mp3-256', 'mp3', 'mp3', '256', 'audio/mpeg', 'bestaudio/best', 'libmp3lame', '256'),
+        OutputProfile('mp3-192', 'mp3', 'mp3', '192', 'audio/mpeg', 'bestaudio/best', 'libmp3lame', '192'),
+        OutputProfile('mp3-128', 'mp3', 'mp3', '128', 'audio/mpeg', 'bestaudio/best', 'libmp3lame', '128'),
+        # パススルー：元のストリームをそのままコンテナへ詰め替える（デコードしない）
+        OutputProfile('opus', 'opus', 'opus', 'copy', 'audio/ogg',
+                      'bestaudio[acodec=opus]/bestaudio/best', 'libopus', '160'),
+        OutputProfile('m4a', 'aac', 'm4a', 'copy', 'audio/mp4',
+                      'bestaudio[ext=m4a]/bestaudio[acodec^=mp4a]/bestaudio/best', 'aac', '256'),
+    ]
+}
+
+# 従来どおりの既定値（MP3 320kbps）
+DEFAULT_PROFILE = 'mp3-320'
+AUTO_PROFILE = 'auto'
+
+# 別名
+_ALIASES = {'mp3': DEFAULT_PROFILE}
+
+# auto のときの優先順（CPU負荷の低い順）と、対応するMIMEタイプ
+_AUTO_ORDER = [
+    ('opus', ('audio/ogg', 'audio/opus', 'audio/webm')),
+    ('m4a', ('audio/mp4', 'audio/m4a', 'audio/aac', 'audio/x-m4a')),
+]
+
+
+
+def get_profile(name: Optional[str]) -> OutputProfile:
+    """プロファイル名から設定を取得（不明な名前は400）"""
+    name = _ALIASES.get(name or DEFAULT_PROFILE, name or DEFAULT_PROFILE)
+    if name not in PROFILES:
+        valid = ", ".join([*PROFILES, *_ALIASES, AUTO_PROFILE])
+        raise HTTPException(status_code=400, detail=f"Unknown profile: {name} (valid: {valid})")
+    return PROFILES[name]
+
+
+def media_type_for(ext: str) -> str:
+    """出力ファイルの拡張子からMIMEタイプを取得"""
+    for profile in PROFILES.values():
+        if profile.ext == ext:
+            return profile.media_type
+    return 'application/octet-stream'
+
+
+def parse_accept(accept: Optional[str]) -> Dict[str, float]:
+    """Acceptヘッダを {MIMEタイプ: q値} にする（q=0 は「受け付けない」なので含めない）"""
+    media_types = {}
+    for item in (accept or '').lower().split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            media_types[media_type] = max(quality, media_types.get(media_type, 0.0))
+    return media_types
+
+
+def accepted_profiles(accept: Optional[str]) -> List[str]:
+    """Acceptヘッダから、auto で選べるプロファイルを負荷の低い順に返す（MP3は常に最後の候補）"""
+    media_types = parse_accept(accept)
+    candidates = [name for name, profile_types in _AUTO_ORDER
+                  if any(media_type in media_types for media_type in profile_types)]
+    return candidates + [DEFAULT_PROFILE]
+
+
+def _codec_name(acodec: str) -> str:
+    """yt-dlpの acodec（mp4a.40.2 など）をプロファイルのコーデック名にする"""
+    acodec = acodec.lower()
+    return 'aac' if acodec.startswith('mp4a') else acodec.split('.')[0]
+
+
+def source_codec(info: Dict) -> Optional[str]:
+    """ダウンロードする形式の音声コーデック（yt-dlpが選んだ形式の acodec。不明なら None）"""
+    acodec = info.get('acodec')
+    if not acodec:
+        # 映像と音声を別々に取得する形式では、音声側の acodec を見る
+        for fmt in info.get('requested_formats') or []:
+            if fmt.get('acodec') not in (None, 'none'):
+                acodec = fmt['acodec']
+                break
+    if not acodec or acodec == 'none':
+        return None
+    return _codec_name(acodec)
+
+
+def can_passthrough(profile: OutputProfile, codec: Optional[str]) -> bool:
+    """再エンコードせずにコンテナの詰め替えだけで済むか"""
+    return profile.quality == 'copy' and codec == profile.codec
+
+
+def available_codecs(info: Dict) -> List[str]:
+    """動画情報に含まれる音声ストリームのコーデック"""
+    codecs = []
+    for fmt in info.get('formats') or []:
+        acodec = (fmt.get('acodec') or 'none').lower()
+        if acodec == 'none' or fmt.get('vcodec') not in (None, 'none'):
+            continue
+        codec = _codec_name(acodec)
+        if codec not in codecs:
+            codecs.append(codec)
+    return codecs
+
+
+def choose_auto_profile(accepted: List[str], info: Dict) -> OutputProfile:
+    """受け付け可能なプロファイルの中で、パススルーできる最も安いものを選ぶ"""
+    codecs = available_codecs(info)
+    for name in accepted:
+        profile = PROFILES[name]
+        if profile.quality == 'copy' and profile.codec in codecs:
+            logger.info(f"Auto profile selected: {name} (passthrough)")
+            return profile
+    logger.info(f"Auto profile selected: {accepted[-1]}")
+    return PROFILES[accepted[-1]]
@@ -0,0 +1,154 @@
+import re
+import time
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from fastapi import HTTPException
+
+import config
+from services.metrics import FAILURES, RETRIES
+from services.transcode_executor import ServerBusyError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 再試行しても結果が変わらないエラー（非公開・削除済みなど）
+_PERMANENT_ERROR_RE = re.compile(
+    r"private video|video unavailable|has been removed|copyright|members-only|"
+    r"sign in to confirm your age|not available in your country|could not extract valid video id",
+    re.IGNORECASE,
+)
+
+
+class CircuitOpenError(HTTPException):
+    """上流（YouTube）の失敗が続いているため、試さずに失敗させる（503 + Retry-After）"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail="Upstream is failing, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.retry_after = retry_after
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """再試行しても成功しないエラーか"""
+    message = error.detail if isinstance(error, HTTPException) else str(error)
+    return bool(_PERMANENT_ERROR_RE.search(str(message)))
+
+
+class RetryPolicy:
+    """指数バックオフ（フルジッター）による再試行の間隔"""
+
+    def __init__(self, attempts: int = None, base_delay: float = None, max_delay: float = None):
+        self.attempts = attempts or config.RETRY_ATTEMPTS
+        self.base_delay = base_delay if base_delay is not None else config.RETRY_BASE_DELAY
+        self.max_delay = max_delay if max_delay is not None else config.RETRY_MAX_DELAY
+
+    def delay(self, attempt: int) -> float:
+        """attempt 回目（0始まり）の失敗後に待つ秒数"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """連続して失敗したら一定時間すぐに失敗させる（ワーカーごと）
+
+    開いてから reset_timeout 秒後に1件だけ試し、成功すれば閉じる。
+    """
+
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = failure_threshold or config.BREAKER_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout if reset_timeout is not None else config.BREAKER_RESET_TIMEOUT
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def check(self) -> None:
+        """開いていれば CircuitOpenError を送出（半開なら1件だけ通す）"""
+        state = self.state
+        if state == "closed":
+            return
+        now = time.monotonic()
+        # 試行中の1件が結果を返さずに終わった（キャンセルなど）場合に備え、一定時間で次の1件を通す
+        if state == "half-open" and (self._probe_started is None or now - self._probe_started >= self.reset_timeout):
+            self._probe_started = now
+            return
+        retry_after = self.reset_timeout - (now - self.opened_at)
+        FAILURES.labels('circuit_open').inc()
+        raise CircuitOpenError(max(1, int(retry_after + 0.999)))
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Upstream recovered, closing circuit breaker")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._probe_started is not None or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f"Opening circuit breaker after {self.failures} consecutive upstream failures")
+            self.opened_at = time.monotonic()
+        self._probe_started = None
+
+
+async def run_stage(stage: str, fn: Callable[[int], Awaitable[T]], policy: RetryPolicy = None,
+                    breaker: CircuitBreaker = None) -> T:
+    """1つの段階を実行し、失敗したらその段階だけを再試行する
+
+    fn には試行回数（0始まり）を渡す。混雑（429）・遮断中（503）・再試行しても変わらないエラーは
+    すぐに送出する。breaker を渡した段階の失敗は上流の失敗として数える。
+    """
+    policy = policy or RetryPolicy()
+    for attempt in range(policy.attempts):
+        if breaker:
+            breaker.check()
+        try:
+            result = await fn(attempt)
+        except (ServerBusyError, CircuitOpenError):
+            raise
+        except Exception as e:
+            permanent = is_permanent_error(e)
+            if breaker:
+                # 非公開・削除済みなどは上流が正常に応答した結果なので失敗に数えない
+                if permanent:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            logger.error(f"Stage {stage} failed (attempt {attempt + 1}/{policy.attempts}): {str(e)}")
+            if permanent or attempt == policy.attempts - 1:
+                FAILURES.labels(stage).inc()
+                if isinstance(e, HTTPException):
+                    raise
+                raise HTTPException(status_code=400, detail=str(e))
+            RETRIES.labels(stage).inc()
+            delay = policy.delay(attempt)
+            logger.info(f"Retrying {stage} in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+        else:
+            if breaker:
+                breaker.record_success()
+            return result
+
+
+_upstream_breaker: Optional[CircuitBreaker] = None
+
+
+def get_upstream_breaker() -> CircuitBreaker:
+    """YouTubeへのアクセス（メタデータ取得・ダウンロード）で共有するサーキットブレーカー"""
+    global _upstream_breaker
+    if _upstream_breaker is None:
+        _upstream_breaker = CircuitBreaker()
+    return _upstream_breaker
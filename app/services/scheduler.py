@@ -0,0 +1,271 @@
+import time
+import heapq
+import asyncio
+import hashlib
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import config
+from services.metrics import SCHEDULER_QUEUED, SCHEDULER_WAIT
+
+logger = logging.getLogger(__name__)
+
+# 優先度（先にあるものほど優先する）
+INTERACTIVE = "interactive"  # 1曲の抽出・ストリーミング・単曲ジョブ
+BULK = "bulk"  # アルバム・同期・一括抽出・プレイリストのジョブ（1曲ずつ順番待ちする）
+BACKGROUND = "background"  # 先読み
+PRIORITIES = (INTERACTIVE, BULK, BACKGROUND)
+
+
+class WorkContext(NamedTuple):
+    """処理の優先度と依頼元のクライアント"""
+    priority: str
+    client: str
+
+
+# リクエストごとに WorkContextMiddleware が設定する（タスクを作ると引き継がれる）
+_work_context: ContextVar[WorkContext] = ContextVar("work_context", default=WorkContext(INTERACTIVE, "local"))
+
+
+def current_work() -> WorkContext:
+    return _work_context.get()
+
+
+def _rank(priority: str) -> int:
+    return PRIORITIES.index(priority)
+
+
+class Promotion:
+    """複数の呼び出しで共有する処理（SingleFlight）の優先度
+
+    後から参加した呼び出しの優先度の方が高ければ引き上げ、順番待ち中なら待ち行列も移す。
+    """
+
+    def __init__(self, work: WorkContext):
+        self.work = work
+        self._on_raise: Optional[Callable[[], None]] = None
+
+    def raise_to(self, work: WorkContext) -> None:
+        if _rank(work.priority) < _rank(self.work.priority):
+            self.work = work
+            if self._on_raise:
+                self._on_raise()
+
+
+# 共有する処理のタスクで use_promotion が設定する
+_promotion: ContextVar[Optional[Promotion]] = ContextVar("work_promotion", default=None)
+
+
+def use_promotion(promotion: Promotion) -> None:
+    """以降の実行枠の確保で、共有する処理の（引き上げられた）優先度を使う"""
+    _promotion.set(promotion)
+
+
+def set_work(priority: Optional[str] = None, client: Optional[str] = None) -> None:
+    """以降の処理（このタスクと、ここから作るタスク）の優先度・クライアントを設定"""
+    work = _work_context.get()
+    _work_context.set(WorkContext(priority or work.priority, client or work.client))
+
+
+def client_identity(scope) -> str:
+    """クライアントの識別子（APIキーがあればそのハッシュ、無ければIPアドレス）"""
+    headers = dict(scope.get("headers") or [])
+    api_key = headers.get(b"x-api-key")
+    if api_key:
+        # 状態の表示やログにキーそのものを出さない
+        return f"key:{hashlib.sha256(api_key).hexdigest()[:12]}"
+    forwarded = headers.get(b"x-forwarded-for")
+    if forwarded and config.SCHEDULER_TRUST_FORWARDED:
+        return f"ip:{forwarded.decode('latin-1').split(',')[0].strip()}"
+    client = scope.get("client")
+    return f"ip:{client[0]}" if client else "unknown"
+
+
+class _Waiter:
+    """順番待ちの1件（仮想終了時刻の小さい順に処理する）"""
+
+    def __init__(self, priority: str, finish: float, seq: int, client: str, future: asyncio.Future):
+        self.priority = priority
+        self.finish = finish
+        self.seq = seq
+        self.client = client
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.finish, self.seq) < (other.finish, other.seq)
+
+
+class WorkScheduler:
+    """抽出の実行枠を優先度順・クライアントごとに公平に割り当てる
+
+    優先度の高い処理が待っている間は低い処理を始めない。一括・先読みは
+    SCHEDULER_INTERACTIVE_RESERVED 枠を残して使い、1曲の抽出がすぐに始められるようにする。
+    同じ優先度の中では重み付き公平キューイング（自己計時型）で、曲の多いクライアントが
+    他のクライアントを待たせ続けないようにする。アルバムなども1曲ずつ順番待ちするので、
+    複数のクライアントの曲が交互に処理される。
+    """
+
+    def __init__(self, capacity: int = None, interactive_reserved: int = None, weights: Dict[str, float] = None):
+        self.capacity = max(1, capacity or config.SCHEDULER_CONCURRENCY)
+        reserved = interactive_reserved if interactive_reserved is not None else config.SCHEDULER_INTERACTIVE_RESERVED
+        shared = max(1, self.capacity - reserved)
+        self.limits = {INTERACTIVE: self.capacity, BULK: shared, BACKGROUND: shared}
+        self.weights = weights if weights is not None else config.SCHEDULER_CLIENT_WEIGHTS
+        self.running = {priority: 0 for priority in PRIORITIES}
+        self._queues: Dict[str, List[_Waiter]] = {priority: [] for priority in PRIORITIES}
+        # 優先度ごとの仮想時刻と、クライアントごとの最後の仮想終了時刻
+        self._virtual_time = {priority: 0.0 for priority in PRIORITIES}
+        self._last_finish: Dict[str, Dict[str, float]] = {priority: {} for priority in PRIORITIES}
+        self._seq = itertools.count()
+        logger.info(f"Work scheduler: {self.capacity} slots, limits {self.limits}")
+
+    def _weight(self, client: str) -> float:
+        return max(0.01, self.weights.get(client, 1.0))
+
+    def _waiting(self, priority: str) -> int:
+        return sum(1 for waiter in self._queues[priority] if not waiter.future.done())
+
+    def _can_start(self, priority: str) -> bool:
+        if sum(self.running.values()) >= self.capacity or self.running[priority] >= self.limits[priority]:
+            return False
+        # 優先度の高い処理が待っていれば先に回す
+        higher = PRIORITIES[:PRIORITIES.index(priority)]
+        return not any(self._waiting(other) for other in higher)
+
+    def _start(self, priority: str, finish: float) -> None:
+        self.running[priority] += 1
+        self._virtual_time[priority] = max(self._virtual_time[priority], finish)
+
+    def _dispatch(self) -> None:
+        """空いた枠を待っている処理に割り当てる"""
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue:
+                # 中止されたものは読み飛ばす
+                if queue[0].future.done():
+                    heapq.heappop(queue)
+                    continue
+                if not self._can_start(priority):
+                    break
+                waiter = heapq.heappop(queue)
+                self._start(priority, waiter.finish)
+                waiter.future.set_result(None)
+
+    def _next_finish(self, priority: str, client: str) -> float:
+        last_finish = self._last_finish[priority]
+        finish = max(self._virtual_time[priority], last_finish.get(client, 0.0)) + 1.0 / self._weight(client)
+        last_finish[client] = finish
+        return finish
+
+    async def _acquire(self, priority: str, client: str, promotion: Optional[Promotion] = None) -> str:
+        """実行枠を得るまで待ち、実行枠を得た優先度を返す（待っている間に引き上げられることがある）"""
+        finish = self._next_finish(priority, client)
+        if not self._waiting(priority) and self._can_start(priority):
+            self._start(priority, finish)
+            return priority
+
+        waiter = _Waiter(priority, finish, next(self._seq), client, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queues[priority], waiter)
+        SCHEDULER_QUEUED.labels(priority).inc()
+        if promotion:
+            promotion._on_raise = lambda: self._promote(waiter, promotion.work)
+        try:
+            await waiter.future
+            return waiter.priority
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 枠を割り当てられた直後に中止された場合は返す
+                self._release(waiter.priority)
+            raise
+        finally:
+            if promotion:
+                promotion._on_raise = None
+            SCHEDULER_QUEUED.labels(waiter.priority).dec()
+
+    def _promote(self, waiter: _Waiter, work: WorkContext) -> None:
+        """順番待ち中の処理を、より高い優先度の待ち行列へ移す"""
+        if waiter.future.done() or _rank(work.priority) >= _rank(waiter.priority):
+            return
+        queue = self._queues[waiter.priority]
+        queue.remove(waiter)
+        heapq.heapify(queue)
+        SCHEDULER_QUEUED.labels(waiter.priority).dec()
+        waiter.priority, waiter.client = work.priority, work.client
+        waiter.finish = self._next_finish(work.priority, work.client)
+        heapq.heappush(self._queues[work.priority], waiter)
+        SCHEDULER_QUEUED.labels(work.priority).inc()
+        logger.info(f"Promoted shared work to {work.priority} for {work.client}")
+        self._dispatch()
+
+    def _release(self, priority: str) -> None:
+        self.running[priority] -= 1
+        # 仮想時刻に追い越された記録は順番に影響しないので捨てる（クライアントが増え続けても残らない）
+        virtual_time = self._virtual_time[priority]
+        self._last_finish[priority] = {
+            client: finish for client, finish in self._last_finish[priority].items() if finish > virtual_time
+        }
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[str] = None, client: Optional[str] = None):
+        """実行枠を確保（優先度・クライアントを省略した場合は current_work() のもの）
+
+        共有する処理（use_promotion）では、参加した呼び出しのうち最も高い優先度を使う。
+        """
+        work = current_work()
+        promotion = _promotion.get() if priority is None else None
+        if promotion and _rank(promotion.work.priority) < _rank(work.priority):
+            work = promotion.work
+        priority = priority or work.priority
+        client = client or work.client
+        started = time.monotonic()
+        priority = await self._acquire(priority, client, promotion)
+        SCHEDULER_WAIT.labels(priority).observe(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    def status(self) -> Dict:
+        queued: Dict[str, Dict[str, int]] = {}
+        for priority in PRIORITIES:
+            clients: Dict[str, int] = {}
+            for waiter in self._queues[priority]:
+                if not waiter.future.done():
+                    clients[waiter.client] = clients.get(waiter.client, 0) + 1
+            queued[priority] = clients
+        return {
+            "capacity": self.capacity,
+            "limits": self.limits,
+            "running": self.running,
+            "queued": queued,
+        }
+
+
+class WorkContextMiddleware:
+    """リクエストごとにクライアントを識別し、優先度を interactive にするASGIミドルウェア
+
+    一括処理のエンドポイントは set_work(BULK) で優先度を下げる。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            set_work(INTERACTIVE, client_identity(scope))
+        await self.app(scope, receive, send)
+
+
+_scheduler: Optional[WorkScheduler] = None
+
+
+def get_scheduler() -> WorkScheduler:
+    """プロセス内で共有するスケジューラを取得"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = WorkScheduler()
+    return _scheduler
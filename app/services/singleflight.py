@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+import config
+from services.scheduler import Promotion, current_work, use_promotion
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """同じキーの処理を1つにまとめる（プロセス内 + ワーカー間）"""
+
+    def __init__(self, lock_dir: str = None, outcome_ttl: float = None, poll_interval: float = 0.2):
+        self.lock_dir = lock_dir or config.LOCK_DIR
+        self.outcome_ttl = outcome_ttl if outcome_ttl is not None else config.SINGLEFLIGHT_OUTCOME_TTL
+        self.poll_interval = poll_interval
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._promotions: Dict[str, Promotion] = {}
+        # 直後に参加した呼び出しにも同じ結果を返すため、完了した結果を短時間保持
+        self._recent: Dict[str, Tuple[float, asyncio.Future]] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """keyごとに fn を1回だけ実行し、全ての呼び出し元へ同じ結果を返す"""
+        recent = self._recent.get(key)
+        if recent:
+            expires_at, task = recent
+            if time.monotonic() < expires_at:
+                logger.info(f"Single-flight: reusing recent outcome for {key}")
+                return task.result()
+            del self._recent[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            logger.info(f"Single-flight: joining in-flight work for {key}")
+            # 先に始めた呼び出し（先読み・一括処理など）の優先度のまま待たないよう引き上げる
+            self._promotions[key].raise_to(current_work())
+        else:
+            # 呼び出し元が切断されても他の待機者のために処理を続ける
+            promotion = Promotion(current_work())
+            task = asyncio.ensure_future(self._run(key, fn, promotion))
+            self._inflight[key] = task
+            self._promotions[key] = promotion
+            task.add_done_callback(lambda t: self._finish(key, t))
+
+        return await asyncio.shield(task)
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable[Any]], promotion: Promotion) -> Any:
+        use_promotion(promotion)
+        async with self._worker_lock(key) as contended:
+            if contended:
+                self._raise_recent_error(key)
+            try:
+                result = await fn()
+            except HTTPException as e:
+                self._write_error(key, e)
+                raise
+            self._clear_error(key)
+            return result
+
+    def _finish(self, key: str, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        self._promotions.pop(key, None)
+        now = time.monotonic()
+        for expired in [k for k, (expires_at, _) in self._recent.items() if expires_at <= now]:
+            del self._recent[expired]
+        if not task.cancelled():
+            self._recent[key] = (now + self.outcome_ttl, task)
+
+    @asynccontextmanager
+    async def _worker_lock(self, key: str):
+        """ワーカープロセス間の排他ロック（待たされた場合は True を返す）
+
+        ロックファイルは終了時にロックを持ったまま削除する。削除済みのファイルのロックを
+        得た場合は開き直すので、削除と同時に待っていた別ワーカーと重複して実行しない。
+        """
+        lock_path = os.path.join(self.lock_dir, f"{key}.lock")
+        contended = False
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if not contended:
+                            logger.info(f"Single-flight: waiting for another worker on {key}")
+                        contended = True
+                        await asyncio.sleep(self.poll_interval)
+            except BaseException:
+                os.close(fd)
+                raise
+            if _is_current(fd, lock_path):
+                break
+            os.close(fd)
+        try:
+            yield contended
+        finally:
+            _remove(lock_path)
+            os.close(fd)
+
+    def _error_path(self, key: str) -> str:
+        return os.path.join(self.lock_dir, f"{key}.error")
+
+    def _write_error(self, key: str, e: HTTPException) -> None:
+        """他ワーカーの待機者向けに失敗内容を記録"""
+        try:
+            with open(self._error_path(key), "w") as f:
+                json.dump({"status_code": e.status_code, "detail": e.detail,
+                           "headers": e.headers, "time": time.time()}, f)
+        except OSError as err:
+            logger.error(f"Error recording single-flight failure for {key}: {err}")
+
+    def _clear_error(self, key: str) -> None:
+        _remove(self._error_path(key))
+
+    def _raise_recent_error(self, key: str) -> None:
+        """待機中に別ワーカーが失敗していれば同じエラーを返す"""
+        try:
+            with open(self._error_path(key)) as f:
+                error: Optional[Dict] = json.load(f)
+        except (OSError, ValueError):
+            return
+        if time.time() - error.get("time", 0) <= self.outcome_ttl:
+            raise HTTPException(status_code=error["status_code"], detail=error["detail"],
+                                headers=error.get("headers"))
+
+
+def _is_current(fd: int, path: str) -> bool:
+    """開いているファイルが、まだそのパスにあるか（削除・作り直しされていないか）"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    opened = os.fstat(fd)
+    return (stat.st_dev, stat.st_ino) == (opened.st_dev, opened.st_ino)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def sweep_lock_dir(lock_dir: str = None, outcome_ttl: float = None) -> int:
+    """期限切れの失敗記録と、使われていないロックファイルを削除（削除した数を返す）
+
+    ロックファイルは通常は処理の終了時に消えるが、ワーカーが強制終了すると残る。
+    """
+    lock_dir = lock_dir or config.LOCK_DIR
+    outcome_ttl = outcome_ttl if outcome_ttl is not None else config.SINGLEFLIGHT_OUTCOME_TTL
+    try:
+        names = os.listdir(lock_dir)
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    now = time.time()
+    for name in names:
+        path = os.path.join(lock_dir, name)
+        if name.endswith(".error"):
+            try:
+                expired = now - os.stat(path).st_mtime > outcome_ttl
+            except FileNotFoundError:
+                continue
+            if expired:
+                _remove(path)
+                removed += 1
+        elif name.endswith(".lock"):
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # 開いた直後に他が削除・作り直ししたものは消さない
+                if _is_current(fd, path):
+                    _remove(path)
+                    removed += 1
+            except BlockingIOError:
+                pass
+            finally:
+                os.close(fd)
+    return removed
+
+
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    """プロセス内で共有するSingleFlightを取得"""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
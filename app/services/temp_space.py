@@ -0,0 +1,227 @@
+import os
+import time
+import uuid
+import fcntl
+import shutil
+import asyncio
+import logging
+import tempfile
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+
+import config
+from services.singleflight import sweep_lock_dir
+
+logger = logging.getLogger(__name__)
+
+# TEMP_DIR 直下で管理対象外にするディレクトリ
+WORK_SUBDIR = "work"
+SERVED_SUBDIR = "served"
+LEASE_FILE = ".lease"
+JANITOR_LOCK = ".janitor.lock"
+OVER_QUOTA_MARKER = ".over_quota"  # 全ワーカーに上限超過を知らせる
+
+# 作成直後（リース取得前）の作業ディレクトリを削除しないための猶予（秒）
+_LEASE_GRACE_SECONDS = 60
+
+
+class WorkDir:
+    """リクエスト（ジョブ）ごとの作業ディレクトリ
+
+    使用中は .lease に共有ロックを保持する。ロックはプロセス間で共有されるため、
+    他のワーカーの掃除処理も使用中のディレクトリを削除しない。
+    """
+
+    def __init__(self, space: "TempSpace", path: str):
+        self.space = space
+        self.path = path
+        self._fds: List[int] = []
+        self.acquire()
+
+    def acquire(self) -> "WorkDir":
+        """参照を1つ増やす（送信中のレスポンスなどが保持する）"""
+        fd = os.open(os.path.join(self.path, LEASE_FILE), os.O_RDONLY | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        self._fds.append(fd)
+        return self
+
+    def release(self) -> None:
+        """参照を1つ減らし、誰も使っていなければ削除"""
+        if not self._fds:
+            return
+        os.close(self._fds.pop())
+        if not self._fds:
+            self.space.remove_if_unused(self.path)
+
+    def detach(self, file_path: str) -> str:
+        """作業ディレクトリの削除後も残すファイルを served/ へ移す（送信後に呼び出し側が削除する）"""
+        served_dir = os.path.join(self.space.root, SERVED_SUBDIR)
+        os.makedirs(served_dir, exist_ok=True)
+        dest = os.path.join(served_dir, f"{uuid.uuid4().hex}-{os.path.basename(file_path)}")
+        os.replace(file_path, dest)
+        return dest
+
+    def __enter__(self) -> "WorkDir":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class TempSpace:
+    """一時領域の管理（作業ディレクトリの払い出しと、容量・期限に基づく掃除）"""
+
+    def __init__(self, root: str = None, quota_bytes: int = None, max_age: float = None,
+                 interval: float = None):
+        self.root = root or config.TEMP_DIR
+        self.quota_bytes = quota_bytes if quota_bytes is not None else config.TEMP_QUOTA_BYTES
+        self.max_age = max_age if max_age is not None else config.TEMP_MAX_AGE
+        self.interval = interval if interval is not None else config.TEMP_JANITOR_INTERVAL
+        self.work_root = os.path.join(self.root, WORK_SUBDIR)
+        os.makedirs(self.work_root, exist_ok=True)
+        self.used_bytes = 0
+
+    def workdir(self, prefix: str = "job") -> WorkDir:
+        """新しい作業ディレクトリを作成（with で使うか、release() を呼ぶ）"""
+        # 掃除後も使用中のファイルだけで上限を超えている場合は新しい作業を受け付けない
+        if os.path.exists(os.path.join(self.root, OVER_QUOTA_MARKER)):
+            raise HTTPException(status_code=503, detail="Temporary storage is full",
+                                headers={"Retry-After": str(max(1, int(self.interval)))})
+        path = tempfile.mkdtemp(prefix=f"{prefix}-", dir=self.work_root)
+        return WorkDir(self, path)
+
+    def remove_if_unused(self, path: str) -> bool:
+        """誰もリースを保持していなければディレクトリを削除"""
+        lease = os.path.join(path, LEASE_FILE)
+        try:
+            fd = os.open(lease, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # 削除中に他から参照されないよう、ロックを持ったまま消す
+            shutil.rmtree(path, ignore_errors=True)
+            return True
+        finally:
+            os.close(fd)
+
+    def _candidates(self) -> Tuple[List[Tuple[float, int, str]], int]:
+        """削除候補 (更新時刻, サイズ, パス) と、使用中を含む合計サイズ"""
+        candidates, total = [], 0
+        now = time.time()
+        for base in (self.work_root, os.path.join(self.root, SERVED_SUBDIR), self.root):
+            try:
+                names = os.listdir(base)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                path = os.path.join(base, name)
+                if base == self.root and name in (WORK_SUBDIR, SERVED_SUBDIR, JANITOR_LOCK, OVER_QUOTA_MARKER):
+                    continue
+                if base == self.root and os.path.abspath(path) == os.path.abspath(config.LOCK_DIR):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                size = _tree_bytes(path) if os.path.isdir(path) else stat.st_size
+                total += size
+                in_use = base == self.work_root and (
+                    _lease_held(path) or now - stat.st_mtime < _LEASE_GRACE_SECONDS)
+                if not in_use:
+                    candidates.append((stat.st_mtime, size, path))
+        candidates.sort()
+        return candidates, total
+
+    def sweep(self) -> int:
+        """期限切れのファイルを削除し、上限を超えていれば古い順に削除（削除したバイト数を返す）"""
+        # 同時実行のロック・失敗記録は容量の計算には含めず、不要になったものだけ消す
+        sweep_lock_dir()
+        candidates, total = self._candidates()
+        now = time.time()
+        freed = 0
+        for mtime, size, path in candidates:
+            expired = now - mtime > self.max_age
+            if not expired and total - freed <= self.quota_bytes:
+                continue
+            if self._remove(path):
+                freed += size
+        self.used_bytes = total - freed
+        marker = os.path.join(self.root, OVER_QUOTA_MARKER)
+        if freed:
+            logger.info(f"Temp janitor freed {freed} bytes ({self.used_bytes} bytes in use)")
+        if self.used_bytes > self.quota_bytes:
+            logger.warning(f"Temp space over quota: {self.used_bytes} > {self.quota_bytes} bytes (all in use)")
+            open(marker, "w").close()
+        elif os.path.exists(marker):
+            os.remove(marker)
+        return freed
+
+    def _remove(self, path: str) -> bool:
+        if os.path.isdir(path):
+            if os.path.exists(os.path.join(path, LEASE_FILE)):
+                return self.remove_if_unused(path)
+            shutil.rmtree(path, ignore_errors=True)
+            return True
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    async def run_janitor(self) -> None:
+        """定期的に掃除を行う（複数ワーカーのうち1つだけが実行する）"""
+        lock_path = os.path.join(self.root, JANITOR_LOCK)
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                await asyncio.to_thread(self.sweep)
+            except BlockingIOError:
+                pass
+            except Exception as e:
+                logger.error(f"Error during temp cleanup: {e}")
+            finally:
+                os.close(fd)
+            await asyncio.sleep(self.interval)
+
+
+def _lease_held(path: str) -> bool:
+    lease = os.path.join(path, LEASE_FILE)
+    try:
+        fd = os.open(lease, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+def _tree_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+_temp_space: Optional[TempSpace] = None
+
+
+def get_temp_space() -> TempSpace:
+    """プロセス内で共有するTempSpaceを取得"""
+    global _temp_space
+    if _temp_space is None:
+        _temp_space = TempSpace()
+    return _temp_space
@@ -0,0 +1,254 @@
+import io
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Optional
+
+import config
+from utils.lazy_import import lazy_import
+
+logger = logging.getLogger(__name__)
+
+httpx = lazy_import("httpx")
+Image = lazy_import("PIL.Image")
+
+# 書き込み途中で止まったワーカーの一時ファイルを削除するまでの秒数
+_TMP_MAX_AGE = 3600
+
+
+def center_crop_square(img: "Image.Image") -> "Image.Image":
+    """画像を中央から正方形にクロップ"""
+    width, height = img.size
+    if width == height:
+        return img
+
+    new_size = min(width, height)
+    # 中央を基準にクロップする位置を計算
+    left = (width - new_size) // 2
+    top = (height - new_size) // 2
+    right = left + new_size
+    bottom = top + new_size
+
+    # クロップを実行
+    logger.info(f"Cropping image from {width}x{height} to {new_size}x{new_size}")
+    return img.crop((left, top, right, bottom))
+
+
+def process_cover(data: bytes, size: int) -> bytes:
+    """サムネイルを正方形のJPEGに変換（CPU処理なのでスレッドで実行する）"""
+    img = Image.open(io.BytesIO(data))
+    if size:
+        # JPEGは縮小しながらデコードし、フル解像度での展開を避ける
+        img.draft('RGB', (size, size))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # 画像を正方形にクロップ
+    img = center_crop_square(img)
+    if size and img.width > size:
+        img = img.resize((size, size), Image.LANCZOS, reducing_gap=2.0)
+
+    # JPEG形式で保存
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=95)
+    return output.getvalue()
+
+
+def thumbnail_candidates(info: Dict) -> List[str]:
+    """取得を試すサムネイルURL（優先順、重複なし）"""
+    candidates = [
+        info.get('thumbnail'),
+        f"https://i.ytimg.com/vi/{info['id']}/maxresdefault.jpg",
+        f"https://i.ytimg.com/vi/{info['id']}/hqdefault.jpg",
+        next((t['url'] for t in reversed(info.get('thumbnails') or []) if t.get('url')), None),
+    ]
+    return list(dict.fromkeys(url for url in candidates if url))
+
+
+class ThumbnailFetcher:
+    """サムネイルを非同期に取得し、加工済みカバーをキャッシュする
+
+    カバーはサムネイルのURLごとに1つだけ保存し、動画IDからはそのファイル名を記録した
+    小さな参照ファイルで引く。キャッシュは COVER_CACHE_MAX_BYTES を超えると使われていない順に、
+    COVER_CACHE_MAX_AGE を過ぎたものは常に削除する（書き込むたびにスレッドで行う）。
+    """
+
+    def __init__(self, cache_dir: str = None, size: int = None,
+                 transport: Optional["httpx.AsyncBaseTransport"] = None,
+                 max_bytes: int = None, max_age: float = None):
+        self.cache_dir = cache_dir or config.COVER_CACHE_DIR
+        self.size = config.COVER_SIZE if size is None else size
+        self.max_bytes = max_bytes if max_bytes is not None else config.COVER_CACHE_MAX_BYTES
+        self.max_age = max_age if max_age is not None else config.COVER_CACHE_MAX_AGE
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_client(self) -> "httpx.AsyncClient":
+        # 接続プールはイベントループごとに持つ
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=config.THUMBNAIL_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=config.THUMBNAIL_MAX_CONNECTIONS,
+                                    max_keepalive_connections=config.THUMBNAIL_MAX_CONNECTIONS),
+                transport=self._transport,
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _cache_path(self, kind: str, key: str) -> str:
+        digest = hashlib.sha256(f"{kind}:{key}:{self.size}".encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{digest}.jpg" if kind == "url" else f"{digest}.ref")
+
+    def _read_cache(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # 最終使用時刻として更新時刻を進める（削除は古い順）
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def _read_video_cache(self, video_id: str) -> Optional[bytes]:
+        ref_path = self._cache_path("video", video_id)
+        name = self._read_cache(ref_path)
+        if not name:
+            return None
+        cover = self._read_cache(os.path.join(self.cache_dir, os.path.basename(name.decode("utf-8"))))
+        if cover is None:
+            # 参照先が削除済み
+            self._remove(ref_path)
+        return cover
+
+    def _write_cache(self, path: str, data: bytes) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _store(self, video_id: str, url_path: str, cover: Optional[bytes]) -> None:
+        """カバーをURLのキーで保存し（cover が None なら保存済み）、動画IDからの参照を書いて容量を整理"""
+        if cover is not None:
+            self._write_cache(url_path, cover)
+        self._write_cache(self._cache_path("video", video_id), os.path.basename(url_path).encode("utf-8"))
+        self.evict()
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def evict(self) -> int:
+        """期限切れのカバーと、上限を超えた分を使われていない順に削除（削除したバイト数を返す）"""
+        now = time.time()
+        covers, refs, total = [], [], 0
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".jpg"):
+                covers.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            elif name.endswith(".ref"):
+                refs.append((stat.st_mtime, path))
+            elif name.endswith(".tmp") and now - stat.st_mtime > _TMP_MAX_AGE:
+                self._remove(path)
+
+        freed = 0
+        for mtime, size, path in sorted(covers):
+            if now - mtime <= self.max_age and total - freed <= self.max_bytes:
+                continue
+            if self._remove(path):
+                freed += size
+        # 参照先の無くなった参照ファイルも消す
+        for mtime, path in refs:
+            if now - mtime > self.max_age:
+                self._remove(path)
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    target = os.path.basename(f.read().decode("utf-8"))
+            except (FileNotFoundError, UnicodeDecodeError):
+                continue
+            if not os.path.exists(os.path.join(self.cache_dir, target)):
+                self._remove(path)
+        if freed:
+            logger.info(f"Cover cache freed {freed} bytes ({total - freed} bytes in use)")
+        return freed
+
+    async def get_cover(self, info: Dict) -> Optional[bytes]:
+        """動画のカバー画像（正方形JPEG）を取得"""
+        cached = self._read_video_cache(info['id'])
+        if cached:
+            logger.info(f"Cover cache hit: {info['id']}")
+            return cached
+
+        for url in thumbnail_candidates(info):
+            url_path = self._cache_path("url", url)
+            cover = self._read_cache(url_path)
+            new_cover = None
+            if cover is None:
+                data = await self._download(url)
+                if data is None:
+                    continue
+                try:
+                    cover = await asyncio.to_thread(process_cover, data, self.size)
+                except Exception as e:
+                    logger.warning(f"Could not process thumbnail {url}: {e}")
+                    continue
+                new_cover = cover
+
+            logger.info(f"Selected thumbnail URL: {url}")
+            try:
+                await asyncio.to_thread(self._store, info['id'], url_path, new_cover)
+            except OSError as e:
+                logger.warning(f"Could not cache cover for {info['id']}: {e}")
+            return cover
+
+        logger.warning(f"No usable thumbnail for {info['id']}")
+        return None
+
+    async def _download(self, url: str) -> Optional[bytes]:
+        try:
+            response = await self._get_client().get(url)
+        except httpx.HTTPError as e:
+            logger.warning(f"Error fetching thumbnail {url}: {e}")
+            return None
+        if response.status_code != 200:
+            logger.info(f"Thumbnail not available ({response.status_code}): {url}")
+            return None
+        return response.content
+
+
+_thumbnail_fetcher: Optional[ThumbnailFetcher] = None
+
+
+def get_thumbnail_fetcher() -> ThumbnailFetcher:
+    """プロセス内で共有するThumbnailFetcherを取得"""
+    global _thumbnail_fetcher
+    if _thumbnail_fetcher is None:
+        _thumbnail_fetcher = ThumbnailFetcher()
+    return _thumbnail_fetcher
@@ -0,0 +1,150 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+import config
+from services.metrics import FAILURES
+
+logger = logging.getLogger(__name__)
+
+# 変換枠を確保している処理の中か（run() が同じ枠を二重に取ると、全枠が埋まったときにデッドロックする）
+_holding_slot: ContextVar[bool] = ContextVar("holding_transcode_slot", default=False)
+
+
+class ServerBusyError(HTTPException):
+    """変換待ちが上限に達している（429 + Retry-After）"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail="Server is busy, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.retry_after = retry_after
+
+
+def _cgroup_cpu_limit() -> Optional[float]:
+    """cgroupのCPUクォータ（コア数換算）。制限が無ければ None"""
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus() -> int:
+    """このプロセスが使えるCPU数（affinity と cgroup のクォータを考慮）"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit:
+        cpus = min(cpus, max(1, int(limit)))
+    return max(1, cpus)
+
+
+class TranscodeExecutor:
+    """FFmpeg変換専用の実行器（同時実行数をCPU数に合わせ、待ち行列を制限）"""
+
+    def __init__(self, workers: int = None, max_queue: int = None):
+        # 各ワーカープロセスが同じCPUを使うので、ワーカー数で分ける（全体で同時に動く変換がコア数を超えない）
+        self.workers = workers or config.TRANSCODE_CONCURRENCY or max(1, available_cpus() // config.WEB_CONCURRENCY)
+        self.max_queue = max_queue or config.TRANSCODE_MAX_QUEUE or self.workers * 4
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="transcode")
+        self.running = 0
+        self.queued = 0
+        # 1件あたりの変換時間の推定値（秒、指数移動平均）
+        self.avg_seconds = 30.0
+        logger.info(f"Transcode executor: {self.workers} workers, max queue {self.max_queue}")
+
+    def is_saturated(self) -> bool:
+        return self.running >= self.workers and self.queued >= self.max_queue
+
+    def retry_after(self) -> int:
+        """待ち行列がはけるまでの目安（秒）"""
+        backlog = self.running + self.queued
+        return max(1, math.ceil(self.avg_seconds * backlog / self.workers))
+
+    def check_admission(self) -> None:
+        """新しいリクエストを受け付けられるか確認（満杯なら429）"""
+        if self.is_saturated():
+            retry_after = self.retry_after()
+            logger.warning(f"Transcode queue is full ({self.queued} queued), rejecting with Retry-After {retry_after}")
+            FAILURES.labels('busy').inc()
+            raise ServerBusyError(retry_after)
+
+    @asynccontextmanager
+    async def slot(self):
+        """変換枠を確保（空くまで待つ）"""
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        self.running += 1
+        started = time.monotonic()
+        token = _holding_slot.set(True)
+        try:
+            yield
+        finally:
+            _holding_slot.reset(token)
+            self.running -= 1
+            self._semaphore.release()
+            elapsed = time.monotonic() - started
+            self.avg_seconds = self.avg_seconds * 0.8 + elapsed * 0.2
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """変換処理を専用スレッドプールで実行（枠を確保済みの処理の中ではその枠を使う）"""
+        loop = asyncio.get_running_loop()
+        if _holding_slot.get():
+            return await loop.run_in_executor(self._pool, functools.partial(fn, *args))
+        async with self.slot():
+            return await loop.run_in_executor(self._pool, functools.partial(fn, *args))
+
+    def status(self) -> Dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "avg_seconds": round(self.avg_seconds, 2),
+            "saturated": self.is_saturated(),
+        }
+
+
+_transcode_executor: Optional[TranscodeExecutor] = None
+
+
+def get_transcode_executor() -> TranscodeExecutor:
+    """プロセス内で共有する変換実行器を取得"""
+    global _transcode_executor
+    if _transcode_executor is None:
+        _transcode_executor = TranscodeExecutor()
+    return _transcode_executor
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+from services.profiles import OutputProfile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def mp3_stream_args(source_file: str, bitrate: str) -> List[str]:
+    """標準出力へMP3を書き出すFFmpegの引数
+
+    タグは別途先頭に付けるため、FFmpeg側ではID3/Xingヘッダを書かない。
+    """
+    return [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin',
+        '-i', source_file,
+        '-vn', '-map_metadata', '-1',
+        '-codec:a', 'libmp3lame', '-b:a', f'{bitrate}k',
+        '-id3v2_version', '0', '-write_xing', '0',
+        '-f', 'mp3', 'pipe:1',
+    ]
+
+
+def metadata_args(metadata: Dict[str, str]) -> List[str]:
+    """-metadata key=value の並び（空の値は省略）"""
+    args = []
+    for key, value in metadata.items():
+        if value:
+            args += ['-metadata', f'{key}={value}']
+    return args
+
+
+def mp3_file_args(source_file: str, output_file: str, bitrate: str,
+                  metadata: Dict[str, str], cover_file: Optional[str] = None) -> List[str]:
+    """タグとカバー画像を含めて、1回の書き込みでMP3を生成するFFmpegの引数"""
+    args = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', source_file]
+    if cover_file:
+        args += ['-i', cover_file]
+    args += ['-map', '0:a:0', '-map_metadata', '-1']
+    if cover_file:
+        # カバー画像はID3のAPIC（表紙）として格納される
+        args += [
+            '-map', '1:0', '-c:v', 'copy',
+            '-metadata:s:v', 'title=Cover', '-metadata:s:v', 'comment=Cover (front)',
+        ]
+    args += [
+        '-codec:a', 'libmp3lame', '-b:a', f'{bitrate}k',
+        '-id3v2_version', '3', '-write_id3v1', '0',
+        *metadata_args(metadata),
+        '-f', 'mp3', output_file,
+    ]
+    return args
+
+
+# コンテナごとのFFmpegの出力形式（m4a は iTunes互換の ipod マルチプレクサ）
+_MUXERS = {'mp3': 'mp3', 'm4a': 'ipod', 'opus': 'opus'}
+
+
+def audio_file_args(source_file: str, output_file: str, profile: OutputProfile,
+                    metadata: Dict[str, str], cover_file: Optional[str] = None,
+                    passthrough: bool = False) -> List[str]:
+    """出力プロファイルに合わせてファイルを生成するFFmpegの引数
+
+    passthrough の場合は音声をデコードせず、コンテナの詰め替えだけを行う。
+    Oggにはカバー画像を映像ストリームとして格納できないため、opus では cover_file を無視する。
+    """
+    if profile.codec == 'mp3' and not passthrough:
+        return mp3_file_args(source_file, output_file, profile.quality, metadata, cover_file)
+
+    embed_cover = bool(cover_file) and profile.ext != 'opus'
+    args = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', source_file]
+    if embed_cover:
+        args += ['-i', cover_file]
+    args += ['-map', '0:a:0', '-map_metadata', '-1']
+    if embed_cover:
+        args += ['-map', '1:0', '-c:v', 'copy', '-disposition:v:0', 'attached_pic']
+    if passthrough:
+        args += ['-codec:a', 'copy']
+    else:
+        args += ['-codec:a', profile.encoder, '-b:a', f'{profile.fallback_bitrate}k']
+    args += [
+        *metadata_args(metadata),
+        '-f', _MUXERS[profile.ext], output_file,
+    ]
+    return args
+
+
+async def run_ffmpeg(args: List[str]) -> None:
+    """FFmpegを実行し、終了を待つ"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await process.communicate()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg exited with code {process.returncode}: {stderr.decode(errors='replace').strip()}")
+
+
+async def stream_ffmpeg(args: List[str], chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """FFmpegを起動し、エンコード結果を少しずつ返す"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    # stderrが詰まってFFmpegが止まらないよう並行して読み捨てる
+    stderr_task = asyncio.ensure_future(process.stderr.read())
+    try:
+        while True:
+            chunk = await process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+        returncode = await process.wait()
+        stderr = (await stderr_task).decode(errors='replace').strip()
+        if returncode != 0:
+            raise RuntimeError(f"FFmpeg exited with code {returncode}: {stderr}")
+    finally:
+        if process.returncode is None:
+            # 途中で打ち切られた場合はFFmpegを停止
+            logger.info("Stopping FFmpeg (stream closed before completion)")
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
@@ -0,0 +1,185 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import config
+from services.extractor import AudioExtractor
+from services.metrics import STARTUP_SECONDS
+from utils.lazy_import import load
+
+logger = logging.getLogger(__name__)
+
+# 事前準備の各段階の状態
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# 起動後に読み込んでおく重いモジュール（使う時点まで読み込みを遅らせている — utils/lazy_import.py）
+HEAVY_MODULES = ("yt_dlp", "mutagen.id3", "mutagen.flac", "mutagen.oggopus", "PIL.Image", "httpx")
+
+
+def _process_age() -> float:
+    """プロセスが起動してからの秒数（インタプリタの起動・インポートの時間を含む）"""
+    try:
+        with open("/proc/self/stat") as f:
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - started_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+# プロセスの起動時刻（time.monotonic 基準）
+PROCESS_STARTED = time.monotonic() - _process_age()
+
+
+class WarmupState:
+    """起動後の事前準備（モジュールの読み込み・FFmpegの確認・YoutubeDLの初期化）の状態
+
+    すべての段階が終わるまで /ready は503を返し、ロードバランサーがすぐに処理できない
+    ワーカーへリクエストを送らないようにする。
+    """
+
+    def __init__(self):
+        self.steps: Dict[str, Dict] = {}
+        self.ready_at: Optional[float] = None
+        self.first_success_at: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    async def run(self, steps: List[Tuple[str, Callable[[], Awaitable[None]]]]) -> None:
+        """各段階を順に実行（失敗した段階があれば準備完了にしない）"""
+        for name, _ in steps:
+            self.steps[name] = {"status": PENDING}
+        for name, step in steps:
+            self.steps[name]["status"] = RUNNING
+            started = time.monotonic()
+            try:
+                await step()
+            except Exception as e:
+                logger.error(f"Warm-up step {name} failed: {str(e)}")
+                self.steps[name] = {"status": FAILED, "error": str(e),
+                                    "seconds": round(time.monotonic() - started, 3)}
+                continue
+            self.steps[name] = {"status": DONE, "seconds": round(time.monotonic() - started, 3)}
+
+        if all(step["status"] == DONE for step in self.steps.values()):
+            self.mark_ready()
+
+    def mark_ready(self) -> None:
+        self.ready_at = time.monotonic()
+        seconds = self.ready_at - PROCESS_STARTED
+        STARTUP_SECONDS.labels('ready').set(seconds)
+        logger.info(f"Worker ready {seconds:.2f}s after process start")
+
+    def mark_first_success(self, path: str) -> None:
+        if self.first_success_at is not None:
+            return
+        self.first_success_at = time.monotonic()
+        seconds = self.first_success_at - PROCESS_STARTED
+        STARTUP_SECONDS.labels('first_success').set(seconds)
+        logger.info(f"First successful request ({path}) {seconds:.2f}s after process start")
+
+    def status(self) -> Dict:
+        def since_start(at: Optional[float]) -> Optional[float]:
+            return round(at - PROCESS_STARTED, 3) if at is not None else None
+
+        if self.ready:
+            state = "ready"
+        elif any(step["status"] == FAILED for step in self.steps.values()):
+            state = "failed"
+        else:
+            state = "warming_up"
+        return {
+            "status": state,
+            "steps": self.steps,
+            "uptime": round(time.monotonic() - PROCESS_STARTED, 3),
+            "ready_after": since_start(self.ready_at),
+            "first_success_after": since_start(self.first_success_at),
+        }
+
+
+async def _load_modules() -> None:
+    for name in HEAVY_MODULES:
+        await asyncio.to_thread(load, name)
+
+
+async def _load_extractors() -> None:
+    """yt-dlpのエクストラクタ一覧を読み込む（初回の情報取得で読み込まずに済む）"""
+    yt_dlp = load("yt_dlp")
+    await asyncio.to_thread(yt_dlp.extractor.gen_extractor_classes)
+
+
+async def _probe_ffmpeg() -> None:
+    """FFmpegが実行できるか確認（変換できないワーカーは準備完了にしない）"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-version',
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        raise Exception("ffmpeg not found")
+    if await process.wait() != 0:
+        raise Exception(f"ffmpeg -version exited with {process.returncode}")
+
+
+async def _warm_ydl_pool() -> None:
+    await asyncio.to_thread(AudioExtractor().warm_ydl_pool)
+
+
+def warmup_steps() -> List[Tuple[str, Callable[[], Awaitable[None]]]]:
+    return [
+        ("modules", _load_modules),
+        ("extractors", _load_extractors),
+        ("ffmpeg", _probe_ffmpeg),
+        ("ydl_pool", _warm_ydl_pool),
+    ]
+
+
+async def run_warmup() -> None:
+    """起動後にバックグラウンドで事前準備を行う（WARMUP_ENABLED=0 ならすぐに準備完了にする）"""
+    state = get_warmup_state()
+    if not config.WARMUP_ENABLED:
+        state.mark_ready()
+        return
+    started = time.monotonic()
+    await state.run(warmup_steps())
+    summary = ", ".join(f"{name}={step['status']}" for name, step in state.steps.items())
+    logger.info(f"Warm-up finished in {time.monotonic() - started:.2f}s ({summary})")
+
+
+class FirstSuccessMiddleware:
+    """起動から最初にAPIのリクエストが成功するまでの時間を記録するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        state = get_warmup_state()
+        if scope["type"] != "http" or state.first_success_at is not None or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        async def watching_send(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                state.mark_first_success(scope["path"])
+            await send(message)
+
+        await self.app(scope, receive, watching_send)
+
+
+_warmup_state: Optional[WarmupState] = None
+
+
+def get_warmup_state() -> WarmupState:
+    """プロセス内で共有する事前準備の状態を取得"""
+    global _warmup_state
+    if _warmup_state is None:
+        _warmup_state = WarmupState()
+    return _warmup_state
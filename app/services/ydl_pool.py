@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import config
+from utils.lazy_import import lazy_import
+
+logger = logging.getLogger(__name__)
+
+yt_dlp = lazy_import("yt_dlp")
+
+ProgressHook = Callable[[Dict], None]
+
+
+class _PooledYDL:
+    """プールに置くYoutubeDLと、貸し出し中だけ有効な進捗フック"""
+
+    def __init__(self, opts: Dict):
+        self.ydl = yt_dlp.YoutubeDL(opts)
+        self.progress_hook: Optional[ProgressHook] = None
+        # フックは作成時に1つだけ登録し、貸し出しごとの通知先に転送する
+        self.ydl.add_progress_hook(self._dispatch)
+
+    def _dispatch(self, d: Dict) -> None:
+        if self.progress_hook:
+            self.progress_hook(d)
+
+
+class YoutubeDLPool:
+    """オプションの組み合わせごとに初期化済みのYoutubeDLを貸し出すプール
+
+    YoutubeDLはスレッドセーフではないため、1つのインスタンスは同時に1つの処理にだけ貸し出す。
+    空きが無ければ新しく作り、返却時に max_idle を超えた分は閉じる。
+    """
+
+    def __init__(self, max_idle: int = None):
+        self.max_idle = max_idle or config.YDL_POOL_MAX_IDLE
+        self._idle: Dict[Tuple, List[_PooledYDL]] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+
+    @staticmethod
+    def _key(opts: Dict) -> Tuple:
+        return tuple(sorted((name, repr(value)) for name, value in opts.items()))
+
+    def _take_idle(self, key: Tuple) -> Optional[_PooledYDL]:
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def _create(self, opts: Dict) -> _PooledYDL:
+        pooled = _PooledYDL(opts)
+        with self._lock:
+            self.created += 1
+        return pooled
+
+    def _take(self, key: Tuple, opts: Dict) -> _PooledYDL:
+        return self._take_idle(key) or self._create(opts)
+
+    def _give_back(self, key: Tuple, pooled: _PooledYDL) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(pooled)
+                return
+        pooled.ydl.close()
+
+    @contextmanager
+    def checkout(self, opts: Dict, paths: Dict[str, str] = None,
+                 progress_hook: ProgressHook = None) -> Iterator["yt_dlp.YoutubeDL"]:
+        """YoutubeDLを借りる（with を抜けると返却される）
+
+        paths（保存先）と progress_hook は貸し出し中だけ有効で、プールのキーには含めない。
+        処理中に例外が起きたインスタンスは状態が分からないため返却せずに捨てる。
+        """
+        key = self._key(opts)
+        with self._lend(key, self._take(key, opts), paths, progress_hook) as ydl:
+            yield ydl
+
+    @asynccontextmanager
+    async def acheckout(self, opts: Dict, paths: Dict[str, str] = None,
+                        progress_hook: ProgressHook = None) -> AsyncIterator["yt_dlp.YoutubeDL"]:
+        """checkout の非同期版（空きが無いときのYoutubeDLの作成はスレッドで行い、イベントループを止めない）"""
+        key = self._key(opts)
+        pooled = self._take_idle(key) or await asyncio.to_thread(self._create, opts)
+        with self._lend(key, pooled, paths, progress_hook) as ydl:
+            yield ydl
+
+    @contextmanager
+    def _lend(self, key: Tuple, pooled: _PooledYDL, paths: Optional[Dict[str, str]],
+              progress_hook: Optional[ProgressHook]) -> Iterator["yt_dlp.YoutubeDL"]:
+        pooled.ydl.params['paths'] = dict(paths or {})
+        pooled.progress_hook = progress_hook
+        try:
+            yield pooled.ydl
+        except Exception:
+            pooled.progress_hook = None
+            pooled.ydl.close()
+            raise
+        except BaseException:
+            # キャンセル時は別スレッドがまだ使っている可能性があるため閉じずに手放す
+            pooled.progress_hook = None
+            raise
+        pooled.progress_hook = None
+        pooled.ydl.params['paths'] = {}
+        self._give_back(key, pooled)
+
+    def warm(self, opts: Dict, count: int = 1) -> None:
+        """あらかじめインスタンスを作っておく（起動時に呼ぶ）"""
+        key = self._key(opts)
+        for pooled in [self._take(key, opts) for _ in range(count)]:
+            self._give_back(key, pooled)
+
+    def status(self) -> Dict:
+        with self._lock:
+            idle = sum(len(instances) for instances in self._idle.values())
+        return {"idle": idle, "created": self.created, "profiles": len(self._idle)}
+
+
+_ydl_pool: Optional[YoutubeDLPool] = None
+
+
+def get_ydl_pool() -> YoutubeDLPool:
+    """プロセス内で共有するYoutubeDLプールを取得"""
+    global _ydl_pool
+    if _ydl_pool is None:
+        _ydl_pool = YoutubeDLPool()
+    return _ydl_pool
@@ -0,0 +1,89 @@
+import pytest
+import os
+from services.cache import ResultCache
+from services.extractor import AudioExtractor, TAG_VERSION
+
+
+def _make_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    return path
+
+
+def test_cache_put_and_get(tmp_path):
+    """キャッシュへの登録と参照のテスト"""
+    cache = ResultCache(cache_dir=str(tmp_path / "cache"), max_bytes=1024)
+    src = _make_file(str(tmp_path), "abc.mp3", 100)
+
+    entry = cache.put("abcdefghijk", "mp3", "320", 1, src, {"title": "Song", "filename": "Song.mp3"})
+    assert not os.path.exists(src)
+    assert os.path.exists(entry["path"])
+
+    hit = cache.get("abcdefghijk", "mp3", "320", 1)
+    assert hit["title"] == "Song"
+    assert hit["hits"] == 1
+
+    # プロファイルやタグバージョンが異なればミス
+    assert cache.get("abcdefghijk", "mp3", "128", 1) is None
+    assert cache.get("abcdefghijk", "mp3", "320", 2) is None
+    # アルバムのタグが異なるので、プレイリストの文脈が違えば別のエントリ
+    assert cache.get("abcdefghijk", "mp3", "320", 1, "PL1") is None
+    assert ResultCache.make_key("abcdefghijk", "mp3", "320", 1, "PL1") != ResultCache.make_key(
+        "abcdefghijk", "mp3", "320", 1, "PL2")
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    """容量超過時にLRUで削除されるかのテスト"""
+    cache = ResultCache(cache_dir=str(tmp_path / "cache"), max_bytes=250, policy="lru")
+    for i, video_id in enumerate(["aaaaaaaaaaa", "bbbbbbbbbbb"]):
+        cache.put(video_id, "mp3", "320", 1, _make_file(str(tmp_path), f"{i}.mp3", 100), {})
+    # aaaa を参照して最近使ったことにする
+    assert cache.get("aaaaaaaaaaa", "mp3", "320", 1)
+
+    cache.put("ccccccccccc", "mp3", "320", 1, _make_file(str(tmp_path), "2.mp3", 100), {})
+
+    assert cache.get("bbbbbbbbbbb", "mp3", "320", 1) is None
+    assert cache.get("aaaaaaaaaaa", "mp3", "320", 1) is not None
+    assert cache.total_bytes() <= 250
+
+
+@pytest.mark.asyncio
+async def test_extract_served_from_cache(tmp_path):
+    """キャッシュ済みの動画はダウンロードせずに返すかのテスト"""
+    extractor = AudioExtractor()
+    extractor.cache = ResultCache(cache_dir=str(tmp_path / "cache"))
+    src = _make_file(str(tmp_path), "x.mp3", 10)
+    extractor.cache.put("dQw4w9WgXcQ", extractor.profile.ext, extractor.profile.quality, TAG_VERSION, src,
+                        {"title": "Cached", "filename": "Cached.mp3"})
+
+    result = await extractor.extract("https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+                                     output_dir=str(tmp_path / "album"))
+    assert result["cached"] is True
+    assert result["title"] == "Cached"
+    assert os.path.dirname(result["file_path"]) == str(tmp_path / "album")
+    assert os.path.getsize(result["file_path"]) == 10
+
+
+@pytest.mark.asyncio
+async def test_legacy_etags_are_backfilled_off_the_request_path(tmp_path, monkeypatch):
+    """etag の無い以前のエントリは参照時にハッシュを計算せず、バックグラウンドで埋めるかのテスト"""
+    import services.cache as cache_module
+
+    extractor = AudioExtractor()
+    extractor.cache = ResultCache(cache_dir=str(tmp_path / "cache"))
+    entry = extractor.cache.put("dQw4w9WgXcQ", extractor.profile.ext, extractor.profile.quality, TAG_VERSION,
+                                _make_file(str(tmp_path), "x.mp3", 10), {"title": "Old"})
+    with extractor.cache._connect() as conn:
+        conn.execute("UPDATE entries SET etag = NULL")
+
+    hashed = []
+    original_hash = cache_module.hash_file
+    monkeypatch.setattr(cache_module, "hash_file", lambda path: hashed.append(path) or original_hash(path))
+
+    assert (await extractor.get_cached("https://www.youtube.com/watch?v=dQw4w9WgXcQ"))["etag"] is None
+    assert hashed == []
+
+    assert extractor.cache.backfill_etags() == 1
+    assert (await extractor.get_cached("https://www.youtube.com/watch?v=dQw4w9WgXcQ"))["etag"] == entry["etag"]
+    assert extractor.cache.backfill_etags() == 0
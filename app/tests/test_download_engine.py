@@ -0,0 +1,136 @@
+import os
+import re
+import asyncio
+import pytest
+import httpx
+from services.download_engine import BandwidthBudget, DownloadEngine, HostConnectionLimiter
+
+BODY = bytes(range(256)) * 40  # 10240 bytes
+
+
+def _range_transport(requests, support_ranges=True):
+    """Rangeヘッダに応じて BODY の一部を返すテスト用サーバ"""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.headers.get("range"))
+        match = re.match(r"bytes=(\d+)-(\d+)", request.headers.get("range", ""))
+        if not support_ranges or not match:
+            return httpx.Response(200, content=BODY)
+        start, end = int(match.group(1)), min(int(match.group(2)), len(BODY) - 1)
+        return httpx.Response(206, content=BODY[start:end + 1],
+                              headers={"Content-Range": f"bytes {start}-{end}/{len(BODY)}"})
+
+    return httpx.MockTransport(handler)
+
+
+@pytest.mark.asyncio
+async def test_ranged_fetch_reassembles_file(tmp_path):
+    """範囲に分けて並列に取得したファイルが元と一致するかのテスト"""
+    requests, progress = [], []
+    engine = DownloadEngine(connections=3, chunk_size=1000, transport=_range_transport(requests))
+    path = str(tmp_path / "abc.src.m4a")
+
+    size = await engine._fetch_ranges("https://media.example/audio", {}, path, progress.append)
+    await engine.close()
+
+    assert size == len(BODY)
+    with open(path, "rb") as f:
+        assert f.read() == BODY
+    assert not os.path.exists(f"{path}.part")
+    assert len(requests) == 11  # 先頭 + 残り10範囲
+    assert progress[-1] == {"status": "finished", "downloaded_bytes": len(BODY), "total_bytes": len(BODY)}
+    assert engine.hosts.in_use("media.example") == 0
+
+
+@pytest.mark.asyncio
+async def test_fetch_without_range_support_downloads_once(tmp_path):
+    """Range非対応のサーバからは全体を1回だけ取得するかのテスト"""
+    requests = []
+    engine = DownloadEngine(connections=3, chunk_size=1000,
+                            transport=_range_transport(requests, support_ranges=False))
+    path = str(tmp_path / "abc.src.m4a")
+
+    assert await engine._fetch_ranges("https://media.example/audio", {}, path) == len(BODY)
+    await engine.close()
+
+    with open(path, "rb") as f:
+        assert f.read() == BODY
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_host_limiter_and_bandwidth_budget():
+    """ホストごとの接続数の割り当てと、帯域の均等な配分のテスト"""
+    hosts = HostConnectionLimiter(per_host=4)
+    assert await hosts.acquire("a", 3) == 3
+    assert await hosts.acquire("a", 3) == 1  # 空いている分だけ
+    assert await hosts.acquire("b", 2) == 2  # 別のホストは別枠
+
+    waiting = asyncio.create_task(hosts.acquire("a", 2))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    await hosts.release("a", 3)
+    assert await waiting == 2
+
+    budget = BandwidthBudget(limit=1000)
+    first = budget.open()
+    assert first.rate == 1000
+    second = budget.open()
+    assert first.rate == second.rate == 500
+    budget.close(first)
+    assert second.rate == 1000
+
+
+@pytest.mark.asyncio
+async def test_failed_range_stops_other_connections(tmp_path, monkeypatch):
+    """1つの範囲が失敗したら、他の接続を止めてからファイルを削除するかのテスト"""
+    monkeypatch.setattr("config.DOWNLOAD_CHUNK_RETRIES", 1)
+    requests = []
+    inner = _range_transport(requests)
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.headers.get("range") == "bytes=2000-2999":
+            return httpx.Response(500)
+        await asyncio.sleep(0.01)  # 他の範囲は失敗より後に届く
+        return await inner.handle_async_request(request)
+
+    engine = DownloadEngine(connections=3, chunk_size=1000, transport=httpx.MockTransport(handler))
+    path = str(tmp_path / "abc.src.m4a")
+    tasks_before = len(asyncio.all_tasks())
+
+    with pytest.raises(Exception, match="500"):
+        await engine._fetch_ranges("https://media.example/audio", {}, path)
+
+    assert len(asyncio.all_tasks()) == tasks_before  # 取り残された接続が無い
+    assert not os.path.exists(f"{path}.part")
+    assert engine.hosts.in_use("media.example") == 0
+    assert engine.budget._shares == []
+    await engine.close()
+
+
+@pytest.mark.asyncio
+async def test_download_returns_selected_format(tmp_path):
+    """ダウンロード用の形式指定で選ばれた形式（情報取得時の bestaudio とは違う）を返すかのテスト"""
+    import yt_dlp
+
+    info = {
+        'id': 'dQw4w9WgXcQ', 'title': 'Song', 'extractor': 'youtube', 'extractor_key': 'Youtube',
+        'webpage_url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'acodec': 'opus',
+        'formats': [
+            {'format_id': '140', 'url': 'https://media.example/140', 'ext': 'm4a', 'acodec': 'mp4a.40.2',
+             'vcodec': 'none', 'abr': 128, 'protocol': 'https'},
+            {'format_id': '251', 'url': 'https://media.example/251', 'ext': 'webm', 'acodec': 'opus',
+             'vcodec': 'none', 'abr': 160, 'protocol': 'https'},
+        ],
+    }
+    requests = []
+    engine = DownloadEngine(connections=2, chunk_size=4096, transport=_range_transport(requests))
+    ydl = yt_dlp.YoutubeDL({'format': 'bestaudio[ext=m4a]/bestaudio', 'quiet': True,
+                            'outtmpl': str(tmp_path / '%(id)s.src.%(ext)s')})
+
+    source = await engine.download(ydl, info)
+    await engine.close()
+
+    assert source.path == str(tmp_path / "dQw4w9WgXcQ.src.m4a")
+    assert source.format['acodec'] == 'mp4a.40.2'
+    assert os.path.getsize(source.path) == len(BODY)
@@ -0,0 +1,40 @@
+import time
+import pytest
+from services.info_cache import InfoCache
+
+
+@pytest.mark.asyncio
+async def test_info_cache_is_shared_and_expires(tmp_path):
+    """SQLiteを通じてワーカー間で共有され、期限切れの情報は返さないかのテスト"""
+    db_path = str(tmp_path / "info.db")
+    worker_a = InfoCache(db_path=db_path, ttl=60)
+    worker_b = InfoCache(db_path=db_path, ttl=60)
+
+    await worker_a.set("dQw4w9WgXcQ", {"id": "dQw4w9WgXcQ", "title": "Song", "automatic_captions": {"en": []}})
+    await worker_a.set(("playlist", "PL123"), {})
+    # 使わない大きな項目は共有しない
+    assert await worker_b.get("dQw4w9WgXcQ") == {"id": "dQw4w9WgXcQ", "title": "Song"}
+    assert await worker_b.get(("playlist", "PL123")) == {}
+    assert await worker_b.get("missing0000") is None
+
+    await worker_b.delete("dQw4w9WgXcQ")
+    worker_a.local.delete("dQw4w9WgXcQ")
+    assert await worker_a.get("dQw4w9WgXcQ") is None
+
+    await worker_a.set("shortlived1", {"id": "shortlived1"}, ttl=0.05)
+    time.sleep(0.06)
+    assert await worker_b.get("shortlived1") is None
+    assert await worker_a.get("shortlived1") is None
+
+
+@pytest.mark.asyncio
+async def test_unserializable_info_is_not_shared(tmp_path):
+    """JSONにできない値を含む情報は、別の型に変えて共有せずプロセス内だけで使うかのテスト"""
+    db_path = str(tmp_path / "info.db")
+    worker_a = InfoCache(db_path=db_path, ttl=60)
+    worker_b = InfoCache(db_path=db_path, ttl=60)
+
+    info = {"id": "dQw4w9WgXcQ", "tags": {"a"}}
+    await worker_a.set("dQw4w9WgXcQ", info)
+    assert await worker_a.get("dQw4w9WgXcQ") is info
+    assert await worker_b.get("dQw4w9WgXcQ") is None
@@ -0,0 +1,67 @@
+import pytest
+import asyncio
+import os
+from services.job_store import JobStore, SUCCEEDED, FAILED, QUEUED
+from services.jobs import JobRunner
+from services.extractor import AudioExtractor
+from fastapi import HTTPException
+
+
+@pytest.fixture
+def runner(tmp_path):
+    return JobRunner(store=JobStore(str(tmp_path / "jobs.db")), result_dir=str(tmp_path / "jobs"))
+
+
+async def _wait_for(runner, job_id):
+    for _ in range(100):
+        job = runner.store.get(job_id)
+        if job["status"] in (SUCCEEDED, FAILED):
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+@pytest.mark.asyncio
+async def test_single_job_runs_in_background(runner, monkeypatch):
+    """ジョブが即座に登録され、バックグラウンドで完了するかのテスト"""
+    async def fake_extract(self, url, output_dir=None, progress=None):
+        progress("download", 50.0)
+        await asyncio.sleep(0.02)
+        path = os.path.join(output_dir, "song.mp3")
+        with open(path, "wb") as f:
+            f.write(b"ID3")
+        return {"file_path": path, "filename": "Song.mp3"}
+
+    monkeypatch.setattr(AudioExtractor, "extract", fake_extract)
+    job = runner.submit("single", "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+    assert job["status"] == QUEUED
+
+    job = await _wait_for(runner, job["id"])
+    assert job["status"] == SUCCEEDED
+    assert job["filename"] == "Song.mp3"
+    assert os.path.exists(job["result_path"])
+
+
+@pytest.mark.asyncio
+async def test_failed_job_records_error(runner, monkeypatch):
+    """失敗したジョブにエラー内容が記録されるかのテスト"""
+    async def fake_extract(self, url, output_dir=None, progress=None):
+        raise HTTPException(status_code=400, detail="Video not available")
+
+    monkeypatch.setattr(AudioExtractor, "extract", fake_extract)
+    job = runner.submit("single", "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+    job = await _wait_for(runner, job["id"])
+    assert job["status"] == FAILED
+    assert job["error"] == "Video not available"
+
+
+def test_claim_orphaned_jobs(tmp_path):
+    """停止したワーカーのジョブだけが引き継がれるかのテスト"""
+    store = JobStore(str(tmp_path / "jobs.db"))
+    mine = store.create("single", "https://www.youtube.com/watch?v=aaaaaaaaaaa")
+    orphan = store.create("single", "https://www.youtube.com/watch?v=bbbbbbbbbbb")
+    store.update(orphan["id"], worker="999999:0")
+
+    claimed = store.claim_orphaned()
+    assert [job["id"] for job in claimed] == [orphan["id"]]
+    assert store.get(mine["id"])["status"] == QUEUED
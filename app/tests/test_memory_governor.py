@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+from services.memory_governor import ADMITTED, QUEUED, REJECTED, MemoryGovernor, ReservationLedger
+from services.transcode_executor import ServerBusyError
+
+MB = 1024 ** 2
+
+
+def _governor(monkeypatch, observed=100 * MB, **kwargs):
+    governor = MemoryGovernor(limit=500 * MB, high_water=0.8,
+                              costs={"single": 100 * MB, "playlist": 250 * MB}, **kwargs)
+    monkeypatch.setattr(governor, "observed", lambda: observed)
+    return governor
+
+
+@pytest.mark.asyncio
+async def test_admits_until_high_water_then_queues(monkeypatch):
+    """見積もりの合計が上限を超える処理は、空くまで待たせるかのテスト"""
+    governor = _governor(monkeypatch, queue_timeout=5)
+    first = await governor.acquire("single")
+    second = await governor.acquire("single")  # 100 + 200 + 100 <= 400
+    assert governor.reserved == 200 * MB
+
+    waiting = asyncio.create_task(governor.acquire("playlist"))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    assert (await governor.status())["queued"] == 1
+
+    await first.release()
+    await first.release()  # 二重に呼んでも1回分だけ
+    await asyncio.sleep(0.01)
+    assert not waiting.done()  # 100 + 100 + 250 > 400
+    await second.release()
+    third = await asyncio.wait_for(waiting, 1)
+
+    assert governor.running == {"playlist": 1}
+    assert [d["decision"] for d in governor.decisions] == [ADMITTED, ADMITTED, QUEUED, ADMITTED]
+    await third.release()
+    assert governor.reserved == 0 and governor.running == {}
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_queue_is_full_or_wait_times_out(monkeypatch):
+    """待ち行列が満杯、または待ちきれない場合に429で断るかのテスト"""
+    governor = _governor(monkeypatch, max_queue=1, queue_timeout=0.05)
+    reservation = await governor.acquire("playlist")
+
+    with pytest.raises(ServerBusyError):
+        await governor.acquire("playlist", wait=False)
+    with pytest.raises(ServerBusyError) as exc:
+        await governor.acquire("playlist")
+    assert exc.value.status_code == 429
+    assert exc.value.headers["Retry-After"]
+    assert (await governor.status())["queued"] == 0
+    assert governor.decisions[-1]["decision"] == REJECTED
+    await reservation.release()
+
+
+@pytest.mark.asyncio
+async def test_admits_one_oversized_job_when_idle(monkeypatch):
+    """何も実行していなければ、見積もりが上限を超える処理も1件は通すかのテスト"""
+    governor = _governor(monkeypatch, queue_timeout=0)
+    governor.costs["playlist"] = 600 * MB
+    reservation = await governor.acquire("playlist")
+    with pytest.raises(ServerBusyError):
+        await governor.acquire("single")
+    await reservation.release()
+
+    busy = _governor(monkeypatch, observed=450 * MB, queue_timeout=0)
+    with pytest.raises(ServerBusyError):
+        await busy.acquire("single")
+
+
+@pytest.mark.asyncio
+async def test_reservations_are_shared_between_workers(monkeypatch, tmp_path):
+    """他のワーカーの予約も数え、合わせて上限を超える処理は受け付けないかのテスト"""
+    ledger = ReservationLedger(str(tmp_path / "memory.db"))
+    workers = [_governor(monkeypatch, queue_timeout=0, ledger=ledger) for _ in range(2)]
+
+    first = await workers[0].acquire("single")
+    second = await workers[1].acquire("single")  # 100 + 100 + 100 <= 400
+    assert await workers[1].total_reserved() == 200 * MB
+    with pytest.raises(ServerBusyError):
+        await workers[1].acquire("playlist")  # 自分の予約は 100MB だけでも、全体では入らない
+
+    await first.release()
+    await second.release()
+    assert ledger.total() == 0
+    third = await workers[1].acquire("playlist")
+    assert await workers[0].total_reserved() == 250 * MB
+    await third.release()
@@ -0,0 +1,76 @@
+import asyncio
+import os
+from services.cache import ResultCache
+from services.extractor import AudioExtractor, TAG_VERSION
+from services.playlist_sync import PlaylistManifestStore, album_sync_entries, plan_sync
+
+
+def _extractor(tmp_path, converted):
+    """変換のたびにキャッシュへ登録する（変換した動画IDを converted に記録）"""
+    extractor = AudioExtractor()
+    extractor.cache = ResultCache(cache_dir=str(tmp_path / "cache"))
+
+    async def fake_iter_extract_many(urls, output_dir=None, concurrency=None):
+        for url in urls:
+            video_id = url.rsplit("=", 1)[-1]
+            converted.append(video_id)
+            src = tmp_path / f"{video_id}.mp3"
+            src.write_bytes(b"ID3" + video_id.encode())
+            entry = extractor.cache.put(video_id, "mp3", "320", TAG_VERSION, str(src),
+                                        {"title": f"Song {video_id[0]}"})
+            yield {"title": entry["title"], "file_path": extractor.cache.materialize(entry, output_dir),
+                   "cache_key": entry["key"], "etag": entry["etag"]}
+
+    extractor.iter_extract_many = fake_iter_extract_many
+    return extractor
+
+
+def _sync(extractor, store, ids, output_dir, delta=False):
+    playlist_info = {"title": "Album", "entries": [{"id": video_id} for video_id in ids]}
+    plan = plan_sync(extractor, "PL1", playlist_info, store.load("PL1", extractor.profile.name))
+
+    async def collect():
+        return [path async for _, path in album_sync_entries(extractor, plan, "Album", output_dir,
+                                                             delta=delta, store=store)]
+    return plan, asyncio.run(collect())
+
+
+def test_sync_converts_only_new_entries(tmp_path):
+    """2回目の同期では増えた曲だけを変換し、delta では新しい曲だけを返すかのテスト"""
+    converted = []
+    extractor = _extractor(tmp_path, converted)
+    store = PlaylistManifestStore(manifest_dir=str(tmp_path / "manifests"))
+    output_dir = str(tmp_path / "out")
+    os.makedirs(output_dir)
+
+    plan, archived = _sync(extractor, store, ["aaaaaaaaaaa", "bbbbbbbbbbb"], output_dir)
+    assert plan.pending == ["aaaaaaaaaaa", "bbbbbbbbbbb"]
+    assert archived == ["Album/Song a.mp3", "Album/Song b.mp3"]
+
+    plan, archived = _sync(extractor, store, ["ccccccccccc", "aaaaaaaaaaa", "bbbbbbbbbbb"], output_dir)
+    assert plan.pending == ["ccccccccccc"]
+    assert archived == ["Album/Song c.mp3", "Album/Song a.mp3", "Album/Song b.mp3"]
+    assert converted == ["aaaaaaaaaaa", "bbbbbbbbbbb", "ccccccccccc"]
+
+    plan, archived = _sync(extractor, store, ["ddddddddddd", "ccccccccccc", "aaaaaaaaaaa"], output_dir, delta=True)
+    assert plan.removed == ["bbbbbbbbbbb"]
+    assert archived == ["Album/Song d.mp3"]
+    manifest = store.load("PL1", extractor.profile.name)
+    assert [entry["video_id"] for entry in manifest["entries"]] == ["ddddddddddd", "ccccccccccc", "aaaaaaaaaaa"]
+
+
+def test_sync_reconverts_evicted_entries(tmp_path):
+    """キャッシュから消えた曲は再変換し、内容が同じなら delta に含めないかのテスト"""
+    converted = []
+    extractor = _extractor(tmp_path, converted)
+    store = PlaylistManifestStore(manifest_dir=str(tmp_path / "manifests"))
+    output_dir = str(tmp_path / "out")
+    os.makedirs(output_dir)
+
+    _sync(extractor, store, ["aaaaaaaaaaa"], output_dir)
+    os.remove(extractor.cache.get("aaaaaaaaaaa", "mp3", "320", TAG_VERSION)["path"])
+
+    plan, archived = _sync(extractor, store, ["aaaaaaaaaaa"], output_dir, delta=True)
+    assert plan.pending == ["aaaaaaaaaaa"]
+    assert archived == []
+    assert converted == ["aaaaaaaaaaa", "aaaaaaaaaaa"]
@@ -0,0 +1,133 @@
+import asyncio
+import pytest
+import config
+import services.memory_governor as memory_governor
+import services.transcode_executor as transcode_executor
+from services.memory_governor import MemoryGovernor
+from services.prefetch import PrefetchItem, PrefetchQueue
+from services.transcode_executor import TranscodeExecutor
+
+MB = 1024 ** 2
+
+
+@pytest.fixture
+def idle_server(monkeypatch):
+    """変換待ちが無く、メモリにも余裕がある状態"""
+    governor = MemoryGovernor(limit=500 * MB, high_water=0.8, costs={"single": 100 * MB})
+    monkeypatch.setattr(governor, "observed", lambda: 100 * MB)
+    monkeypatch.setattr(memory_governor, "_memory_governor", governor)
+    monkeypatch.setattr(transcode_executor, "_transcode_executor", TranscodeExecutor(workers=2, max_queue=4))
+    monkeypatch.setattr(config, "PREFETCH_IDLE_POLL", 0.05)
+
+
+async def _until(condition, timeout=1.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+@pytest.mark.asyncio
+async def test_prefetch_waits_for_idle_and_is_preempted(idle_server):
+    """対話的な処理の間は始めず、割り込まれたら中止して先頭に戻すかのテスト"""
+    started, finished = [], []
+    release = asyncio.Event()
+
+    async def runner(item):
+        started.append(item.video_id)
+        await release.wait()
+        finished.append(item.video_id)
+        return True
+
+    queue = PrefetchQueue(max_queue=10, concurrency=1)
+    worker = asyncio.create_task(queue.run(runner))
+    try:
+        with queue.foreground():
+            queue.enqueue([PrefetchItem("aaaaaaaaaaa", "mp3-320"), PrefetchItem("bbbbbbbbbbb", "mp3-320")])
+            await asyncio.sleep(0.1)
+            assert started == []  # 対話的な処理の間は始めない
+
+        await _until(lambda: started == ["aaaaaaaaaaa"])
+        with queue.foreground():
+            await _until(lambda: not queue._running)
+            # 中止したものは次に最初にやり直す
+            assert [item.video_id for item in queue._queue] == ["aaaaaaaaaaa", "bbbbbbbbbbb"]
+            assert memory_governor._memory_governor.reserved == 0
+
+        release.set()
+        await _until(lambda: finished == ["aaaaaaaaaaa", "bbbbbbbbbbb"])
+        assert started == ["aaaaaaaaaaa", "aaaaaaaaaaa", "bbbbbbbbbbb"]
+    finally:
+        worker.cancel()
+
+
+def test_enqueue_following_and_limits(monkeypatch):
+    """プレイリストの後続の曲を追加し、重複は入れず、あふれたら古いものを捨てるかのテスト"""
+    monkeypatch.setattr(config, "PREFETCH_ENABLED", True)
+    monkeypatch.setattr(config, "PREFETCH_PLAYLIST_AHEAD", 2)
+    queue = PrefetchQueue(max_queue=3, concurrency=1)
+    playlist = ["v1", "v2", "v3", "v4", "v5"]
+
+    assert queue.enqueue_following("v2", playlist, "opus", "PL1") == 2
+    assert queue.enqueue_following("v2", playlist, "opus", "PL1") == 0
+    assert queue.enqueue_following("v5", playlist, "opus") == 0  # 最後の曲
+    assert queue.enqueue_following("other", playlist, "opus") == 0
+    # アルバムのタグが後のリクエストと同じになるよう、プレイリストの文脈を残す
+    assert list(queue._queue) == [PrefetchItem("v3", "opus", "PL1"), PrefetchItem("v4", "opus", "PL1")]
+
+    queue.enqueue_following("v4", playlist, "opus", "PL1")
+    queue.enqueue_following("v4", playlist, "mp3-320", "PL1")
+    assert [(item.video_id, item.profile) for item in queue._queue] == [
+        ("v4", "opus"), ("v5", "opus"), ("v5", "mp3-320")]
+
+
+def test_prefetch_endpoint_skips_cached(client, monkeypatch):
+    """変換済みの動画は待ち行列に入れず、不正なURLは数だけ返すかのテスト"""
+    import services.prefetch as prefetch
+    from services.extractor import AudioExtractor
+
+    queue = PrefetchQueue(max_queue=10, concurrency=1)
+    monkeypatch.setattr(prefetch, "_prefetch_queue", queue)
+    monkeypatch.setattr(config, "PREFETCH_ENABLED", True)
+    async def fake_get_cached(self, url):
+        return {"cached": True} if "cachedvideo" in url else None
+
+    monkeypatch.setattr(AudioExtractor, "get_cached", fake_get_cached)
+
+    response = client.post("/api/v1/prefetch", json={
+        "urls": ["dQw4w9WgXcQ", "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "cachedvideo",
+                 "https://example.com/not-youtube"],
+        "profile": "opus",
+    })
+    assert response.status_code == 202
+    assert response.json() == {"queued": 1, "cached": 1, "invalid": 1}
+    assert list(queue._queue) == [PrefetchItem("dQw4w9WgXcQ", "opus")]
+
+    assert client.post("/api/v1/prefetch", json={"urls": ["dQw4w9WgXcQ"], "profile": "auto"}).status_code == 400
+    assert client.get("/api/v1/prefetch/status").json()["queued"] == [
+        {"video_id": "dQw4w9WgXcQ", "profile": "opus", "playlist_id": None}]
+
+
+@pytest.mark.asyncio
+async def test_busy_prefetch_is_deferred_not_dropped(idle_server):
+    """混んでいて断られた先読みは失敗として捨てず、待ち行列に戻してやり直すかのテスト"""
+    from services.transcode_executor import ServerBusyError
+
+    attempts = []
+
+    async def runner(item):
+        attempts.append(item.video_id)
+        if len(attempts) == 1:
+            raise ServerBusyError(5)
+        return True
+
+    queue = PrefetchQueue(max_queue=10, concurrency=1)
+    worker = asyncio.create_task(queue.run(runner))
+    try:
+        queue.enqueue([PrefetchItem("aaaaaaaaaaa", "mp3-320")])
+        await _until(lambda: len(attempts) == 2)
+        await _until(lambda: not queue._running)
+        assert list(queue._queue) == []
+    finally:
+        worker.cancel()
@@ -0,0 +1,93 @@
+import os
+import pytest
+from fastapi import HTTPException
+from services.download_engine import DownloadedSource
+from services.extractor import AudioExtractor
+from services.profiles import PROFILES, accepted_profiles, choose_auto_profile, get_profile
+from services.transcoder import audio_file_args
+
+
+def test_get_profile():
+    """プロファイル名の解決（別名・不明な名前）のテスト"""
+    assert get_profile("mp3").name == "mp3-320"
+    assert get_profile(None).name == "mp3-320"
+    assert get_profile("opus").media_type == "audio/ogg"
+    with pytest.raises(HTTPException) as exc:
+        get_profile("flac")
+    assert exc.value.status_code == 400
+
+
+def test_auto_profile_selection():
+    """Acceptヘッダとフォーマット一覧からパススルー可能なものを選ぶかのテスト"""
+    assert accepted_profiles(None) == ["mp3-320"]
+    assert accepted_profiles("audio/mp4, audio/ogg;q=0.9") == ["opus", "m4a", "mp3-320"]
+    # q=0 は受け付けないという意味。部分一致（audio/oggvorbis など）でも選ばない
+    assert accepted_profiles("audio/ogg;q=0, audio/mp4") == ["m4a", "mp3-320"]
+    assert accepted_profiles("audio/ogg; q=0.0") == ["mp3-320"]
+    assert accepted_profiles("audio/oggvorbis") == ["mp3-320"]
+
+    info = {"formats": [
+        {"acodec": "mp4a.40.2", "vcodec": "none"},
+        {"acodec": "opus", "vcodec": "avc1"},  # 映像付きは対象外
+    ]}
+    assert choose_auto_profile(["opus", "m4a", "mp3-320"], info).name == "m4a"
+    assert choose_auto_profile(["opus", "mp3-320"], info).name == "mp3-320"
+
+
+def test_audio_file_args_passthrough():
+    """パススルー時は再エンコードせずにコンテナだけ詰め替えるかのテスト"""
+    args = audio_file_args("in.m4a", "out.m4a", PROFILES["m4a"], {"title": "Song"}, "cover.jpg",
+                           passthrough=True)
+    assert args[args.index("-codec:a") + 1] == "copy"
+    assert "-b:a" not in args
+    assert args[args.index("-disposition:v:0") + 1] == "attached_pic"
+    assert args[-3:] == ["-f", "ipod", "out.m4a"]
+
+    # コーデックが違う場合は再エンコード（Oggには画像ストリームを入れない）
+    args = audio_file_args("in.m4a", "out.opus", PROFILES["opus"], {}, "cover.jpg")
+    assert args[args.index("-codec:a") + 1] == "libopus"
+    assert "cover.jpg" not in args
+
+
+@pytest.mark.asyncio
+async def test_download_and_convert_passthrough(monkeypatch, tmp_path):
+    """ダウンロード時に選ばれた形式のコーデックが同じならコピーで出力し、拡張子もプロファイルに合わせるかのテスト"""
+    import services.extractor as extractor_module
+
+    extractor = AudioExtractor(profile="m4a")
+    extractor.temp_dir = str(tmp_path)
+    ffmpeg_calls = []
+    selected = {'acodec': 'mp4a.40.2'}
+
+    async def fake_download(info, work_dir=None, progress=None):
+        path = tmp_path / "dQw4w9WgXcQ.src.m4a"
+        path.write_bytes(b"m4a")
+        return DownloadedSource(str(path), selected)
+
+    async def fake_cover(info):
+        return None
+
+    async def fake_run_ffmpeg(args):
+        ffmpeg_calls.append(args)
+        with open(args[-1], "wb") as f:
+            f.write(b"m4a")
+
+    monkeypatch.setattr(extractor, "_download_source", fake_download)
+    monkeypatch.setattr(extractor, "_fetch_cover_image", fake_cover)
+    monkeypatch.setattr(extractor_module, "run_ffmpeg", fake_run_ffmpeg)
+
+    # 情報取得時の選択（bestaudio = opus）ではなく、プロファイルの形式で選ばれた aac を見る
+    output = await extractor._download_and_convert({'id': 'dQw4w9WgXcQ', 'title': 'Song', 'acodec': 'opus'})
+
+    assert ffmpeg_calls[0][ffmpeg_calls[0].index("-codec:a") + 1] == "copy"
+    assert os.listdir(tmp_path) == ["dQw4w9WgXcQ.m4a"]
+    assert output.endswith(".m4a")
+
+    # 拡張子が同じでも、選ばれた形式のコーデックが違えば再エンコードする
+    extractor = AudioExtractor(profile="opus")
+    extractor.temp_dir = str(tmp_path)
+    monkeypatch.setattr(extractor, "_download_source", fake_download)
+    monkeypatch.setattr(extractor, "_fetch_cover_image", fake_cover)
+    selected['acodec'] = 'vorbis'
+    await extractor._download_and_convert({'id': 'dQw4w9WgXcQ', 'title': 'Song', 'acodec': 'opus'})
+    assert ffmpeg_calls[1][ffmpeg_calls[1].index("-codec:a") + 1] == "libopus"
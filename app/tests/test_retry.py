@@ -0,0 +1,97 @@
+import os
+import pytest
+from fastapi import HTTPException
+from services.download_engine import DownloadedSource
+from services.extractor import AudioExtractor
+from services.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, run_stage
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    import config
+    monkeypatch.setattr(config, "RETRY_BASE_DELAY", 0)
+
+
+@pytest.mark.asyncio
+async def test_transcode_retry_keeps_downloaded_source(monkeypatch, tmp_path):
+    """変換の失敗では変換だけをやり直し、再ダウンロードしないかのテスト"""
+    import services.extractor as extractor_module
+
+    extractor = AudioExtractor()
+    downloads, ffmpeg_calls = [], []
+
+    async def fake_download(info, work_dir=None, progress=None):
+        downloads.append(info['id'])
+        path = tmp_path / "dQw4w9WgXcQ.src.webm"
+        path.write_bytes(b"webm")
+        return DownloadedSource(str(path), {'acodec': 'opus'})
+
+    async def fake_cover(info):
+        return None
+
+    async def flaky_ffmpeg(args):
+        ffmpeg_calls.append(args)
+        if len(ffmpeg_calls) == 1:
+            raise RuntimeError("ffmpeg crashed")
+        with open(args[-1], "wb") as f:
+            f.write(b"ID3mp3")
+
+    monkeypatch.setattr(extractor, "_download_source", fake_download)
+    monkeypatch.setattr(extractor, "_fetch_cover_image", fake_cover)
+    monkeypatch.setattr(extractor_module, "run_ffmpeg", flaky_ffmpeg)
+
+    output = await extractor._download_and_convert({'id': 'dQw4w9WgXcQ', 'title': 'Song'}, work_dir=str(tmp_path))
+
+    assert downloads == ['dQw4w9WgXcQ']
+    assert len(ffmpeg_calls) == 2
+    assert os.listdir(tmp_path) == ["dQw4w9WgXcQ.mp3"]
+    assert open(output, "rb").read() == b"ID3mp3"
+
+
+@pytest.mark.asyncio
+async def test_permanent_errors_are_not_retried():
+    """非公開動画などのエラーは再試行しないかのテスト"""
+    calls = []
+
+    async def private_video(attempt):
+        calls.append(attempt)
+        raise HTTPException(status_code=400, detail="Video not available: Private video")
+
+    with pytest.raises(HTTPException):
+        await run_stage('metadata', private_video, RetryPolicy(attempts=3))
+    assert calls == [0]
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast_and_recovers(monkeypatch):
+    """連続失敗で遮断し、一定時間後の1件が成功すれば戻るかのテスト"""
+    import services.retry as retry_module
+
+    now = [1000.0]
+    monkeypatch.setattr(retry_module.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    calls = []
+
+    async def upstream_down(attempt):
+        calls.append(attempt)
+        raise RuntimeError("HTTP Error 503")
+
+    with pytest.raises(HTTPException):
+        await run_stage('download', upstream_down, RetryPolicy(attempts=3), breaker)
+    assert len(calls) == 2  # 2回目の失敗で遮断され、3回目は試さない
+    assert breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError) as exc_info:
+        await run_stage('download', upstream_down, RetryPolicy(attempts=3), breaker)
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers["Retry-After"] == "30"
+    assert len(calls) == 2
+
+    now[0] += 30
+    assert breaker.state == "half-open"
+
+    async def upstream_ok(attempt):
+        return "ok"
+
+    assert await run_stage('download', upstream_ok, RetryPolicy(attempts=3), breaker) == "ok"
+    assert breaker.state == "closed"
@@ -32,4 +32,224 @@ def test_extract_audio_success(client, sample_youtube_url):
         json={"url": sample_youtube_url}
     )
     assert response.status_code == 200
-    assert response.headers["content-type"] == "audio/mpeg"
\ No newline at end of file
+    assert response.headers["content-type"] == "audio/mpeg"
+
+def test_extract_album_streams_zip_in_playlist_order(client, monkeypatch, tmp_path):
+    """アルバムのZIPがプレイリスト順にストリーミングされるかのテスト"""
+    import io
+    import zipfile
+    from services.extractor import AudioExtractor
+
+    async def fake_playlist_info(self, url):
+        return {"title": "My Album", "entries": [{"id": "aaaaaaaaaaa"}, {"id": "bbbbbbbbbbb"}, {"id": "ccccccccccc"}]}
+
+    async def fake_iter_extract_many(self, urls, output_dir=None, concurrency=None):
+        for i, url in enumerate(urls):
+            if i == 1:
+                yield None  # 失敗した曲はスキップされる
+                continue
+            path = tmp_path / f"{i}.mp3"
+            path.write_bytes(b"ID3" + bytes([i]) * 10)
+            yield {"title": f"Track {i}", "file_path": str(path)}
+
+    monkeypatch.setattr(AudioExtractor, "get_playlist_info", fake_playlist_info)
+    monkeypatch.setattr(AudioExtractor, "iter_extract_many", fake_iter_extract_many)
+
+    response = client.post(
+        "/api/v1/extract-album",
+        json={"url": "https://www.youtube.com/watch?v=aaaaaaaaaaa&list=PL123"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zipf:
+        assert zipf.namelist() == ["My Album/Track 0.mp3", "My Album/Track 2.mp3"]
+
+
+async def _not_cached(self, url):
+    return None
+
+
+def test_extract_audio_returns_429_when_saturated(client, monkeypatch):
+    """変換待ちが満杯のとき、すぐに429とRetry-Afterを返すかのテスト"""
+    import routes.audio as audio_routes
+    from services.extractor import AudioExtractor
+    from services.transcode_executor import ServerBusyError
+
+    class BusyExecutor:
+        def check_admission(self):
+            raise ServerBusyError(12)
+
+    monkeypatch.setattr(AudioExtractor, "get_cached", _not_cached)
+    monkeypatch.setattr(audio_routes, "get_transcode_executor", lambda: BusyExecutor())
+
+    response = client.post(
+        "/api/v1/extract-audio",
+        json={"url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ"}
+    )
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "12"
+
+
+def test_metrics_endpoint(client, monkeypatch, tmp_path):
+    """段階ごとの所要時間と送信バイト数が /metrics に出るかのテスト"""
+    from services.extractor import AudioExtractor
+
+    async def fake_playlist_info(self, url):
+        return {"title": "Metrics Album", "entries": [{"id": "aaaaaaaaaaa"}]}
+
+    async def fake_iter_extract_many(self, urls, output_dir=None, concurrency=None):
+        path = tmp_path / "0.mp3"
+        path.write_bytes(b"ID3" * 10)
+        yield {"title": "Track", "file_path": str(path)}
+
+    monkeypatch.setattr(AudioExtractor, "get_playlist_info", fake_playlist_info)
+    monkeypatch.setattr(AudioExtractor, "iter_extract_many", fake_iter_extract_many)
+    client.post("/api/v1/extract-album",
+                json={"url": "https://www.youtube.com/watch?v=aaaaaaaaaaa&list=PL123"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert 'ytdlp_stage_duration_seconds_count{stage="zip"}' in body
+    assert 'ytdlp_bytes_served_total{endpoint="extract_album"}' in body
+    assert "ytdlp_temp_dir_bytes" in body
+
+
+def test_artifact_supports_range_and_etag(client, monkeypatch, tmp_path):
+    """変換済みファイルの安定URLがRangeとETagに対応しているかのテスト"""
+    import routes.audio as audio_routes
+    from services.cache import ResultCache
+
+    cache = ResultCache(cache_dir=str(tmp_path / "cache"))
+    src = tmp_path / "song.mp3"
+    src.write_bytes(bytes(range(256)) * 4)
+    entry = cache.put("dQw4w9WgXcQ", "mp3", "320", 1, str(src), {"title": "Song", "filename": "Song.mp3"})
+    monkeypatch.setattr(audio_routes, "get_result_cache", lambda: cache)
+    url = f"/api/v1/artifacts/{entry['key']}"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "audio/mpeg"
+    assert response.headers["accept-ranges"] == "bytes"
+    etag = response.headers["etag"]
+    assert etag == f'"{entry["etag"]}"'
+
+    response = client.get(url, headers={"Range": "bytes=1000-"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 1000-1023/1024"
+    assert response.content == bytes(range(232, 256))
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={"Range": "bytes=5000-"}).status_code == 416
+    # If-Range が一致しなければ全体を返す
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert response.status_code == 200 and len(response.content) == 1024
+    # 弱いETagでは部分を返さない
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": f"W/{etag}"})
+    assert response.status_code == 200 and len(response.content) == 1024
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206 and len(response.content) == 10
+
+    response = client.head(url)
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "1024"
+    assert client.get("/api/v1/artifacts/unknown").status_code == 404
+
+
+def _fake_batch_extract(calls, tmp_path):
+    from fastapi import HTTPException
+
+    async def fake_extract(self, url, output_dir=None, progress=None):
+        video_id = url.rsplit("=", 1)[-1]
+        calls.append(video_id)
+        if video_id == "bbbbbbbbbbb":
+            raise HTTPException(status_code=400, detail="Video not available")
+        path = tmp_path / f"{video_id}.mp3"
+        path.write_bytes(b"ID3" + video_id.encode())
+        return {"video_id": video_id, "title": f"Track {video_id[0]}", "file_path": str(path),
+                "filename": f"Track {video_id[0]}.mp3", "media_type": "audio/mpeg",
+                "cache_key": f"key-{video_id}", "etag": "abc"}
+    return fake_extract
+
+
+def test_extract_batch_ndjson_dedupes_and_reports_errors(client, monkeypatch, tmp_path):
+    """重複URLを1回にまとめ、個別の失敗を1行ずつ返すかのテスト"""
+    import json
+    from services.extractor import AudioExtractor
+
+    calls = []
+    monkeypatch.setattr(AudioExtractor, "extract", _fake_batch_extract(calls, tmp_path))
+    monkeypatch.setattr(AudioExtractor, "get_cached", _not_cached)
+
+    response = client.post("/api/v1/extract-batch", json={"format": "ndjson", "urls": [
+        "https://www.youtube.com/watch?v=aaaaaaaaaaa",
+        "https://youtu.be/aaaaaaaaaaa",
+        "https://www.youtube.com/watch?v=bbbbbbbbbbb",
+        "https://example.com/not-a-video",
+    ]})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    assert sorted(calls) == ["aaaaaaaaaaa", "bbbbbbbbbbb"]
+    by_id = {line.get("video_id"): line for line in lines[:-1]}
+    assert by_id["aaaaaaaaaaa"]["index"] == [0, 1]
+    assert by_id["aaaaaaaaaaa"]["artifact_url"] == "/api/v1/artifacts/key-aaaaaaaaaaa"
+    assert by_id["bbbbbbbbbbb"]["status"] == "error"
+    assert by_id["bbbbbbbbbbb"]["error"] == "Video not available"
+    assert by_id[None]["index"] == [3]
+    assert lines[-1] == {"status": "done", "total": 4, "succeeded": 2, "failed": 2}
+
+
+def test_extract_batch_zip_includes_errors(client, monkeypatch, tmp_path):
+    """ZIPに成功した曲と失敗一覧（errors.json）が入るかのテスト"""
+    import io
+    import json
+    import zipfile
+    from services.extractor import AudioExtractor
+
+    calls = []
+    monkeypatch.setattr(AudioExtractor, "extract", _fake_batch_extract(calls, tmp_path))
+    monkeypatch.setattr(AudioExtractor, "get_cached", _not_cached)
+
+    response = client.post("/api/v1/extract-batch", json={"urls": [
+        "https://www.youtube.com/watch?v=aaaaaaaaaaa",
+        "https://www.youtube.com/watch?v=bbbbbbbbbbb",
+    ]})
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zipf:
+        assert sorted(zipf.namelist()) == ["Track a.mp3", "errors.json"]
+        errors = json.loads(zipf.read("errors.json"))
+    assert [e["video_id"] for e in errors] == ["bbbbbbbbbbb"]
+
+
+def test_extract_audio_reextracts_when_cached_file_vanishes(client, monkeypatch, tmp_path):
+    """参照後に別のワーカーがキャッシュのファイルを削除していたら、エントリを外して変換し直すかのテスト"""
+    from services.cache import ResultCache
+    from services.extractor import AudioExtractor
+
+    async def cached(self, url):
+        return {"cached": True}
+
+    converted = tmp_path / "new.mp3"
+    converted.write_bytes(b"ID3new")
+    results = [
+        {"title": "Song", "filename": "Song.mp3", "file_path": str(tmp_path / "evicted.mp3"),
+         "cached": True, "cache_key": "old", "etag": "e1"},
+        {"title": "Song", "filename": "Song.mp3", "file_path": str(converted),
+         "cached": False, "cache_key": "new", "etag": "e2"},
+    ]
+
+    async def fake_extract(self, url, output_dir=None, progress=None):
+        return results.pop(0)
+
+    dropped = []
+    monkeypatch.setattr(AudioExtractor, "get_cached", cached)
+    monkeypatch.setattr(AudioExtractor, "extract", fake_extract)
+    monkeypatch.setattr(ResultCache, "drop", lambda self, key: dropped.append(key))
+
+    response = client.post("/api/v1/extract-audio", json={"url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ"})
+    assert response.status_code == 200
+    assert response.content == b"ID3new"
+    assert response.headers["content-location"] == "/api/v1/artifacts/new"
+    assert dropped == ["old"]
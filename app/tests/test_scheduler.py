@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+import config
+from services.scheduler import BACKGROUND, BULK, INTERACTIVE, WorkScheduler, client_identity
+
+
+async def _run_units(scheduler, units, order):
+    """各処理単位を順に投入し、実行枠を得た順番を記録する"""
+    release = asyncio.Event()
+
+    async def unit(priority, client):
+        async with scheduler.slot(priority, client):
+            order.append(client)
+            await release.wait()
+            release.clear()
+
+    tasks = []
+    for priority, client in units:
+        tasks.append(asyncio.create_task(unit(priority, client)))
+        await asyncio.sleep(0)
+    for _ in units:
+        await asyncio.sleep(0.01)
+        release.set()
+    await asyncio.wait_for(asyncio.gather(*tasks), 1)
+
+
+@pytest.mark.asyncio
+async def test_clients_are_interleaved_by_weight():
+    """曲の多いクライアントが他のクライアントを待たせ続けず、重みに応じて交互に処理されるかのテスト"""
+    order = []
+    scheduler = WorkScheduler(capacity=1, interactive_reserved=0, weights={})
+    await _run_units(scheduler, [(BULK, "album")] * 5 + [(BULK, "other")] * 2, order)
+    assert order == ["album", "album", "other", "album", "other", "album", "album"]
+
+    order = []
+    scheduler = WorkScheduler(capacity=1, interactive_reserved=0, weights={"heavy": 2})
+    await _run_units(scheduler, [(BULK, "light")] * 3 + [(BULK, "heavy")] * 4, order)
+    assert order == ["light", "heavy", "light", "heavy", "heavy", "light", "heavy"]
+
+
+@pytest.mark.asyncio
+async def test_interactive_runs_before_bulk_and_background():
+    """一括・先読みは予約枠を使えず、優先度の高い処理が待っていれば後回しになるかのテスト"""
+    scheduler = WorkScheduler(capacity=2, interactive_reserved=1, weights={})
+    bulk = scheduler.slot(BULK, "album")
+    await bulk.__aenter__()
+
+    waiting_bulk = asyncio.create_task(scheduler._acquire(BULK, "album"))
+    await asyncio.sleep(0.01)
+    assert not waiting_bulk.done()  # 残りの1枠は対話的な処理のために空けておく
+
+    async with scheduler.slot(INTERACTIVE, "single"):
+        assert scheduler.running == {INTERACTIVE: 1, BULK: 1, BACKGROUND: 0}
+        waiting_interactive = asyncio.create_task(scheduler._acquire(INTERACTIVE, "single"))
+        waiting_background = asyncio.create_task(scheduler._acquire(BACKGROUND, "prefetch"))
+        await asyncio.sleep(0.01)
+        assert scheduler.status()["queued"] == {
+            INTERACTIVE: {"single": 1}, BULK: {"album": 1}, BACKGROUND: {"prefetch": 1}}
+
+    await asyncio.wait_for(waiting_interactive, 1)
+    assert not waiting_bulk.done() and not waiting_background.done()
+
+    # 待っている間に中止されたものは枠を使わない
+    waiting_background.cancel()
+    await bulk.__aexit__(None, None, None)
+    await asyncio.wait_for(waiting_bulk, 1)
+    assert scheduler.running == {INTERACTIVE: 1, BULK: 1, BACKGROUND: 0}
+    assert scheduler.status()["queued"] == {INTERACTIVE: {}, BULK: {}, BACKGROUND: {}}
+
+
+def test_client_identity(monkeypatch):
+    """APIキー（ハッシュ）、IPアドレスの順にクライアントを識別するかのテスト"""
+    scope = {"headers": [(b"x-forwarded-for", b"203.0.113.7, 10.0.0.1")], "client": ("10.0.0.1", 5000)}
+    assert client_identity(scope) == "ip:10.0.0.1"
+    monkeypatch.setattr(config, "SCHEDULER_TRUST_FORWARDED", True)
+    assert client_identity(scope) == "ip:203.0.113.7"
+
+    identity = client_identity({"headers": [(b"x-api-key", b"secret")], "client": ("10.0.0.1", 5000)})
+    assert identity.startswith("key:") and "secret" not in identity
+    assert client_identity({"headers": []}) == "unknown"
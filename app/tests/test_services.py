@@ -1,5 +1,7 @@
+import asyncio
 import pytest
 from services.extractor import AudioExtractor  # 相対インポートを絶対インポートに変更
+from services.download_engine import DownloadedSource
 from fastapi import HTTPException
 import os
 
@@ -34,4 +36,276 @@ async def test_full_extraction_process(sample_youtube_url, temp_dir):
     
     # ファイルが実際に生成されているか確認
     assert os.path.exists(result['file_path'])
-    assert os.path.getsize(result['file_path']) > 0
\ No newline at end of file
+    assert os.path.getsize(result['file_path']) > 0
+
+
+class _FakeYoutubeDL:
+    """extract_info の呼び出しを記録するyt-dlpの代替"""
+    calls = []
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.params = dict(opts)
+
+    def add_progress_hook(self, hook):
+        pass
+
+    def close(self):
+        pass
+
+    def extract_info(self, url, download=False):
+        _FakeYoutubeDL.calls.append((url, self.opts.get('extract_flat')))
+        if self.opts.get('extract_flat'):
+            return {'_type': 'playlist', 'id': 'PL123', 'title': 'My Album', 'entries': []}
+        return {'id': 'dQw4w9WgXcQ', 'title': 'Song', 'duration': 212}
+
+
+@pytest.fixture
+def fake_ydl(monkeypatch, tmp_path):
+    import services.extractor as extractor_module
+    import services.info_cache as info_cache
+    import services.ydl_pool as ydl_pool
+    _FakeYoutubeDL.calls = []
+    monkeypatch.setattr(extractor_module.yt_dlp, "YoutubeDL", _FakeYoutubeDL)
+    monkeypatch.setattr(ydl_pool, "_ydl_pool", ydl_pool.YoutubeDLPool())
+    monkeypatch.setattr(info_cache, "_info_cache", info_cache.InfoCache(db_path=str(tmp_path / "info.db"), ttl=60))
+    return _FakeYoutubeDL
+
+
+@pytest.mark.asyncio
+async def test_video_info_resolved_once(fake_ydl, sample_youtube_url):
+    """動画情報が1回だけ解決され、キャッシュが再利用されるかのテスト"""
+    extractor = AudioExtractor()
+    first = await extractor._get_video_info(sample_youtube_url)
+    second = await extractor._get_video_info(sample_youtube_url)
+
+    assert first['title'] == second['title'] == 'Song'
+    # list= が無いのでプレイリストの問い合わせは行わない
+    assert fake_ydl.calls == [("https://www.youtube.com/watch?v=dQw4w9WgXcQ", False)]
+
+
+@pytest.mark.asyncio
+async def test_video_info_with_playlist(fake_ydl):
+    """list= 付きURLではプレイリスト情報が付与されるかのテスト"""
+    extractor = AudioExtractor()
+    info = await extractor._get_video_info("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL123")
+
+    assert info['playlist_title'] == 'My Album'
+    assert [flat for _, flat in fake_ydl.calls] == [True, False]
+    # キャッシュされた動画情報にはプレイリスト情報を混ぜない
+    assert 'playlist_title' not in await extractor.info_cache.get('dQw4w9WgXcQ')
+
+
+@pytest.mark.asyncio
+async def test_extract_many_keeps_order_and_isolates_failures(monkeypatch):
+    """並列処理でも結果が入力順で、失敗した曲だけが None になるかのテスト"""
+    import asyncio
+    extractor = AudioExtractor()
+    running = 0
+    peak = 0
+
+    async def fake_extract(url, output_dir=None):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        # 後の曲ほど早く終わるようにして順序の保証を確認
+        await asyncio.sleep(0.01 * (5 - int(url[-1])))
+        running -= 1
+        if url.endswith("3"):
+            raise HTTPException(status_code=400, detail="unavailable")
+        return {"file_path": url}
+
+    monkeypatch.setattr(extractor, "extract", fake_extract)
+    urls = [f"https://example.com/{i}" for i in range(5)]
+    results = await extractor.extract_many(urls, concurrency=2)
+
+    assert [r and r["file_path"] for r in results] == [urls[0], urls[1], urls[2], None, urls[4]]
+    assert peak <= 2
+
+
+@pytest.mark.asyncio
+async def test_extract_stream_sends_tags_first_and_fills_cache(monkeypatch, tmp_path):
+    """ストリーミング抽出でID3ヘッダが先頭に来て、結果がキャッシュされるかのテスト"""
+    import io
+    import services.extractor as extractor_module
+    from mutagen.id3 import ID3
+    from services.cache import ResultCache
+
+    from services.temp_space import TempSpace
+
+    extractor = AudioExtractor()
+    extractor.cache = ResultCache(cache_dir=str(tmp_path / "cache"))
+    extractor.temp_space = TempSpace(root=str(tmp_path / "temp"))
+
+    async def fake_info(url):
+        return {'id': 'dQw4w9WgXcQ', 'title': 'Song', 'uploader': 'Artist', 'duration': 212}
+
+    async def fake_download(info, work_dir=None):
+        path = os.path.join(work_dir, "dQw4w9WgXcQ.webm")
+        open(path, "wb").close()
+        return DownloadedSource(path, {'acodec': 'opus'})
+
+    async def fake_cover(info):
+        return None
+
+    async def fake_ffmpeg(args):
+        for _ in range(3):
+            yield b"\xff\xfb" + b"\0" * 100
+
+    monkeypatch.setattr(extractor, "_get_video_info", fake_info)
+    monkeypatch.setattr(extractor, "_download_source", fake_download)
+    monkeypatch.setattr(extractor, "_fetch_cover_image", fake_cover)
+    monkeypatch.setattr(extractor_module, "stream_ffmpeg", fake_ffmpeg)
+
+    meta, body = await extractor.extract_stream("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+    chunks = [chunk async for chunk in body]
+
+    assert meta["filename"] == "Song.mp3"
+    assert chunks[0].startswith(b"ID3")
+    tags = ID3(io.BytesIO(chunks[0]))
+    assert str(tags["TIT2"]) == "Song"
+    assert str(tags["TPE1"]) == "Artist"
+
+    cached = extractor.cache.get('dQw4w9WgXcQ', extractor.profile.ext,
+                                 extractor.profile.quality, extractor_module.TAG_VERSION)
+    with open(cached["path"], "rb") as f:
+        assert f.read() == b"".join(chunks)
+    # 作業ディレクトリは削除されている
+    assert os.listdir(tmp_path / "temp" / "work") == []
+
+
+@pytest.mark.asyncio
+async def test_transcode_executor_rejects_when_queue_full():
+    """変換枠と待ち行列が埋まると429になるかのテスト"""
+    import asyncio
+    from services.transcode_executor import TranscodeExecutor, ServerBusyError
+
+    executor = TranscodeExecutor(workers=1, max_queue=1)
+    release = asyncio.Event()
+
+    async def hold():
+        async with executor.slot():
+            await release.wait()
+
+    tasks = [asyncio.ensure_future(hold()) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    assert executor.status()["running"] == 1
+    assert executor.status()["queued"] == 1
+
+    with pytest.raises(ServerBusyError) as exc_info:
+        executor.check_admission()
+    assert exc_info.value.status_code == 429
+    assert int(exc_info.value.headers["Retry-After"]) >= 1
+
+    release.set()
+    await asyncio.gather(*tasks)
+    executor.check_admission()  # 空けば受け付ける
+
+
+@pytest.mark.asyncio
+async def test_transcode_executor_runs_off_loop():
+    """変換処理が専用スレッドで実行されるかのテスト"""
+    import threading
+    from services.transcode_executor import TranscodeExecutor, available_cpus
+
+    assert available_cpus() >= 1
+    executor = TranscodeExecutor(workers=2)
+    thread_name = await executor.run(lambda: threading.current_thread().name)
+    assert thread_name.startswith("transcode")
+
+    # 枠を確保したまま run() を呼んでも、同じ枠を二重に待たない（1枠でもデッドロックしない）
+    executor = TranscodeExecutor(workers=1)
+    async with executor.slot():
+        assert await asyncio.wait_for(executor.run(lambda: "tagged"), 1) == "tagged"
+    assert executor.status()["running"] == 0
+
+
+def test_transcode_executor_splits_cpus_across_workers(monkeypatch):
+    """ワーカープロセスの数でCPUを分け、全体の同時変換数がコア数を超えないかのテスト"""
+    import config
+    import services.transcode_executor as transcode_executor
+
+    monkeypatch.setattr(transcode_executor, "available_cpus", lambda: 4)
+    monkeypatch.setattr(config, "TRANSCODE_CONCURRENCY", 0)
+    monkeypatch.setattr(config, "WEB_CONCURRENCY", 2)
+    assert transcode_executor.TranscodeExecutor().workers == 2
+    monkeypatch.setattr(config, "WEB_CONCURRENCY", 8)
+    assert transcode_executor.TranscodeExecutor().workers == 1  # 最低1枠
+
+
+def test_mp3_file_args_include_tags_and_cover():
+    """変換時にタグとカバー画像を書き込む引数になっているかのテスト"""
+    from services.transcoder import mp3_file_args
+    args = mp3_file_args("in.webm", "out.mp3", "320",
+                         {"title": "Song", "artist": "Artist", "date": ""}, "cover.jpg")
+
+    assert args[args.index("-b:a") + 1] == "320k"
+    assert args[args.index("-id3v2_version") + 1] == "3"
+    assert ["-i", "cover.jpg"] == args[args.index("cover.jpg") - 1:args.index("cover.jpg") + 1]
+    assert "title=Song" in args and "artist=Artist" in args
+    assert not any(a.startswith("date=") for a in args)  # 空の値は書き込まない
+    assert args[-1] == "out.mp3"
+
+
+@pytest.mark.asyncio
+async def test_download_and_convert_writes_file_once(monkeypatch, tmp_path):
+    """タグ付きのMP3が変換1回で生成され、中間ファイルが残らないかのテスト"""
+    import services.extractor as extractor_module
+
+    extractor = AudioExtractor()
+    extractor.temp_dir = str(tmp_path)
+    ffmpeg_calls = []
+
+    async def fake_download(info, work_dir=None, progress=None):
+        path = tmp_path / "dQw4w9WgXcQ.webm"
+        path.write_bytes(b"webm")
+        return DownloadedSource(str(path), {'acodec': 'opus'})
+
+    async def fake_cover(info):
+        return b"jpeg"
+
+    async def fake_run_ffmpeg(args):
+        ffmpeg_calls.append(args)
+        cover_file = args[args.index("-map") - 1]
+        assert open(cover_file, "rb").read() == b"jpeg"
+        with open(args[-1], "wb") as f:
+            f.write(b"ID3mp3")
+
+    monkeypatch.setattr(extractor, "_download_source", fake_download)
+    monkeypatch.setattr(extractor, "_fetch_cover_image", fake_cover)
+    monkeypatch.setattr(extractor_module, "run_ffmpeg", fake_run_ffmpeg)
+
+    output = await extractor._download_and_convert({'id': 'dQw4w9WgXcQ', 'title': 'Song'})
+
+    assert len(ffmpeg_calls) == 1
+    assert "title=Song" in ffmpeg_calls[0]
+    assert os.listdir(tmp_path) == ["dQw4w9WgXcQ.mp3"]
+    assert open(output, "rb").read() == b"ID3mp3"
+
+
+def test_bulk_info_streams_and_feeds_later_extraction(client, fake_ydl):
+    """一括取得した情報が共有キャッシュに残り、後の抽出で再取得しないかのテスト"""
+    import json
+    from services.info_cache import InfoCache, get_info_cache
+
+    response = client.post("/api/v1/info", json={
+        "urls": ["dQw4w9WgXcQ", "https://youtu.be/dQw4w9WgXcQ", "https://www.youtube.com/invalid"],
+    })
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0]["index"] == [2] and lines[0]["status"] == "error"
+    assert lines[1] == {"index": [0, 1], "url": "dQw4w9WgXcQ", "video_id": "dQw4w9WgXcQ", "status": "ok",
+                        "title": "Song", "duration": 212, "thumbnail": None, "uploader": None,
+                        "upload_date": None}
+    assert lines[-1] == {"status": "done", "total": 3, "succeeded": 2, "failed": 1}
+    assert len(fake_ydl.calls) == 1
+
+    # 別のワーカー（プロセス内のキャッシュが空）からも参照できる
+    other_worker = InfoCache(db_path=get_info_cache().db_path)
+    assert asyncio.run(other_worker.get("dQw4w9WgXcQ"))["title"] == "Song"
+
+    async def lookup():
+        return await AudioExtractor()._get_video_info("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+    assert asyncio.run(lookup())["title"] == "Song"
+    assert len(fake_ydl.calls) == 1
@@ -0,0 +1,139 @@
+import os
+import fcntl
+import pytest
+import asyncio
+from fastapi import HTTPException
+from services.singleflight import SingleFlight, sweep_lock_dir
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_execution(tmp_path):
+    """同じキーの同時呼び出しが1回の実行にまとめられるかのテスト"""
+    flight = SingleFlight(lock_dir=str(tmp_path))
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {"video_id": "abc"}
+
+    results = await asyncio.gather(*[flight.do("abc", work) for _ in range(5)])
+    assert calls == 1
+    assert all(r == {"video_id": "abc"} for r in results)
+
+
+@pytest.mark.asyncio
+async def test_late_joiner_sees_same_error(tmp_path):
+    """直後に参加した呼び出しにも同じエラーが返るかのテスト"""
+    flight = SingleFlight(lock_dir=str(tmp_path), outcome_ttl=5)
+    calls = 0
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        raise HTTPException(status_code=400, detail="Video not available")
+
+    for _ in range(2):
+        with pytest.raises(HTTPException) as exc_info:
+            await flight.do("abc", work)
+        assert exc_info.value.detail == "Video not available"
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_other_worker_error_is_propagated(tmp_path):
+    """別ワーカーの失敗を待機側が受け取るかのテスト"""
+    owner = SingleFlight(lock_dir=str(tmp_path), poll_interval=0.01)
+    waiter = SingleFlight(lock_dir=str(tmp_path), poll_interval=0.01)
+    waiter_calls = 0
+
+    async def failing():
+        await asyncio.sleep(0.05)
+        raise HTTPException(status_code=400, detail="boom")
+
+    async def never():
+        nonlocal waiter_calls
+        waiter_calls += 1
+        return {}
+
+    owner_task = asyncio.ensure_future(owner.do("abc", failing))
+    await asyncio.sleep(0.01)
+    with pytest.raises(HTTPException) as exc_info:
+        await waiter.do("abc", never)
+    assert exc_info.value.detail == "boom"
+    assert waiter_calls == 0
+    with pytest.raises(HTTPException):
+        await owner_task
+
+
+@pytest.mark.asyncio
+async def test_lock_files_are_removed(tmp_path):
+    """終了後にロックファイルが残らず、残ったものや期限切れの失敗記録は掃除されるかのテスト"""
+    workers = [SingleFlight(lock_dir=str(tmp_path), poll_interval=0.01) for _ in range(3)]
+    running = 0
+
+    async def work():
+        nonlocal running
+        running += 1
+        assert running == 1  # ロックファイルが削除されても同時には実行しない
+        await asyncio.sleep(0.05)
+        running -= 1
+        return {}
+
+    async def start_after(delay, flight):
+        await asyncio.sleep(delay)
+        return await flight.do("abc", work)
+
+    # 3つ目は、2つ目が削除済みのファイルのロックで実行している間に始める
+    await asyncio.gather(*[start_after(delay, f) for delay, f in zip((0, 0.01, 0.07), workers)])
+    assert list(tmp_path.iterdir()) == []
+
+    # 強制終了したワーカーが残したロックと、期限切れの失敗記録
+    (tmp_path / "stale.lock").touch()
+    (tmp_path / "stale.error").write_text("{}")
+    held = os.open(tmp_path / "held.lock", os.O_RDWR | os.O_CREAT)
+    fcntl.flock(held, fcntl.LOCK_EX)
+    try:
+        assert sweep_lock_dir(str(tmp_path), outcome_ttl=-1) == 2
+        assert [p.name for p in tmp_path.iterdir()] == ["held.lock"]  # 使用中のロックは残す
+    finally:
+        os.close(held)
+
+
+@pytest.mark.asyncio
+async def test_joiner_raises_priority_of_shared_work(tmp_path):
+    """先読みが始めた処理に対話的な呼び出しが参加したら、対話的な優先度で順番待ちするかのテスト"""
+    from services.scheduler import BACKGROUND, BULK, INTERACTIVE, WorkScheduler, set_work
+
+    scheduler = WorkScheduler(capacity=1, interactive_reserved=0, weights={})
+    flight = SingleFlight(lock_dir=str(tmp_path))
+    order = []
+
+    async def shared():
+        async with scheduler.slot():
+            order.append("shared")
+        return {}
+
+    async def call(priority, client):
+        set_work(priority, client)
+        return await flight.do("abc", shared)
+
+    async def album():
+        async with scheduler.slot(BULK, "album"):
+            order.append("album")
+
+    holder = scheduler.slot(INTERACTIVE, "holder")
+    await holder.__aenter__()
+    starter = asyncio.create_task(call(BACKGROUND, "prefetch"))
+    await asyncio.sleep(0.01)
+    other = asyncio.create_task(album())
+    await asyncio.sleep(0.01)
+    joiner = asyncio.create_task(call(INTERACTIVE, "user"))
+    await asyncio.sleep(0.01)
+    assert scheduler.status()["queued"] == {INTERACTIVE: {"user": 1}, BULK: {"album": 1}, BACKGROUND: {}}
+
+    await holder.__aexit__(None, None, None)
+    await asyncio.wait_for(asyncio.gather(starter, joiner, other), 1)
+    assert order == ["shared", "album"]
+    assert scheduler.running == {INTERACTIVE: 0, BULK: 0, BACKGROUND: 0}
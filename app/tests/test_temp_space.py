@@ -0,0 +1,69 @@
+import os
+import time
+import pytest
+from fastapi import HTTPException
+from services.temp_space import TempSpace
+
+
+def _write(path, size):
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+
+
+def _age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_workdir_is_removed_when_last_reference_is_released(tmp_path):
+    """参照が残っている間は削除されず、最後の参照が外れたら削除されるかのテスト"""
+    space = TempSpace(root=str(tmp_path))
+    workdir = space.workdir("job")
+    workdir.acquire()  # 送信中のレスポンスが参照
+    _write(os.path.join(workdir.path, "a.mp3"), 10)
+
+    workdir.release()
+    assert os.path.isdir(workdir.path)
+    workdir.release()
+    assert not os.path.exists(workdir.path)
+
+
+def test_sweep_keeps_leased_and_removes_expired(tmp_path):
+    """使用中のディレクトリは残し、期限切れの残骸を削除するかのテスト"""
+    space = TempSpace(root=str(tmp_path), quota_bytes=10 ** 9, max_age=60)
+    active = space.workdir("active")
+    _age(active.path, 3600)
+    leftover = tmp_path / "old.webm.part"
+    _write(leftover, 100)
+    _age(leftover, 3600)
+    fresh = tmp_path / "new.webm"
+    _write(fresh, 100)
+
+    space.sweep()
+    assert os.path.isdir(active.path)
+    assert not leftover.exists()
+    assert fresh.exists()
+    active.release()
+
+
+def test_sweep_enforces_quota(tmp_path):
+    """上限を超えた分を古い順に削除し、使用中だけで超える場合は新規作業を断るかのテスト"""
+    space = TempSpace(root=str(tmp_path), quota_bytes=250, max_age=3600)
+    for i, name in enumerate(["a", "b", "c"]):
+        _write(tmp_path / name, 100)
+        _age(tmp_path / name, 300 - i)
+
+    space.sweep()
+    assert sorted(os.listdir(tmp_path / "work")) == []
+    assert not (tmp_path / "a").exists()
+    assert (tmp_path / "b").exists() and (tmp_path / "c").exists()
+
+    active = space.workdir("big")
+    _write(os.path.join(active.path, "x"), 1000)
+    space.sweep()
+    with pytest.raises(HTTPException) as exc:
+        space.workdir("next")
+    assert exc.value.status_code == 503
+    active.release()
+    space.sweep()
+    space.workdir("next").release()
@@ -0,0 +1,67 @@
+import pytest
+import io
+import httpx
+from PIL import Image
+from services.thumbnail import ThumbnailFetcher, process_cover
+
+
+def _jpeg(width, height):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def test_process_cover_is_square_and_bounded():
+    """カバーが正方形かつ指定サイズ以下になるかのテスト"""
+    cover = Image.open(io.BytesIO(process_cover(_jpeg(1920, 1080), 600)))
+    assert cover.size == (600, 600)
+    assert cover.format == 'JPEG'
+
+
+@pytest.mark.asyncio
+async def test_cover_fallback_and_cache(tmp_path):
+    """maxresdefault が無ければ hqdefault を使い、2回目はキャッシュから返すかのテスト"""
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        if request.url.path.endswith("hqdefault.jpg"):
+            return httpx.Response(200, content=_jpeg(480, 360))
+        return httpx.Response(404)
+
+    fetcher = ThumbnailFetcher(cache_dir=str(tmp_path), size=600, transport=httpx.MockTransport(handler))
+    info = {'id': 'dQw4w9WgXcQ'}
+
+    cover = await fetcher.get_cover(info)
+    assert Image.open(io.BytesIO(cover)).size == (360, 360)
+    assert requested == [
+        "https://i.ytimg.com/vi/dQw4w9WgXcQ/maxresdefault.jpg",
+        "https://i.ytimg.com/vi/dQw4w9WgXcQ/hqdefault.jpg",
+    ]
+
+    assert await fetcher.get_cover(info) == cover
+    assert len(requested) == 2
+    await fetcher.close()
+
+
+@pytest.mark.asyncio
+async def test_cover_cache_is_bounded(tmp_path):
+    """カバーを1つだけ保存し、上限を超えたら使われていない順に削除するかのテスト"""
+    fetcher = ThumbnailFetcher(cache_dir=str(tmp_path), size=600, max_bytes=10 * 1024 ** 2,
+                               transport=httpx.MockTransport(lambda request: httpx.Response(200, content=_jpeg(640, 480))))
+
+    first = await fetcher.get_cover({'id': 'aaaaaaaaaaa', 'thumbnail': 'https://example.com/a.jpg'})
+    assert len(list(tmp_path.glob("*.jpg"))) == 1 and len(list(tmp_path.glob("*.ref"))) == 1
+
+    # 上限を超えたので古いカバーと、その参照が削除される
+    fetcher.max_bytes = len(first)
+    await fetcher.get_cover({'id': 'bbbbbbbbbbb', 'thumbnail': 'https://example.com/b.jpg'})
+    assert len(list(tmp_path.glob("*.jpg"))) == 1 and len(list(tmp_path.glob("*.ref"))) == 1
+    assert fetcher._read_video_cache('aaaaaaaaaaa') is None
+    assert fetcher._read_video_cache('bbbbbbbbbbb') == first
+
+    # 期限切れは容量に関係なく削除する
+    fetcher.max_age = -1
+    assert fetcher.evict() == len(first)
+    assert list(tmp_path.iterdir()) == []
+    await fetcher.close()
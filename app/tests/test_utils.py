@@ -28,4 +28,93 @@ def test_get_file_size(temp_dir):
 def test_get_file_size_nonexistent():
     """存在しないファイルのサイズ取得テスト"""
     size = get_file_size("nonexistent.txt")
-    assert size == 0
\ No newline at end of file
+    assert size == 0
+
+
+def test_ttl_cache_expiry(monkeypatch):
+    """TTLキャッシュの期限切れと件数上限のテスト"""
+    import time
+    from utils.ttl_cache import TTLCache
+
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = TTLCache(ttl=10, max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+    assert cache.get("a") is None  # 上限超過で最古のものを削除
+    assert cache.get("b") == 2
+
+    now[0] += 11
+    assert cache.get("b") is None
+
+
+@pytest.mark.asyncio
+async def test_stream_zip_produces_stored_archive(temp_dir):
+    """ストリーミングで生成したZIPが正しく読めるかのテスト"""
+    import io
+    import struct
+    import zipfile
+    from utils.zip_stream import stream_zip
+
+    paths = []
+    for i in range(2):
+        path = os.path.join(temp_dir, f"{i}.mp3")
+        with open(path, "wb") as f:
+            f.write(os.urandom(150 * 1024))
+        paths.append(path)
+
+    async def entries():
+        for i, path in enumerate(paths):
+            yield path, f"Album/Track {i}.mp3"
+
+    chunks = [chunk async for chunk in stream_zip(entries(), chunk_size=32 * 1024)]
+    # 一度に全体をバッファせず、少しずつ送出されている
+    assert max(len(c) for c in chunks) < 64 * 1024
+
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zipf:
+        assert zipf.namelist() == ["Album/Track 0.mp3", "Album/Track 1.mp3"]
+        for i, name in enumerate(zipf.namelist()):
+            assert zipf.getinfo(name).compress_type == zipfile.ZIP_STORED
+            with open(paths[i], "rb") as f:
+                assert zipf.read(name) == f.read()
+
+    # データディスクリプタを使わず、ローカルヘッダにCRCとサイズを書く（前から順に読む展開ツール向け）
+    archive = b"".join(chunks)
+    for info in zipfile.ZipFile(io.BytesIO(archive)).infolist():
+        assert not info.flag_bits & 0x08
+        header = archive[info.header_offset:info.header_offset + 30]
+        crc, compressed, size = struct.unpack("<III", header[14:26])
+        assert (crc, compressed, size) == (info.CRC, 150 * 1024, 150 * 1024)
+
+
+def test_unique_archive_path():
+    """アーカイブ内のパス重複回避のテスト"""
+    from utils.zip_stream import unique_archive_path
+    used = set()
+    assert unique_archive_path("A/Song.mp3", used) == "A/Song.mp3"
+    assert unique_archive_path("A/Song.mp3", used) == "A/Song (2).mp3"
+
+
+def test_parse_range():
+    """Rangeヘッダの解釈のテスト"""
+    from utils.file_serving import RangeNotSatisfiable, parse_range
+
+    assert parse_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_range("bytes=900-", 1000) == (900, 999)
+    assert parse_range("bytes=-100", 1000) == (900, 999)
+    assert parse_range("bytes=990-2000", 1000) == (990, 999)
+    assert parse_range("bytes=0-1,5-6", 1000) is None  # 複数範囲は全体を返す
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=1000-", 1000)
+
+
+def test_if_range_uses_strong_comparison():
+    """If-Range は強い比較で、弱いETagでは一致しないかのテスト"""
+    from utils.file_serving import etag_matches, if_range_matches
+
+    assert if_range_matches('"abc"', '"abc"')
+    assert not if_range_matches('W/"abc"', '"abc"')
+    assert not if_range_matches('*', '"abc"')
+    assert not if_range_matches('Wed, 21 Oct 2015 07:28:00 GMT', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')  # If-None-Match は弱い比較のまま
@@ -0,0 +1,67 @@
+import pytest
+import services.warmup as warmup
+from services.warmup import DONE, FAILED, WarmupState
+from utils.lazy_import import LazyModule, lazy_import
+
+
+@pytest.mark.asyncio
+async def test_ready_only_after_all_steps_succeed():
+    """すべての段階が成功したときだけ準備完了になるかのテスト"""
+    calls = []
+
+    async def ok():
+        calls.append("ok")
+
+    async def broken():
+        raise Exception("ffmpeg not found")
+
+    state = WarmupState()
+    await state.run([("modules", ok), ("ffmpeg", broken), ("ydl_pool", ok)])
+    assert calls == ["ok", "ok"]  # 失敗した段階があっても残りは実行する
+    assert not state.ready
+    assert state.status()["status"] == "failed"
+    assert state.steps["ffmpeg"]["status"] == FAILED
+    assert state.steps["ffmpeg"]["error"] == "ffmpeg not found"
+
+    state = WarmupState()
+    await state.run([("modules", ok)])
+    assert state.ready
+    assert state.steps["modules"]["status"] == DONE
+    assert state.status()["ready_after"] > 0
+
+
+def test_ready_endpoint_reports_warmup(client, monkeypatch):
+    """/ready が準備完了まで503を返し、最初に成功したリクエストを記録するかのテスト"""
+    state = WarmupState()
+    monkeypatch.setattr(warmup, "_warmup_state", state)
+
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "warming_up"
+    assert client.get("/health").status_code == 200
+
+    state.mark_ready()
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+    assert state.first_success_at is None  # /ready と /health は数えない
+
+    client.get("/api/v1/transcode/status")
+    assert client.get("/ready").json()["first_success_after"] is not None
+
+
+def test_lazy_import_defers_loading():
+    """属性を参照するまで読み込まず、設定は読み込んだモジュールに反映されるかのテスト"""
+    module = LazyModule("json")
+    assert not module.is_loaded
+    assert module.dumps([1]) == "[1]"
+    assert module.is_loaded
+    assert lazy_import("json.decoder") is lazy_import("json.decoder")
+
+    import json
+    module.test_marker = True
+    try:
+        assert json.test_marker is True
+    finally:
+        del module.test_marker
+    assert not hasattr(json, "test_marker")
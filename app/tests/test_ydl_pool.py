@@ -0,0 +1,74 @@
+import threading
+import pytest
+import services.ydl_pool as ydl_pool
+from services.ydl_pool import YoutubeDLPool
+
+
+class _FakeYoutubeDL:
+    def __init__(self, opts):
+        self.params = dict(opts)
+        self.hooks = []
+        self.closed = False
+
+    def add_progress_hook(self, hook):
+        self.hooks.append(hook)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def fake_ydl(monkeypatch):
+    monkeypatch.setattr(ydl_pool.yt_dlp, "YoutubeDL", _FakeYoutubeDL)
+
+
+def test_pool_reuses_instances_per_option_profile():
+    """同じオプションならインスタンスを使い回し、保存先と進捗フックは貸し出しごとに切り替わるかのテスト"""
+    pool = YoutubeDLPool(max_idle=2)
+    events = []
+
+    with pool.checkout({'format': 'bestaudio'}, paths={'home': '/tmp/a'}, progress_hook=events.append) as first:
+        assert first.params['paths'] == {'home': '/tmp/a'}
+        first.hooks[0]({'status': 'downloading'})
+    with pool.checkout({'format': 'bestaudio'}, paths={'home': '/tmp/b'}) as second:
+        assert second is first
+        assert second.params['paths'] == {'home': '/tmp/b'}
+        second.hooks[0]({'status': 'finished'})  # 前回のフックには通知されない
+    with pool.checkout({'format': 'bestaudio[ext=m4a]'}) as other:
+        assert other is not first
+
+    assert events == [{'status': 'downloading'}]
+    assert pool.status() == {"idle": 2, "created": 2, "profiles": 2}
+
+
+def test_pool_discards_instance_after_error():
+    """処理中に失敗したインスタンスは返却されずに閉じられるかのテスト"""
+    pool = YoutubeDLPool()
+    with pytest.raises(RuntimeError):
+        with pool.checkout({}) as broken:
+            raise RuntimeError("extractor crashed")
+    assert broken.closed
+
+    with pool.checkout({}) as fresh:
+        assert fresh is not broken
+
+
+@pytest.mark.asyncio
+async def test_async_checkout_creates_off_the_event_loop(monkeypatch):
+    """非同期の貸し出しでは、空きが無いときのYoutubeDLの作成をイベントループのスレッドで行わないかのテスト"""
+    pool = YoutubeDLPool()
+    created_in = []
+
+    class _RecordingYoutubeDL(_FakeYoutubeDL):
+        def __init__(self, opts):
+            created_in.append(threading.get_ident())
+            super().__init__(opts)
+
+    monkeypatch.setattr(ydl_pool.yt_dlp, "YoutubeDL", _RecordingYoutubeDL)
+    async with pool.acheckout({'format': 'bestaudio'}, paths={'home': '/tmp/a'}) as first:
+        assert first.params['paths'] == {'home': '/tmp/a'}
+    async with pool.acheckout({'format': 'bestaudio'}) as second:
+        assert second is first
+
+    assert len(created_in) == 1 and created_in[0] != threading.get_ident()
+    assert pool.status() == {"idle": 1, "created": 1, "profiles": 1}
@@ -0,0 +1,173 @@
+import os
+import re
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    """Rangeがファイルの範囲外"""
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """ファイル内容のSHA-256（ETagに使う）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Rangeヘッダを (開始, 終了) に変換（終了は含む）
+
+    単一範囲のみ対応し、複数範囲や解釈できない値は None（全体を返す）とする。
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+
+    first, last = match.group(1), match.group(2)
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # 末尾から n バイト
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        start, end = max(0, size - length), size - 1
+
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match のETagが一致するか（弱い比較）"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    candidates = [value.strip() for value in header.split(',')]
+    return any(value.removeprefix('W/') == etag for value in candidates)
+
+
+def if_range_matches(header: Optional[str], etag: str) -> bool:
+    """If-Range のETagが一致するか（強い比較。弱いETagや日付は一致しないものとして全体を返す）"""
+    if not header:
+        return False
+    value = header.strip()
+    return not value.startswith('W/') and value == etag
+
+
+class ArtifactResponse(Response):
+    """ファイルの全体または一部を返すレスポンス
+
+    サーバが対応していれば、ゼロコピー送信の拡張（http.response.zerocopysend / pathsend）で
+    カーネルから直接送る。対応していなければスレッドでチャンクごとに読み出す。
+    送信中にキャッシュから削除されても、開いたファイルからそのまま送り切る。
+    """
+
+    def __init__(self, path: str, fd: int, size: int, status_code: int = 200,
+                 byte_range: Optional[Tuple[int, int]] = None, headers: Dict[str, str] = None,
+                 media_type: str = None, send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.fd = fd
+        self.offset, last = byte_range or (0, size - 1)
+        self.count = last - self.offset + 1 if size else 0
+        self.full = byte_range is None
+        self.send_body = send_body
+        self.headers["content-length"] = str(self.count)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if not self.send_body or not self.count:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+            else:
+                await self._send_body(scope, send)
+        finally:
+            os.close(self.fd)
+        if self.background is not None:
+            await self.background()
+
+    async def _send_body(self, scope: Scope, send: Send) -> None:
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            await send({"type": "http.response.zerocopysend", "file": self.fd,
+                        "offset": self.offset, "count": self.count, "more_body": False})
+            return
+        if self.full and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+
+        offset, remaining = self.offset, self.count
+        while remaining > 0:
+            chunk = await anyio.to_thread.run_sync(os.pread, self.fd, min(CHUNK_SIZE, remaining), offset)
+            if not chunk:
+                raise RuntimeError(f"File shrank while sending: {self.path}")
+            offset += len(chunk)
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+
+
+def serve_file(request_headers, method: str, path: str, etag: Optional[str], media_type: str,
+               headers: Dict[str, str] = None, conditional: bool = True) -> Response:
+    """ETag / If-None-Match / Range / If-Range に従ってファイルを返す
+
+    conditional は GET/HEAD 以外（POSTなど）では False にする（条件付きリクエストとRangeを無視する）。
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        headers = {**(headers or {}), "accept-ranges": "bytes" if conditional else "none"}
+        quoted_etag = f'"{etag}"' if etag else None
+        if quoted_etag:
+            headers["etag"] = quoted_etag
+        send_body = method.upper() != "HEAD"
+
+        if conditional and quoted_etag and etag_matches(request_headers.get("if-none-match"), quoted_etag):
+            os.close(fd)
+            return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "accept-ranges"})
+
+        byte_range = None
+        if conditional and size:
+            if_range = request_headers.get("if-range")
+            # If-Range が一致しない（ファイルが変わった）場合は全体を返す
+            if not if_range or (quoted_etag and if_range_matches(if_range, quoted_etag)):
+                try:
+                    byte_range = parse_range(request_headers.get("range"), size)
+                except RangeNotSatisfiable:
+                    os.close(fd)
+                    return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+
+        if byte_range:
+            start, end = byte_range
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            return ArtifactResponse(path, fd, size, 206, byte_range, headers, media_type, send_body)
+        return ArtifactResponse(path, fd, size, 200, None, headers, media_type, send_body)
+    except BaseException:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,60 @@
+import importlib
+import threading
+from types import ModuleType
+from typing import Dict
+
+
+class LazyModule:
+    """最初に属性を参照したときに読み込むモジュール
+
+    yt_dlp・mutagen・PIL・httpx などの読み込みに時間のかかるモジュールを
+    起動時ではなく、使う時点（または起動後の事前準備）まで遅らせる。
+    属性の設定（テストでの差し替えなど）は読み込んだモジュールに対して行う。
+    """
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self) -> ModuleType:
+        module = object.__getattribute__(self, "_module")
+        if module is None:
+            # import_module はインポートロックで保護されているので、複数のスレッドから呼んでもよい
+            module = importlib.import_module(object.__getattribute__(self, "_name"))
+            object.__setattr__(self, "_module", module)
+        return module
+
+    @property
+    def is_loaded(self) -> bool:
+        return object.__getattribute__(self, "_module") is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value) -> None:
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr: str) -> None:
+        delattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"<lazy module {object.__getattribute__(self, '_name')!r} ({state})>"
+
+
+_modules: Dict[str, LazyModule] = {}
+_lock = threading.Lock()
+
+
+def lazy_import(name: str) -> LazyModule:
+    """モジュールを遅延して読み込む（同じ名前には同じオブジェクトを返す）"""
+    with _lock:
+        module = _modules.get(name)
+        if module is None:
+            module = _modules[name] = LazyModule(name)
+        return module
+
+
+def load(name: str) -> ModuleType:
+    """遅延しているモジュールを今すぐ読み込む（起動後の事前準備用）"""
+    return lazy_import(name)._load()
@@ -0,0 +1,100 @@
+import os
+import zlib
+import asyncio
+import zipfile
+import logging
+from typing import AsyncIterator, BinaryIO, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """ZipFileの書き込み先（シーク不可）。書かれたバイト列を順次取り出す"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _crc_and_size(src: BinaryIO, chunk_size: int = 1024 * 1024) -> Tuple[int, int]:
+    """ファイルのCRC-32とサイズ（読み終えたら先頭に戻す）"""
+    crc, size = 0, 0
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+    src.seek(0)
+    return crc, size
+
+
+async def stream_zip(entries: AsyncIterator[Tuple[str, str]],
+                     chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """(ファイルパス, アーカイブ内パス) を受け取り、ZIPを少しずつ生成する
+
+    MP3は圧縮済みなので ZIP_STORED で格納する。メモリ使用量は chunk_size 程度に収まる。
+    シーク不可の出力に ZipFile.open で書くとデータディスクリプタ付きになり、前から順に読む
+    展開ツールが STORED のエントリの終わりを判断できない。ファイルは揃っているので、
+    先にCRCとサイズを求めてローカルヘッダに書き、ディスクリプタを使わない。
+    セントラルディレクトリは ZipFile に書かせる。ファイルの読み込みはスレッドで行う。
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zipf:
+        async for file_path, archive_path in entries:
+            zinfo = zipfile.ZipInfo.from_file(file_path, archive_path)
+            zinfo.compress_type = zipfile.ZIP_STORED
+            logger.info(f"Adding to ZIP: {file_path} as {archive_path}")
+
+            with open(file_path, "rb") as src:
+                zinfo.CRC, zinfo.file_size = await asyncio.to_thread(_crc_and_size, src)
+                zinfo.compress_size = zinfo.file_size
+                # ローカルヘッダを送出（ZipFileはシーク不可の出力を位置を数えるラッパーで包んでいる）
+                zinfo.header_offset = zipf.fp.tell()
+                zipf.fp.write(zinfo.FileHeader())
+                yield buffer.drain()
+
+                remaining = zinfo.file_size
+                while remaining > 0:
+                    data = await asyncio.to_thread(src.read, min(chunk_size, remaining))
+                    if not data:
+                        raise RuntimeError(f"File shrank while adding to ZIP: {file_path}")
+                    zipf.fp.write(data)
+                    remaining -= len(data)
+                    yield buffer.drain()
+
+            # ZipFile.open で書いた場合と同じく、セントラルディレクトリに載せる
+            zipf.filelist.append(zinfo)
+            zipf.NameToInfo[zinfo.filename] = zinfo
+            zipf.start_dir = zipf.fp.tell()
+            zipf._didModify = True
+
+    # セントラルディレクトリを送出
+    tail = buffer.drain()
+    if tail:
+        yield tail
+
+
+def unique_archive_path(archive_path: str, used: set) -> str:
+    """アーカイブ内のパスが重複しないように番号を付与"""
+    candidate = archive_path
+    base, ext = os.path.splitext(archive_path)
+    n = 2
+    while candidate in used:
+        candidate = f"{base} ({n}){ext}"
+        n += 1
+    used.add(candidate)
+    return candidate
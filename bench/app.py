@@ -0,0 +1,11 @@
+"""ベンチマーク用のアプリ（スタブExtractorを組み込んだ main:app）
+
+uvicorn の各ワーカーがこのモジュールを読み込むため、ワーカーごとにスタブが有効になる。
+"""
+import os
+
+from bench.fixtures import install_stub
+
+install_stub(os.environ["BENCH_FIXTURE_URL"], float(os.environ.get("BENCH_AUDIO_SECONDS", "30")))
+
+from main import app  # noqa: E402  スタブを入れてから読み込む
@@ -0,0 +1,184 @@
+"""ネットワークを使わないベンチマーク用のフィクスチャ
+
+- FixtureServer: 合成した音声（WAV）とサムネイル（JPEG）を返すローカルHTTPサーバ
+- BenchYoutubeIE: YouTubeのURLをフィクスチャサーバへ向けるyt-dlpのスタブExtractor
+"""
+import io
+import importlib
+import math
+import re
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+
+def synthetic_wav(seconds: float, frequency: float = 440.0) -> bytes:
+    """サイン波のWAV（16bit ステレオ）を生成"""
+    # 1秒分を作って繰り返す（周波数を整数にしておけば継ぎ目でも波形が連続する）
+    one_second = bytearray()
+    for i in range(SAMPLE_RATE):
+        sample = int(12000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE))
+        one_second += struct.pack('<hh', sample, sample)
+    whole, rest = divmod(int(seconds * SAMPLE_RATE), SAMPLE_RATE)
+    data = bytes(one_second) * whole + bytes(one_second[:rest * CHANNELS * 2])
+
+    header = struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + len(data), b'WAVE', b'fmt ', 16, 1, CHANNELS, SAMPLE_RATE,
+        SAMPLE_RATE * CHANNELS * 2, CHANNELS * 2, 16, b'data', len(data),
+    )
+    return header + data
+
+
+def synthetic_thumbnail(width: int = 1280, height: int = 720) -> bytes:
+    """16:9のグラデーション画像（JPEG）を生成"""
+    from PIL import Image
+
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class FixtureServer:
+    """合成した音声とサムネイルを返すHTTPサーバ（別スレッドで動作）
+
+    /audio/<id>.wav と /thumb/<id>.jpg は、IDに関係なく同じ内容を返す。
+    latency を指定すると、各レスポンスの前に待機してネットワークの往復時間を模擬する。
+    """
+
+    def __init__(self, audio_seconds: float = 30.0, latency: float = 0.0, port: int = 0):
+        self.audio = synthetic_wav(audio_seconds)
+        self.thumbnail = synthetic_thumbnail()
+        self.latency = latency
+        self.audio_seconds = audio_seconds
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path.startswith('/audio/'):
+                    server._send(self, server.audio, 'audio/wav')
+                elif self.path.startswith('/thumb/'):
+                    server._send(self, server.thumbnail, 'image/jpeg')
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _send(self, handler: BaseHTTPRequestHandler, body: bytes, content_type: str) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+        start, end = 0, len(body) - 1
+        status = 200
+        match = re.match(r'bytes=(\d*)-(\d*)', handler.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+            else:
+                start = max(0, len(body) - int(match.group(2)))
+            status = 206
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(end - start + 1))
+        handler.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        handler.end_headers()
+        handler.wfile.write(body[start:end + 1])
+
+    def start(self) -> 'FixtureServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fixture-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def bench_video_info(video_id: str, base_url: str, audio_seconds: float) -> Dict:
+    """フィクスチャサーバを指す動画情報"""
+    return {
+        'id': video_id,
+        'title': f'Bench Track {video_id}',
+        'uploader': 'Bench Artist',
+        'upload_date': '20240101',
+        'duration': audio_seconds,
+        'thumbnail': f'{base_url}/thumb/{video_id}.jpg',
+        'thumbnails': [{'url': f'{base_url}/thumb/{video_id}.jpg', 'width': 1280, 'height': 720}],
+        'formats': [{
+            'format_id': 'wav',
+            'url': f'{base_url}/audio/{video_id}.wav',
+            'ext': 'wav',
+            'acodec': 'pcm_s16le',
+            'vcodec': 'none',
+            'abr': SAMPLE_RATE * CHANNELS * 16 / 1000,
+            'protocol': 'http',
+        }],
+    }
+
+
+def playlist_size(playlist_id: str) -> int:
+    """プレイリストIDの末尾 n<曲数> から曲数を取得（例: PLBENCHxxxxn12）"""
+    match = re.search(r'n(\d+)$', playlist_id)
+    return int(match.group(1)) if match else 1
+
+
+def playlist_video_id(playlist_id: str, index: int) -> str:
+    """プレイリスト内の動画ID（11文字）"""
+    prefix = re.sub(r'n\d+$', '', playlist_id)[-7:]
+    return f"{prefix:_>7}{index:04d}"
+
+
+def install_stub(base_url: str, audio_seconds: float) -> None:
+    """以降に作成されるYoutubeDLが、YouTubeのURLをスタブExtractorで処理するようにする"""
+    import yt_dlp  # noqa: F401
+    from yt_dlp.extractor.common import InfoExtractor
+
+    # yt_dlp.YoutubeDL はクラス名と同じなので、モジュールは sys.modules から取る
+    youtube_dl_module = sys.modules['yt_dlp.YoutubeDL']
+
+    class BenchYoutubeIE(InfoExtractor):
+        IE_NAME = 'bench:youtube'
+        _VALID_URL = r'https?://(?:www\.)?(?:youtube\.com/(?:watch|playlist)\?|youtu\.be/)'
+
+        def _real_extract(self, url):
+            query = parse_qs(urlparse(url).query)
+            playlist_id = query.get('list', [None])[0]
+            video_id = query.get('v', [None])[0]
+
+            if playlist_id and (not video_id or not self.get_param('noplaylist')):
+                entries = [
+                    self.url_result(f'https://www.youtube.com/watch?v={vid}', ie=self.ie_key(), video_id=vid)
+                    for vid in (playlist_video_id(playlist_id, i) for i in range(playlist_size(playlist_id)))
+                ]
+                return self.playlist_result(entries, playlist_id, f'Bench Album {playlist_id}')
+
+            return bench_video_info(video_id, base_url, audio_seconds)
+
+    youtube_dl_module.gen_extractor_classes = lambda: [BenchYoutubeIE]
+    # インスタンスはクラス名から遅延生成されるため、Extractor一覧にも登録する
+    setattr(importlib.import_module('yt_dlp.extractor.extractors'), BenchYoutubeIE.__name__, BenchYoutubeIE)
@@ -0,0 +1,381 @@
+"""オフラインのベンチマーク
+
+ローカルのフィクスチャサーバとスタブExtractorを使い、ネットワークなしで
+/api/v1/extract-audio と /api/v1/extract-album を指定した並列度で叩く。
+スループット・レイテンシ（p50/p95/p99）・ピークRSS・1曲あたりのCPU時間をJSONで保存する。
+
+    python bench/run.py --mode single --requests 20 --concurrency 4
+    python bench/run.py --mode album --requests 2 --tracks 8 --concurrency 1
+    python bench/run.py compare bench/results/A.json bench/results/B.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import signal
+import socket
+import struct
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT_DIR, "app")
+RESULTS_DIR = os.path.join(ROOT_DIR, "bench", "results")
+
+sys.path.insert(0, ROOT_DIR)
+from bench.fixtures import FixtureServer  # noqa: E402
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """線形補間のパーセンタイル（q は 0〜100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+# ZIP末尾（セントラルディレクトリ終端レコード）を探すために保持するバイト数
+ZIP_TAIL_BYTES = 64 * 1024
+
+
+def zip_entry_count(tail: bytes) -> int:
+    """ZIPの末尾からエントリ数を取得"""
+    index = tail.rfind(b"PK\x05\x06")
+    if index < 0 or len(tail) < index + 12:
+        return 0
+    return struct.unpack("<H", tail[index + 10:index + 12])[0]
+
+
+def _process_tree(pid: int) -> List[int]:
+    """pid とその子孫のプロセスID"""
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    stack.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def _rss_bytes(pids: List[int]) -> int:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def _cpu_seconds(pids: List[int]) -> float:
+    """utime + stime + 終了した子プロセス（FFmpegなど）の分"""
+    ticks = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # comm に空白が含まれる場合があるため ')' 以降を分割する
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks += sum(int(value) for value in fields[11:15])
+        except (OSError, IndexError, ValueError):
+            pass
+    return ticks / CLK_TCK
+
+
+class ResourceSampler:
+    """サーバのプロセスツリーのRSSを定期的に計測し、ピークを記録"""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, _rss_bytes(_process_tree(self.pid)))
+            self._stop.wait(self.interval)
+
+    def cpu_seconds(self) -> float:
+        return _cpu_seconds(_process_tree(self.pid))
+
+    def start(self) -> "ResourceSampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _git_revision() -> Dict:
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    return {"commit": git("rev-parse", "--short", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "app"))}
+
+
+def start_server(args: argparse.Namespace, fixture_url: str, work_dir: str) -> subprocess.Popen:
+    """スタブ入りのアプリをuvicornで起動"""
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join([APP_DIR, ROOT_DIR]),
+        "BENCH_FIXTURE_URL": fixture_url,
+        "BENCH_AUDIO_SECONDS": str(args.audio_seconds),
+        "TEMP_DIR": os.path.join(work_dir, "temp"),
+        "CACHE_DIR": os.path.join(work_dir, "cache"),
+    }
+    if args.workers > 1:
+        env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(work_dir, "prometheus")
+        os.makedirs(env["PROMETHEUS_MULTIPROC_DIR"])
+
+    command = [
+        sys.executable, "-m", "uvicorn", "bench.app:app",
+        "--host", "127.0.0.1", "--port", str(args.port), "--workers", str(args.workers),
+        "--log-level", "warning",
+    ]
+    log = open(os.path.join(work_dir, "server.log"), "wb")
+    return subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                if (await client.get(f"{base_url}/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not become ready")
+
+
+def build_requests(args: argparse.Namespace) -> List[Dict]:
+    """リクエストの一覧（--distinct 件を超えた分は同じ動画を繰り返しキャッシュを効かせる）"""
+    token = uuid.uuid4().hex[:4]
+    distinct = args.distinct or args.requests
+    # 動画IDは11文字に収める必要がある
+    if args.mode == "album" and (distinct > 100 or args.tracks > 9999):
+        raise SystemExit("album mode supports up to 100 distinct albums of up to 9999 tracks")
+    requests = []
+    for n in range(args.requests):
+        k = n % distinct
+        if args.mode == "single":
+            url = f"https://www.youtube.com/watch?v={token}s{k:06d}"
+            requests.append({"path": "/api/v1/extract-audio", "tracks": 1,
+                             "json": {"url": url, "stream": args.stream, "profile": args.profile}})
+        else:
+            url = f"https://www.youtube.com/watch?v={token}a{k:02d}0000&list=PL{token}a{k:02d}n{args.tracks}"
+            requests.append({"path": "/api/v1/extract-album", "tracks": args.tracks,
+                             "json": {"url": url, "profile": args.profile}})
+    return requests
+
+
+async def drive(base_url: str, requests: List[Dict], concurrency: int) -> List[Dict]:
+    """指定した並列度でリクエストを送り、各リクエストの結果を返す"""
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send(client: httpx.AsyncClient, request: Dict) -> Dict:
+        async with slots:
+            started = time.perf_counter()
+            received = 0
+            tail = b""
+            try:
+                async with client.stream("POST", f"{base_url}{request['path']}", json=request["json"]) as response:
+                    async for chunk in response.aiter_bytes():
+                        received += len(chunk)
+                        tail = (tail + chunk)[-ZIP_TAIL_BYTES:]
+                    status = response.status_code
+            except httpx.HTTPError as e:
+                status, received = None, 0
+                print(f"Request failed: {e}", file=sys.stderr)
+            latency = time.perf_counter() - started
+
+            tracks = request["tracks"]
+            if status == 200 and request["path"].endswith("/extract-album"):
+                # 失敗した曲はZIPに含まれないため、実際に入った曲数を数える
+                tracks = zip_entry_count(tail)
+            return {"status": status, "latency": latency, "bytes": received, "tracks": tracks}
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        return await asyncio.gather(*(send(client, request) for request in requests))
+
+
+def summarize(samples: List[Dict], wall_seconds: float, cpu_seconds: float, peak_rss: int) -> Dict:
+    ok = [s for s in samples if s["status"] == 200]
+    latencies = [s["latency"] for s in ok]
+    tracks = sum(s["tracks"] for s in ok)
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": len(samples) - len(ok),
+        "tracks": tracks,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_tracks_per_s": round(tracks / wall_seconds, 3) if wall_seconds else None,
+        "latency_s": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "max": max(latencies) if latencies else None,
+        },
+        "peak_rss_bytes": peak_rss,
+        "cpu_seconds": round(cpu_seconds, 3),
+        "cpu_seconds_per_track": round(cpu_seconds / tracks, 3) if tracks else None,
+        "bytes_received": sum(s["bytes"] for s in ok),
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict:
+    fixture = FixtureServer(audio_seconds=args.audio_seconds, latency=args.latency).start()
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    args.port = args.port or _free_port()
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = start_server(args, fixture.base_url, work_dir)
+    try:
+        await wait_until_ready(base_url, server)
+        sampler = ResourceSampler(server.pid).start()
+        cpu_before = sampler.cpu_seconds()
+        started = time.perf_counter()
+        samples = await drive(base_url, build_requests(args), args.concurrency)
+        wall_seconds = time.perf_counter() - started
+        cpu_seconds = sampler.cpu_seconds() - cpu_before
+        sampler.stop()
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        fixture.stop()
+        if args.keep_work_dir:
+            print(f"Work directory kept: {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "benchmark": {
+            "mode": args.mode, "requests": args.requests, "concurrency": args.concurrency,
+            "tracks": args.tracks if args.mode == "album" else 1, "distinct": args.distinct or args.requests,
+            "audio_seconds": args.audio_seconds, "latency": args.latency, "workers": args.workers,
+            "stream": args.stream, "profile": args.profile,
+        },
+        "git": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": summarize(samples, wall_seconds, cpu_seconds, sampler.peak_rss),
+    }
+
+
+# 比較する指標と、値が大きいほど良いか
+COMPARED_METRICS = [
+    ("throughput_tracks_per_s", True),
+    ("latency_s.p50", False),
+    ("latency_s.p95", False),
+    ("latency_s.p99", False),
+    ("peak_rss_bytes", False),
+    ("cpu_seconds_per_track", False),
+]
+
+
+def _metric(result: Dict, path: str) -> Optional[float]:
+    value = result["results"]
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(baseline_path: str, candidate_path: str, threshold: float) -> int:
+    """2つの結果を比較し、threshold（%）を超えて悪化した指標があれば 1 を返す"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    if baseline["benchmark"] != candidate["benchmark"]:
+        print("Warning: benchmark settings differ", file=sys.stderr)
+
+    def fmt(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.3f}"
+
+    regressions = 0
+    print(f"{'metric':<26}{'baseline':>16}{'candidate':>16}{'change':>10}")
+    for path, higher_is_better in COMPARED_METRICS:
+        before, after = _metric(baseline, path), _metric(candidate, path)
+        if not before or after is None:
+            print(f"{path:<26}{fmt(before):>16}{fmt(after):>16}{'-':>10}")
+            continue
+        change = (after - before) * 100 / before
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > threshold else ""
+        regressions += bool(flag)
+        print(f"{path:<26}{fmt(before):>16}{fmt(after):>16}{change:>+9.1f}%{flag}")
+    return 1 if regressions else 0
+
+
+def main() -> int:
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        parser = argparse.ArgumentParser(prog="bench/run.py compare")
+        parser.add_argument("baseline")
+        parser.add_argument("candidate")
+        parser.add_argument("--threshold", type=float, default=10.0, help="悪化とみなす変化率（%%）")
+        args = parser.parse_args(sys.argv[2:])
+        return compare(args.baseline, args.candidate, args.threshold)
+
+    parser = argparse.ArgumentParser(description="Offline benchmark for the extraction API")
+    parser.add_argument("--mode", choices=["single", "album"], default="single")
+    parser.add_argument("--requests", type=int, default=20, help="送信するリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に送るリクエスト数")
+    parser.add_argument("--tracks", type=int, default=8, help="album モードの1アルバムあたりの曲数")
+    parser.add_argument("--distinct", type=int, default=0, help="異なる動画の数（0 = 全て別の動画）")
+    parser.add_argument("--audio-seconds", type=float, default=30.0, help="合成する音声の長さ（秒）")
+    parser.add_argument("--latency", type=float, default=0.0, help="フィクスチャサーバの応答遅延（秒）")
+    parser.add_argument("--workers", type=int, default=1, help="uvicornのワーカー数")
+    parser.add_argument("--stream", action="store_true", help="ストリーミングモードで取得")
+    parser.add_argument("--profile", default="mp3-320")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", help="結果のJSONの保存先（既定: bench/results/<時刻>-<commit>.json）")
+    parser.add_argument("--keep-work-dir", action="store_true", help="サーバの作業ディレクトリとログを残す")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{result['git']['commit'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(json.dumps(result["results"], indent=2))
+    print(f"Saved: {output}")
+    results = result["results"]
+    expected_tracks = args.requests * (args.tracks if args.mode == "album" else 1)
+    return 0 if results["errors"] == 0 and results["tracks"] == expected_tracks else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())